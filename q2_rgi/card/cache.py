@@ -0,0 +1,247 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+# Environment variables that configure the persistent cache. The cache is only used
+# if a cache directory is set.
+CACHE_DIR_ENV = "Q2_RGI_CACHE_DIR"
+CACHE_SIZE_ENV = "Q2_RGI_CACHE_SIZE"
+
+# Default size cap of every cache in GB
+DEFAULT_CACHE_SIZE = 20
+
+# Content hashes of files that were already hashed in this process, keyed by path,
+# size and modification time
+_file_hashes = {}
+
+
+class DirectoryCache:
+    """
+    Persistent, size capped cache of directories keyed by content hashes.
+
+    Entries are created in a staging directory without holding the lock on the
+    cache, so that creating one entry doesn't block the use of others. Only one
+    process at a time creates an entry with the same key. The exclusive lock on the
+    cache is only held to move finished entries into place and to select entries for
+    eviction, so concurrent processes never see partially written entries. Entries
+    are held with a shared lock while they are in use and are never evicted during
+    that time. The total size of the cache is kept in a file, and when it grows
+    beyond the size cap, the least recently used entries are removed.
+
+    Args:
+        root (str): Directory that holds the cache entries.
+        max_size (float): Size cap of the cache in bytes.
+    """
+
+    def __init__(self, root: str, max_size: float):
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(self.root, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, name: str):
+        """
+        Creates the cache called name inside the directory set by Q2_RGI_CACHE_DIR.
+        Returns None if no cache directory is set.
+        """
+        cache_dir = os.environ.get(CACHE_DIR_ENV)
+        if not cache_dir:
+            return None
+        max_size = float(os.environ.get(CACHE_SIZE_ENV, DEFAULT_CACHE_SIZE)) * 1024**3
+        return cls(os.path.join(cache_dir, name), max_size)
+
+    @contextmanager
+    def _lock(self, path: str, mode: int):
+        with open(path, "a") as lock_file:
+            fcntl.flock(lock_file, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _entry_path(self, key: str):
+        return os.path.join(self.root, key)
+
+    def _lock_path(self, key: str):
+        return os.path.join(self.root, f"{key}.lock")
+
+    def _create_lock_path(self, key: str):
+        return os.path.join(self.root, f"{key}.create.lock")
+
+    def _size_path(self, key: str):
+        return os.path.join(self.root, f"{key}.size")
+
+    def __contains__(self, key: str):
+        # Entries can still be evicted right after this check, so callers have to be
+        # able to create them in use
+        return os.path.isdir(self._entry_path(key))
+
+    @contextmanager
+    def use(self, key: str, create):
+        """
+        Yields the path to the entry with the key. If the entry doesn't exist it is
+        created by calling create with the path of an empty directory. The entry
+        can't be evicted until the context is left.
+        """
+        path = self._entry_path(key)
+        while True:
+            if not os.path.isdir(path):
+                # Other processes that need the same entry wait until it is created
+                with self._lock(self._create_lock_path(key), fcntl.LOCK_EX):
+                    if not os.path.isdir(path):
+                        self._create(key, create)
+
+            entry_lock = open(self._lock_path(key), "a")
+            fcntl.flock(entry_lock, fcntl.LOCK_SH)
+
+            # The entry can be evicted between creating it and taking the lock. The
+            # lock file is removed together with the entry, so a lock on a removed
+            # lock file doesn't protect the entry
+            try:
+                in_place = (
+                    os.stat(self._lock_path(key)).st_ino
+                    == os.fstat(entry_lock.fileno()).st_ino
+                )
+            except FileNotFoundError:
+                in_place = False
+            if in_place and os.path.isdir(path):
+                break
+            fcntl.flock(entry_lock, fcntl.LOCK_UN)
+            entry_lock.close()
+
+        # Mark the entry as recently used
+        os.utime(path)
+        try:
+            yield path
+        finally:
+            fcntl.flock(entry_lock, fcntl.LOCK_UN)
+            entry_lock.close()
+
+    def _create(self, key: str, create):
+        # Create the entry in a staging directory and move it into place once it is
+        # complete
+        staging = tempfile.mkdtemp(dir=self.root, prefix=".staging-")
+        try:
+            create(staging)
+            size = _directory_size(staging)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        to_remove = []
+        with self._lock(os.path.join(self.root, ".lock"), fcntl.LOCK_EX):
+            # Another process may have created the same entry in the meantime
+            if not os.path.isdir(self._entry_path(key)):
+                total_size = self._read_total_size()
+                os.rename(staging, self._entry_path(key))
+                with open(self._size_path(key), "w") as f:
+                    f.write(str(size))
+                total_size += size
+                if total_size > self.max_size:
+                    to_remove, total_size = self._evict(keep=key, total_size=total_size)
+                with open(os.path.join(self.root, ".size"), "w") as f:
+                    f.write(str(total_size))
+            else:
+                to_remove.append(staging)
+
+        # Removing directories can take a while, so it is done without the lock
+        for path in to_remove:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _read_total_size(self):
+        # The total size is recalculated once if it wasn't recorded yet
+        try:
+            with open(os.path.join(self.root, ".size")) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return sum(size for _, _, size in self._entries())
+
+    def _entries(self):
+        entries = []
+        for key in os.listdir(self.root):
+            path = self._entry_path(key)
+            if key.startswith(".") or not os.path.isdir(path):
+                continue
+            try:
+                with open(self._size_path(key)) as f:
+                    size = int(f.read())
+            except (FileNotFoundError, ValueError):
+                size = _directory_size(path)
+            entries.append((os.stat(path).st_mtime, key, size))
+        return entries
+
+    def _evict(self, keep: str, total_size: int):
+        """
+        Selects least recently used entries that are not in use until the cache is
+        smaller than its size cap. The selected entries are moved out of place, so
+        they can be removed after the lock on the cache is released.
+
+        Args:
+            keep (str): Key of the entry that must not be evicted.
+            total_size (int): Current total size of the cache in bytes.
+
+        Returns:
+            list: Paths of the evicted entries.
+            int: Total size of the cache without the evicted entries.
+        """
+        evicted = []
+        for _, key, size in sorted(self._entries()):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            with open(self._lock_path(key), "a") as entry_lock:
+                try:
+                    fcntl.flock(entry_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                path = tempfile.mkdtemp(dir=self.root, prefix=".evicted-")
+                os.rename(self._entry_path(key), os.path.join(path, key))
+                os.remove(self._lock_path(key))
+                for path_to_remove in [
+                    self._size_path(key),
+                    self._create_lock_path(key),
+                ]:
+                    if os.path.exists(path_to_remove):
+                        os.remove(path_to_remove)
+            evicted.append(path)
+            total_size -= size
+        return evicted, total_size
+
+
+def _directory_size(path: str):
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            file_path = os.path.join(root, file)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+def hash_file(path: str, chunk_size: int = 1024**2):
+    """Returns the SHA-256 hex digest of the file content."""
+    stat = os.stat(path)
+    memo_key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        _file_hashes[memo_key] = digest.hexdigest()
+    return _file_hashes[memo_key]
+
+
+def hash_key(items: list, files: list = ()):
+    """
+    Creates a cache key from a list of values and the content of a list of files.
+    Values are hashed as strings, so that a value is never mistaken for a path.
+    """
+    digest = hashlib.sha256()
+    for item in [str(item) for item in items] + [hash_file(f) for f in files]:
+        digest.update(item.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
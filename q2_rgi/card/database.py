@@ -1,22 +1,70 @@
+import fcntl
 import glob
 import gzip
+import hashlib
+import json
 import os
 import shutil
 import subprocess
 import tarfile
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from tqdm import tqdm
 
-from q2_rgi.card.utils import colorify, run_command
+from q2_rgi.card.cache import CACHE_DIR_ENV
+from q2_rgi.card.utils import colorify, copy_files, run_command
 from q2_rgi.types._format import (
     CARDDatabaseDirectoryFormat,
     CARDKmerDatabaseDirectoryFormat,
 )
 
+# Size of the chunks in which database archives are downloaded and written to disk
+CHUNK_SIZE = 1024**2
 
-def fetch_card_db() -> (
+# Number of times an interrupted download is resumed before giving up
+RETRIES = 5
+
+# Delay in seconds before the first retry, which doubles with every retry
+RETRY_DELAY = 1
+
+# URLs of the latest CARD and WildCARD archives
+CARD_URL = "https://card.mcmaster.ca/latest/data"
+WILDCARD_URL = "https://card.mcmaster.ca/latest/variants"
+
+# File in the CARD database that stores the versions of the archives it was created
+# from and the sizes of the k-mer database files that were fetched with it
+METADATA_FILE = "fetch_metadata.json"
+
+# File in the CARD aligner index that stores the CARD version and settings it was
+# built with
+INDEX_METADATA_FILE = "index_metadata.json"
+
+# Files that are kept from the CARD and WildCARD archives
+CARD_FILES = ("card.json",)
+WILDCARD_FILES = (
+    "index-for-model-sequences.txt.gz",
+    "nucleotide_fasta_protein_homolog_model_variants.fasta.gz",
+    "nucleotide_fasta_protein_overexpression_model_variants.fasta.gz",
+    "nucleotide_fasta_protein_variant_model_variants.fasta.gz",
+    "nucleotide_fasta_rRNA_gene_variant_model_variants.fasta.gz",
+    "61_kmer_db.json.gz",
+    "all_amr_61mers.txt.gz",
+    "15_kmer_db.json.gz",
+    "all_amr_15mers.txt.gz",
+)
+
+# Size of the buffer that extracted and decompressed files are streamed through
+BUFFER_SIZE = 1024**2
+
+
+def fetch_card_db(
+    previous_card_db: CARDDatabaseDirectoryFormat = None,
+    previous_61_mer_db: CARDKmerDatabaseDirectoryFormat = None,
+    previous_15_mer_db: CARDKmerDatabaseDirectoryFormat = None,
+) -> (
     CARDDatabaseDirectoryFormat,
     CARDKmerDatabaseDirectoryFormat,
     CARDKmerDatabaseDirectoryFormat,
@@ -26,18 +74,46 @@ def fetch_card_db() -> (
             card_tar_path = os.path.join(tmp_dir, "card_tar")
             wildcard_tar_path = os.path.join(tmp_dir, "wildcard_tar")
 
-            # Download CARD and WildCARD tar database archives with progressbars
-            download_with_progress_bar(
-                url="https://card.mcmaster.ca/latest/data",
-                description="Downloading CARD database",
-                tar_path=card_tar_path,
+            # Check which archives changed on the server since the previous databases
+            # were fetched. WildCARD files can only be reused if all previous
+            # databases are available and the k-mer databases were fetched together
+            # with the CARD database
+            metadata = read_fetch_metadata(previous_card_db)
+            card_changed = has_changed(CARD_URL, metadata)
+            wildcard_changed = (
+                previous_61_mer_db is None
+                or previous_15_mer_db is None
+                or any(
+                    metadata.get(file) != size
+                    for file, size in kmer_db_sizes(
+                        previous_61_mer_db, previous_15_mer_db
+                    ).items()
+                )
+                or has_changed(WILDCARD_URL, metadata)
             )
 
-            download_with_progress_bar(
-                url="https://card.mcmaster.ca/latest/variants",
-                description="Downloading WildCARD database",
-                tar_path=wildcard_tar_path,
-            )
+            # Download changed CARD and WildCARD tar database archives at the same
+            # time with one progressbar each
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                futures = {}
+                if card_changed:
+                    futures[CARD_URL] = executor.submit(
+                        download_with_progress_bar,
+                        url=CARD_URL,
+                        description="Downloading CARD database",
+                        tar_path=card_tar_path,
+                        position=0,
+                    )
+                if wildcard_changed:
+                    futures[WILDCARD_URL] = executor.submit(
+                        download_with_progress_bar,
+                        url=WILDCARD_URL,
+                        description="Downloading WildCARD database",
+                        tar_path=wildcard_tar_path,
+                        position=1,
+                    )
+                for url, future in futures.items():
+                    metadata[url] = future.result()
 
         except requests.ConnectionError as e:
             raise requests.ConnectionError(
@@ -47,49 +123,92 @@ def fetch_card_db() -> (
         print(colorify("Extracting database files..."), flush=True)
 
         # Create directories to store zipped and unzipped database files
-        os.mkdir(os.path.join(tmp_dir, "card"))
-        os.mkdir(os.path.join(tmp_dir, "wildcard_zip"))
-        os.mkdir(os.path.join(tmp_dir, "wildcard"))
+        card_dir = os.path.join(tmp_dir, "card")
+        wildcard_zip_dir = os.path.join(tmp_dir, "wildcard_zip")
+        wildcard_dir = os.path.join(tmp_dir, "wildcard")
+        for directory in [card_dir, wildcard_zip_dir, wildcard_dir]:
+            os.mkdir(directory)
 
-        # Extract tar.bz2 archives and store files in dirs "card" and "wildcard_zip"
+        # Extract only the needed files from the tar.bz2 archives. Both archives are
+        # extracted at the same time and every gzip file from the WildCARD archive is
+        # decompressed into the "wildcard" dir as soon as it is extracted
         try:
-            with tarfile.open(card_tar_path, mode="r:bz2") as c_tar:
-                c_tar.extractall(path=os.path.join(tmp_dir, "card"))
-
-            with tarfile.open(wildcard_tar_path, mode="r|bz2") as wc_tar:
-                wc_tar.extractall(path=os.path.join(tmp_dir, "wildcard_zip"))
+            with ThreadPoolExecutor(
+                max_workers=min(len(WILDCARD_FILES), os.cpu_count() or 1) + 1
+            ) as executor:
+                futures = []
+                if card_changed:
+                    futures.append(
+                        executor.submit(
+                            list, extract_members(card_tar_path, CARD_FILES, card_dir)
+                        )
+                    )
+                if wildcard_changed:
+                    for path in extract_members(
+                        wildcard_tar_path, WILDCARD_FILES, wildcard_zip_dir
+                    ):
+                        futures.append(
+                            executor.submit(
+                                gunzip,
+                                path,
+                                os.path.join(wildcard_dir, os.path.basename(path)[:-3]),
+                            )
+                        )
+                for future in futures:
+                    future.result()
 
         except tarfile.ReadError as a:
             raise tarfile.ReadError("Tarfile is invalid.") from a
 
-        # List of files to be unzipped
-        files = (
-            "index-for-model-sequences.txt.gz",
-            "nucleotide_fasta_protein_homolog_model_variants.fasta.gz",
-            "nucleotide_fasta_protein_overexpression_model_variants.fasta.gz",
-            "nucleotide_fasta_protein_variant_model_variants.fasta.gz",
-            "nucleotide_fasta_rRNA_gene_variant_model_variants.fasta.gz",
-            "61_kmer_db.json.gz",
-            "all_amr_61mers.txt.gz",
-            "15_kmer_db.json.gz",
-            "all_amr_15mers.txt.gz",
-        )
+        # Take the files of archives that didn't change from the previous databases
+        if not card_changed:
+            copy_files([os.path.join(str(previous_card_db), "card.json")], card_dir)
+        if not wildcard_changed:
+            copy_files(
+                [
+                    os.path.join(str(db), file[:-3])
+                    for file in WILDCARD_FILES
+                    for db in [previous_card_db, previous_61_mer_db, previous_15_mer_db]
+                    if os.path.exists(os.path.join(str(db), file[:-3]))
+                ],
+                wildcard_dir,
+            )
 
-        # Unzip gzip files and save them in "wildcard" dir
-        for file in files:
-            with gzip.open(
-                os.path.join(tmp_dir, "wildcard_zip", file), "rb"
-            ) as f_in, open(
-                os.path.join(tmp_dir, "wildcard", file[:-3]), "wb"
-            ) as f_out:
-                f_out.write(f_in.read())
+        # A new CARD archive only has to be preprocessed if its version changed
+        card_updated = card_changed and (
+            previous_card_db is None
+            or card_version(card_dir) != card_version(str(previous_card_db))
+        )
 
         print(colorify("Preprocessing database files..."), flush=True)
 
         # Preprocess data for CARD and WildCARD
-        # This creates additional fasta files in the temp directory
-        preprocess(dir=tmp_dir, operation="card")
-        preprocess(dir=tmp_dir, operation="wildcard")
+        # This creates additional fasta files in the temp directory. Files of
+        # the previous database are reused if the data they are created from didn't
+        # change
+        if card_updated:
+            preprocess(dir=tmp_dir, operation="card")
+        else:
+            copy_files(
+                glob.glob(
+                    os.path.join(str(previous_card_db), "card_database_v*.fasta")
+                ),
+                tmp_dir,
+            )
+
+        if card_updated or wildcard_changed:
+            preprocess(dir=tmp_dir, operation="wildcard")
+        else:
+            print(
+                colorify(
+                    "CARD and WildCARD are up to date. Reusing previous databases."
+                ),
+                flush=True,
+            )
+            copy_files(
+                glob.glob(os.path.join(str(previous_card_db), "wildcard_database_v0*")),
+                tmp_dir,
+            )
 
         print(colorify("Creating database artifacts..."), flush=True)
 
@@ -146,29 +265,265 @@ def fetch_card_db() -> (
                     os.path.join(src_des[0], file), os.path.join(src_des[1], file)
                 )
 
+        # Save the versions of the downloaded archives and the sizes of the k-mer
+        # database files for the next incremental fetch
+        metadata.update(kmer_db_sizes(_61_mer_db, _15_mer_db))
+        with open(os.path.join(str(card_db), METADATA_FILE), "w") as f:
+            json.dump(metadata, f, indent=2)
+
         return card_db, _61_mer_db, _15_mer_db
 
 
-def download_with_progress_bar(url, description, tar_path):
-    response = requests.get(url=url, stream=True)
+def read_fetch_metadata(card_db: CARDDatabaseDirectoryFormat):
+    """
+    Returns the ETag or Last-Modified date of every archive that card_db was created
+    from, keyed by URL. Returns an empty dict if card_db is None or if it was created
+    before this metadata was saved.
+    """
+    if card_db is None:
+        return {}
+    path = os.path.join(str(card_db), METADATA_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def kmer_db_sizes(*kmer_dbs: CARDKmerDatabaseDirectoryFormat):
+    """
+    Returns the size of every file in kmer_dbs as a string, keyed by file name. The
+    sizes identify the WildCARD release that the k-mer databases were created from
+    without reading the large k-mer files.
+    """
+    return {
+        file: str(os.path.getsize(os.path.join(str(db), file)))
+        for db in kmer_dbs
+        for file in os.listdir(str(db))
+    }
+
+
+def has_changed(url: str, metadata: dict):
+    """
+    Checks with a HEAD request if the file at url changed since the metadata was
+    saved. Files that the server doesn't report an ETag or Last-Modified date for are
+    always treated as changed.
+    """
+    if url not in metadata:
+        return True
+    validator = _validator(requests.head(url=url, allow_redirects=True, timeout=60))
+    return not validator or validator != metadata[url]
+
 
-    # Get content length to calculate progress bar length
-    tot_size = int(response.headers.get("content-length", 0))
+def card_version(card_dir: str):
+    # Get the version of CARD from card.json
+    with open(os.path.join(card_dir, "card.json")) as f:
+        return json.load(f).get("_version")
 
-    # Initialize CARD progress bar and download database
-    progress_bar_card = tqdm(
-        total=tot_size,
-        unit="B",
-        unit_scale=True,
-        desc=description,
+
+def check_card_index(card_index, card_db: CARDDatabaseDirectoryFormat, **settings):
+    """
+    Checks that a prebuilt CARD aligner index was built from the same CARD version
+    and with the same settings as the action it is used by.
+
+    Args:
+        card_index (CARDAlignerIndexDirectoryFormat): Prebuilt aligner index.
+        card_db (CARDDatabaseDirectoryFormat): CARD database used by the action.
+        **settings: Aligner and settings used by the action.
+
+    Raises:
+        ValueError: If the CARD version or any of the settings is different.
+    """
+    with open(os.path.join(str(card_index), INDEX_METADATA_FILE)) as f:
+        metadata = json.load(f)
+
+    expected = {"card_version": card_version(str(card_db)), **settings}
+    different = [key for key in expected if metadata.get(key) != expected[key]]
+    if different:
+        raise ValueError(
+            "The CARD index was built from a different CARD version or with different "
+            f"settings and can't be used. Different: {', '.join(different)}. Build "
+            "the index again with build-card-index or don't provide it."
+        )
+
+
+def download_with_progress_bar(
+    url: str,
+    description: str,
+    tar_path: str,
+    chunk_size: int = CHUNK_SIZE,
+    position: int = None,
+):
+    """
+    Downloads the file at url to tar_path while showing a progressbar.
+
+    The file is first written to a partial file. If the connection drops, the
+    download is resumed from the end of the partial file with an HTTP range request.
+    If Q2_RGI_CACHE_DIR is set, the partial file is kept in the cache directory, so
+    that downloads that were interrupted in an earlier run are resumed as well.
+    Partial files are only resumed if the server reports the same ETag or
+    Last-Modified date as when the download was started. Failed attempts are retried
+    with an exponentially growing delay.
+
+    Args:
+        url (str): URL of the file to download.
+        description (str): Description shown next to the progressbar.
+        tar_path (str): Path that the downloaded file is moved to once it is complete.
+        chunk_size (int): Size of the chunks in bytes that are written to disk.
+        position (int): Line of the progressbar if several are shown at once.
+
+    Returns:
+        str: ETag or Last-Modified date of the downloaded file.
+    """
+    part_path = partial_download_path(url, tar_path)
+    progress_bar = tqdm(unit="B", unit_scale=True, desc=description, position=position)
+
+    # Only one process at a time can write to a partial file
+    with open(f"{part_path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            for attempt in range(RETRIES + 1):
+                try:
+                    download_part(url, part_path, chunk_size, progress_bar)
+                    break
+                except (
+                    requests.ConnectionError,
+                    requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError,
+                ) as e:
+                    if attempt == RETRIES:
+                        raise requests.ConnectionError(
+                            f"Downloading {url} failed after {RETRIES} retries."
+                        ) from e
+
+                    # Wait longer after every failed attempt
+                    time.sleep(RETRY_DELAY * 2**attempt)
+        finally:
+            progress_bar.close()
+
+        # Get the ETag or Last-Modified date of the downloaded file
+        with open(f"{part_path}.validator") as f:
+            validator = f.read()
+
+        shutil.move(part_path, tar_path)
+        _remove_partial_download(part_path)
+
+    return validator
+
+
+def download_part(url: str, part_path: str, chunk_size: int, progress_bar: tqdm):
+    """
+    Downloads the file at url into part_path. Resumes the download at the end of
+    part_path if the file at url didn't change since the partial file was started.
+    """
+    validator_path = f"{part_path}.validator"
+
+    # Request only the missing bytes if there is a partial file that can be resumed
+    offset = 0
+    headers = {}
+    if os.path.exists(part_path) and os.path.exists(validator_path):
+        with open(validator_path) as f:
+            validator = f.read()
+
+        # Without an ETag or Last-Modified date it can't be checked that the file
+        # didn't change, so the download is started from scratch
+        if validator:
+            offset = os.path.getsize(part_path)
+            headers = {"Range": f"bytes={offset}-", "If-Range": validator}
+
+    with requests.get(url=url, stream=True, headers=headers, timeout=60) as response:
+        # The partial file is already complete or longer than the file on the server
+        if response.status_code == 416:
+            _remove_partial_download(part_path)
+            return download_part(url, part_path, chunk_size, progress_bar)
+
+        response.raise_for_status()
+
+        # Start from scratch if the server sends the whole file. This happens if the
+        # file changed or if the server doesn't support range requests
+        if response.status_code != 206:
+            offset = 0
+            with open(validator_path, "w") as f:
+                f.write(_validator(response))
+
+        # Get the total size to calculate progress bar length and check completeness
+        if response.status_code == 206:
+            tot_size = int(response.headers["content-range"].rsplit("/", 1)[1])
+        else:
+            tot_size = int(response.headers.get("content-length", 0))
+        progress_bar.reset(total=tot_size or None)
+        progress_bar.update(offset)
+
+        with open(part_path, "r+b" if offset else "wb") as file:
+            file.seek(offset)
+            file.truncate()
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                file.write(chunk)
+                progress_bar.update(len(chunk))
+
+    if tot_size and os.path.getsize(part_path) != tot_size:
+        raise requests.ConnectionError(f"Download of {url} is incomplete.")
+
+
+def partial_download_path(url: str, tar_path: str):
+    """
+    Returns the path of the partial file for downloading url. The partial file is
+    placed in the cache directory if Q2_RGI_CACHE_DIR is set and next to tar_path
+    otherwise.
+    """
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return f"{tar_path}.part"
+
+    downloads_dir = os.path.join(cache_dir, "downloads")
+    os.makedirs(downloads_dir, exist_ok=True)
+    return os.path.join(
+        downloads_dir, f"{hashlib.sha256(url.encode()).hexdigest()}.part"
     )
 
-    with open(tar_path, "wb") as file:
-        for chunk in response.iter_content(chunk_size=8192):
-            file.write(chunk) if chunk else False
-            if tot_size > 0:
-                progress_bar_card.update(len(chunk))
-        progress_bar_card.close() if tot_size > 0 else False
+
+def _validator(response):
+    # Only strong ETags can be used to resume downloads with If-Range
+    etag = response.headers.get("etag", "")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("last-modified", "")
+
+
+def _remove_partial_download(part_path):
+    for path in [part_path, f"{part_path}.validator"]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def extract_members(tar_path: str, members: tuple, dst_dir: str):
+    """
+    Extracts the files in members from a tar.bz2 archive into dst_dir and yields
+    the path of every file once it is extracted. The archive is read as a stream and
+    all other files are skipped.
+    """
+    missing = set(members)
+    with tarfile.open(tar_path, mode="r|bz2") as tar:
+        for member in tar:
+            name = os.path.normpath(member.name)
+            if not member.isfile() or name not in missing:
+                continue
+
+            path = os.path.join(dst_dir, name)
+            with tar.extractfile(member) as f_in, open(path, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out, BUFFER_SIZE)
+            missing.remove(name)
+            yield path
+
+    if missing:
+        raise tarfile.ReadError(
+            f"Files {', '.join(sorted(missing))} are missing from {tar_path}."
+        )
+
+
+def gunzip(src: str, dst: str):
+    # Decompress in chunks so that memory usage doesn't depend on the file size
+    with gzip.open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, BUFFER_SIZE)
 
 
 def preprocess(dir, operation):
@@ -0,0 +1,203 @@
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import biom
+import pandas as pd
+
+from q2_rgi.card.utils import create_count_table, read_rgi_table
+from q2_rgi.types import CARDAnnotationDirectoryFormat
+
+# RGI nudges loose hits of protein homolog models with at least this identity to
+# strict hits if include_nudge is set
+NUDGE_IDENTITY = 95.0
+NUDGE_MODEL_TYPE = "protein homolog model"
+
+# Number of bins that are read and written at the same time
+MAX_WORKERS = 8
+
+
+def filter_mags_annotations(
+    amr_annotations: CARDAnnotationDirectoryFormat,
+    include_loose: bool = False,
+    include_nudge: bool = False,
+    min_identity: float = 0.0,
+    min_coverage: float = 0.0,
+) -> (CARDAnnotationDirectoryFormat, biom.Table):
+    samp_bins = [
+        (samp, samp_bin)
+        for samp, bins in amr_annotations.sample_dict().items()
+        for samp_bin in bins
+    ]
+    filtered_annotations = CARDAnnotationDirectoryFormat()
+
+    # Read the annotations of all bins into one table, so that the criteria are
+    # applied to all bins at once
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        tables = list(
+            executor.map(
+                lambda samp_bin: _read_annotation_txt(amr_annotations, samp_bin),
+                samp_bins,
+            )
+        )
+    annotations = pd.concat(tables, keys=range(len(samp_bins)), names=["bin", None])
+    annotations = _rethreshold(
+        annotations, include_loose, include_nudge, min_identity, min_coverage
+    )
+    if annotations.empty:
+        raise ValueError(
+            "None of the annotations meet the criteria. No output can be created."
+        )
+
+    # Write the remaining rows and JSON items of every bin. The table is split into
+    # bins once, and bins without remaining rows are written with an empty table
+    bins = dict(list(annotations.groupby(level="bin")))
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(
+            executor.map(
+                lambda i: _write_bin(
+                    amr_annotations,
+                    filtered_annotations,
+                    samp_bins[i],
+                    bins.get(i, annotations.iloc[:0]),
+                    tables[i].columns,
+                    include_loose,
+                    include_nudge,
+                    min_identity,
+                    min_coverage,
+                ),
+                range(len(samp_bins)),
+            )
+        )
+
+    # Count the best hit AROs of all bins at once
+    bin_index = annotations.index.get_level_values("bin")
+    counts = annotations.groupby([bin_index, "Best_Hit_ARO"]).size()
+    df_list = []
+    for i, bin_counts in counts.groupby(level=0):
+        df = bin_counts.droplevel(0).reset_index()
+        df.columns = ["Best_Hit_ARO", os.path.join(*samp_bins[i])]
+        df_list.append(df)
+    feature_table = create_count_table(df_list=df_list)
+
+    return filtered_annotations, feature_table
+
+
+def _read_annotation_txt(amr_annotations, samp_bin):
+    # All columns are read as strings and quotes are kept as they are, so that kept
+    # rows are written unchanged
+    return read_rgi_table(
+        os.path.join(str(amr_annotations), *samp_bin, "amr_annotation.txt"),
+        dtype=str,
+        engine="c",
+        na_filter=False,
+        quoting=csv.QUOTE_NONE,
+    )
+
+
+def _rethreshold(annotations, include_loose, include_nudge, min_identity, min_coverage):
+    """
+    Applies new criteria to RGI annotations that were created with loose hits.
+
+    Args:
+        annotations (pd.DataFrame): RGI annotations with all columns as strings.
+        include_loose (bool): Keep loose hits.
+        include_nudge (bool): Nudge loose hits with at least 95 percent identity to
+            strict hits. Hits that were nudged before are reverted to loose hits if
+            this is not set.
+        min_identity (float): Minimum percent identity of the best hit.
+        min_coverage (float): Minimum percent length of the reference sequence.
+
+    Returns:
+        pd.DataFrame: The rows that meet the criteria with updated Cut_Off and Nudged
+            columns.
+    """
+    annotations = annotations.copy()
+    identity = pd.to_numeric(annotations["Best_Identities"], errors="coerce")
+    coverage = pd.to_numeric(
+        annotations["Percentage Length of Reference Sequence"], errors="coerce"
+    )
+
+    nudged = annotations["Nudged"].eq("True") | (
+        annotations["Cut_Off"].eq("Loose")
+        & annotations["Model_type"].eq(NUDGE_MODEL_TYPE)
+        & (identity >= NUDGE_IDENTITY)
+    )
+    annotations.loc[nudged, "Cut_Off"] = "Strict" if include_nudge else "Loose"
+    annotations.loc[nudged, "Nudged"] = "True" if include_nudge else ""
+
+    # Rows without identity or coverage are kept, as they can't be compared
+    keep = (
+        (include_loose | annotations["Cut_Off"].ne("Loose"))
+        & ~(identity < min_identity)
+        & ~(coverage < min_coverage)
+    )
+    return annotations[keep]
+
+
+def _write_bin(
+    amr_annotations,
+    filtered_annotations,
+    samp_bin,
+    annotations,
+    columns,
+    include_loose,
+    include_nudge,
+    min_identity,
+    min_coverage,
+):
+    bin_dir = os.path.join(str(filtered_annotations), *samp_bin)
+    os.makedirs(bin_dir)
+    annotations[columns].to_csv(
+        os.path.join(bin_dir, "amr_annotation.txt"),
+        sep="\t",
+        index=False,
+        quoting=csv.QUOTE_NONE,
+    )
+
+    # Keep the items of the remaining ORFs and apply the same criteria to their hits.
+    # Items that don't belong to an ORF, like metadata, are kept
+    with open(
+        os.path.join(str(amr_annotations), *samp_bin, "amr_annotation.json")
+    ) as f:
+        results = json.load(f)
+    orfs = set(annotations["ORF_ID"])
+    filtered = {}
+    for orf, hsps in results.items():
+        if orf.startswith("_"):
+            filtered[orf] = hsps
+        elif orf in orfs:
+            filtered[orf] = _rethreshold_hsps(
+                hsps, include_loose, include_nudge, min_identity, min_coverage
+            )
+    with open(os.path.join(bin_dir, "amr_annotation.json"), "w") as f:
+        json.dump(filtered, f)
+
+
+def _rethreshold_hsps(hsps, include_loose, include_nudge, min_identity, min_coverage):
+    # Applies the criteria to the hits of one ORF in the JSON output. The coverage is
+    # calculated like the "Percentage Length of Reference Sequence" column of the TXT
+    # output. Hits without identity or sequences are kept, as they can't be compared
+    filtered = {}
+    for name, hsp in hsps.items():
+        identity = hsp.get("perc_identity")
+        if identity is not None and identity < min_identity:
+            continue
+        orf_seq = hsp.get("orf_prot_sequence")
+        ref_seq = hsp.get("sequence_from_broadstreet")
+        if orf_seq and ref_seq:
+            # Rounded like in the TXT output, so that the hit of a kept row is kept
+            if round(len(orf_seq) / len(ref_seq) * 100, 2) < min_coverage:
+                continue
+
+        if hsp.get("nudged") or (
+            hsp.get("type_match") == "Loose"
+            and hsp.get("model_type") == NUDGE_MODEL_TYPE
+            and hsp.get("perc_identity", 0) >= NUDGE_IDENTITY
+        ):
+            hsp["type_match"] = "Strict" if include_nudge else "Loose"
+            hsp["nudged"] = include_nudge
+        if include_loose or hsp.get("type_match") != "Loose":
+            filtered[name] = hsp
+    return filtered
@@ -5,6 +5,7 @@ from typing import Union
 import pandas as pd
 from q2_types.feature_data import SequenceCharacteristicsDirectoryFormat
 
+from q2_rgi.card.utils import read_rgi_table
 from q2_rgi.types import (
     CARDAlleleAnnotationDirectoryFormat,
     CARDGeneAnnotationDirectoryFormat,
@@ -31,7 +32,9 @@ def get_gene_lengths(
             os.path.join(str(annotations), samp, "*_mapping_data.txt")
         )[0]
         cols = [gene_name_col, "Reference Length"]
-        len_sample = pd.read_csv(anno_txt, sep="\t", usecols=cols)
+        len_sample = read_rgi_table(
+            anno_txt, usecols=cols, dtype={cols[0]: str, cols[1]: "int64"}
+        )
         len_sample = len_sample.set_index(cols[0])[cols[1]]
         len_all.append(len_sample)
 
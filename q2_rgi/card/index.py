@@ -0,0 +1,99 @@
+import json
+import os
+import shutil
+import tempfile
+
+from q2_rgi.card.database import INDEX_METADATA_FILE, card_version
+from q2_rgi.card.mags import run_rgi_main
+from q2_rgi.card.reads import run_rgi_bwt
+from q2_rgi.card.utils import LOCAL_DB, load_card_db
+from q2_rgi.types import CARDAlignerIndexDirectoryFormat, CARDDatabaseDirectoryFormat
+
+# Aligners used by rgi main to annotate MAGs. All other aligners are used by rgi bwt
+MAGS_ALIGNERS = ("BLAST", "DIAMOND")
+
+# CARD file from which the query sequence is taken that RGI is run on
+QUERY_SOURCE = "nucleotide_fasta_protein_homolog_model_variants.fasta"
+
+
+def build_card_index(
+    card_db: CARDDatabaseDirectoryFormat,
+    aligner: str = "kma",
+    include_wildcard: bool = False,
+    include_other_models: bool = False,
+    threads: int = 1,
+) -> CARDAlignerIndexDirectoryFormat:
+    mags = aligner in MAGS_ALIGNERS
+    if mags and (include_wildcard or include_other_models):
+        raise ValueError(
+            "include-wildcard and include-other-models can only be used with the "
+            "aligners for reads (kma, bowtie2 and bwa)."
+        )
+
+    card_index = CARDAlignerIndexDirectoryFormat()
+    with tempfile.TemporaryDirectory() as tmp, load_card_db(
+        card_db=card_db,
+        fasta=not mags,
+        include_other_models=include_other_models,
+        include_wildcard=include_wildcard,
+        cwd=tmp,
+    ):
+        # RGI builds the index of the aligner the first time it runs, so it is run
+        # once on the sequence of a CARD reference gene
+        header, sequence = _first_sequence(os.path.join(str(card_db), QUERY_SOURCE))
+        if mags:
+            query = os.path.join(tmp, "query.fasta")
+            with open(query, "w") as f:
+                f.write(f">{header}\n{sequence}\n")
+            run_rgi_main(tmp, query, aligner, low_quality=True, num_threads=threads)
+        else:
+            query = os.path.join(tmp, "query.fastq")
+            with open(query, "w") as f:
+                f.write(f"@{header}\n{sequence}\n+\n{'I' * len(sequence)}\n")
+            os.makedirs(os.path.join(tmp, "query"))
+            run_rgi_bwt(
+                cwd=tmp,
+                samp="query",
+                fwd=query,
+                rev=None,
+                aligner=aligner,
+                threads=threads,
+                include_wildcard=include_wildcard,
+                include_other_models=include_other_models,
+            )
+
+        # Keep the local database together with the aligner indices that were built
+        # into it
+        shutil.copytree(
+            os.path.join(tmp, LOCAL_DB), os.path.join(str(card_index), LOCAL_DB)
+        )
+
+    # Store the CARD version and settings, so that actions can check that the
+    # index matches their inputs
+    with open(os.path.join(str(card_index), INDEX_METADATA_FILE), "w") as f:
+        json.dump(
+            {
+                "card_version": card_version(str(card_db)),
+                "aligner": aligner,
+                "include_wildcard": include_wildcard,
+                "include_other_models": include_other_models,
+            },
+            f,
+        )
+
+    return card_index
+
+
+def _first_sequence(path: str):
+    # Returns the name and the sequence of the first record in a FASTA file
+    header = None
+    sequence = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith(">"):
+                if header is not None:
+                    break
+                header = line[1:].split()[0]
+            elif header is not None:
+                sequence.append(line.strip())
+    return header, "".join(sequence)
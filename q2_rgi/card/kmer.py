@@ -20,7 +20,14 @@ from q2_rgi.types import (
 
 
 def kmer_query_mags_card(
-    ctx, amr_annotations, kmer_db, card_db, minimum=10, threads=1, num_partitions=None
+    ctx,
+    amr_annotations,
+    kmer_db,
+    card_db,
+    minimum=10,
+    threads=1,
+    num_partitions=None,
+    partition_balance="count",
 ):
     # Define all actions used by the pipeline
     partition_method = ctx.get_action("rgi", "partition_mags_annotations")
@@ -28,7 +35,9 @@ def kmer_query_mags_card(
     kmer_query = ctx.get_action("rgi", "_kmer_query_mags")
 
     # Partition the annotations
-    (partitioned_annotations,) = partition_method(amr_annotations, num_partitions)
+    (partitioned_annotations,) = partition_method(
+        amr_annotations, num_partitions, partition_balance
+    )
 
     kmer_analyses = []
 
@@ -52,7 +61,14 @@ def kmer_query_mags_card(
 
 
 def kmer_query_reads_card(
-    ctx, amr_annotations, card_db, kmer_db, minimum=10, threads=1, num_partitions=None
+    ctx,
+    amr_annotations,
+    card_db,
+    kmer_db,
+    minimum=10,
+    threads=1,
+    num_partitions=None,
+    partition_balance="count",
 ):
     # Define all actions used by the pipeline
     partition_method = ctx.get_action("rgi", "partition_reads_allele_annotations")
@@ -61,7 +77,9 @@ def kmer_query_reads_card(
     kmer_query = ctx.get_action("rgi", "_kmer_query_reads")
 
     # Partition the annotations
-    (partitioned_annotations,) = partition_method(amr_annotations, num_partitions)
+    (partitioned_annotations,) = partition_method(
+        amr_annotations, num_partitions, partition_balance
+    )
 
     kmer_analyses_allele = []
     kmer_analyses_gene = []
@@ -125,10 +143,10 @@ def _kmer_query_helper(card_db, kmer_db, amr_annotations, minimum, threads):
 
         kmer_analysis = CARDMAGsKmerAnalysisDirectoryFormat()
 
-    with tempfile.TemporaryDirectory() as tmp:
-        # Load all necessary database files and retrieve Kmer size
-        kmer_size = load_card_db(card_db=card_db, kmer_db=kmer_db, kmer=True)
-
+    # Load all necessary database files and retrieve Kmer size
+    with tempfile.TemporaryDirectory() as tmp, load_card_db(
+        card_db=card_db, kmer_db=kmer_db, kmer=True, cwd=tmp
+    ) as kmer_size:
         # Run once per annotation file
         for root, dirs, files in os.walk(str(amr_annotations)):
             if annotation_file in files:
@@ -213,6 +231,7 @@ def _run_rgi_kmer_query(tmp, input_file, input_type, kmer_size, minimum, threads
         str(threads),
         "--output",
         "output",
+        "--local",
     ]
 
     try:
@@ -233,9 +252,8 @@ def kmer_build_card(
 ) -> CARDKmerDatabaseDirectoryFormat:
     kmer_db = CARDKmerDatabaseDirectoryFormat()
 
-    with tempfile.TemporaryDirectory() as tmp:
-        # Load card_db and get data path to card_db fasta file
-        load_card_db(card_db=card_db)
+    # Load card_db and get data path to card_db fasta file
+    with tempfile.TemporaryDirectory() as tmp, load_card_db(card_db=card_db):
         card_fasta = glob.glob(os.path.join(str(card_db), "card_database_v*.fasta"))[0]
 
         # Run RGI kmer-build
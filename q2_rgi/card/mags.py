@@ -1,13 +1,34 @@
+import json
 import os
+import re
 import shutil
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
+import biom
 import pandas as pd
 from q2_types.per_sample_sequences import MultiMAGSequencesDirFmt
 
-from q2_rgi.card.utils import create_count_table, load_card_db, read_in_txt, run_command
-from q2_rgi.types import CARDAnnotationDirectoryFormat, CARDDatabaseDirectoryFormat
+from q2_rgi.card.cache import DirectoryCache, hash_key
+from q2_rgi.card.database import card_version, check_card_index
+from q2_rgi.card.utils import (
+    colorify,
+    create_count_table,
+    link_local_db,
+    link_tree,
+    load_card_db,
+    read_in_txt,
+    rgi_version,
+    run_command,
+    split_threads,
+)
+from q2_rgi.types import (
+    CARDAlignerIndexDirectoryFormat,
+    CARDAnnotationDirectoryFormat,
+    CARDDatabaseDirectoryFormat,
+)
 
 
 def annotate_mags_card(
@@ -19,43 +40,398 @@ def annotate_mags_card(
     include_nudge: bool = False,
     low_quality: bool = False,
     threads: int = 1,
-) -> (CARDAnnotationDirectoryFormat, pd.DataFrame):
+    parallel_bins: int = 1,
+    batch_size_bp: int = 0,
+    card_index: CARDAlignerIndexDirectoryFormat = None,
+) -> (CARDAnnotationDirectoryFormat, biom.Table):
+    # Prodigal only predicts the genes of every contig independently of the other
+    # contigs in the same file with --low_quality, so only then the results of a
+    # batch are the same as the results of its bins
+    if batch_size_bp and not low_quality:
+        raise ValueError(
+            "MAGs can only be annotated in batches with low-quality. Without it, "
+            "Prodigal is trained on all contigs in the input, so the annotation of "
+            "a MAG would depend on the other MAGs in its batch."
+        )
+
     manifest = mag.manifest.view(pd.DataFrame)
     amr_annotations = CARDAnnotationDirectoryFormat()
-    frequency_list = []
-    with tempfile.TemporaryDirectory() as tmp:
-        load_card_db(card_db=card_db)
-        for samp_bin in list(manifest.index):
-            bin_dir = os.path.join(str(amr_annotations), samp_bin[0], samp_bin[1])
-            os.makedirs(bin_dir, exist_ok=True)
-            input_sequence = manifest.loc[samp_bin, "filename"]
-            run_rgi_main(
-                tmp,
-                input_sequence,
-                alignment_tool,
-                split_prodigal_jobs,
-                include_loose,
-                include_nudge,
-                low_quality,
-                threads,
+    samp_bins = list(manifest.index)
+
+    # Split the thread budget between the bins that are annotated at the same time
+    parallel_bins, bin_threads = split_threads(threads, parallel_bins)
+
+    # Annotations of MAGs that were annotated before with the same CARD version and
+    # settings are taken from the result cache if Q2_RGI_CACHE_DIR is set
+    cache = DirectoryCache.from_env("mags")
+    cache_key = None
+    if cache is not None:
+        cache_key = [
+            rgi_version(),
+            card_version(str(card_db)),
+            alignment_tool,
+            include_loose,
+            include_nudge,
+            low_quality,
+        ]
+
+    # A prebuilt aligner index has to match the CARD database and alignment tool
+    if card_index is not None:
+        check_card_index(card_index, card_db, aligner=alignment_tool)
+
+    with tempfile.TemporaryDirectory() as tmp, load_card_db(
+        card_db=card_db, cwd=tmp, card_index=card_index
+    ):
+        # Small MAGs are packed into batches that are annotated with one RGI run
+        # each, to save the fixed cost of every run
+        batched = set()
+        if batch_size_bp:
+            batched = _annotate_batches(
+                samp_bins=[
+                    samp_bin
+                    for samp_bin in samp_bins
+                    if cache is None
+                    or hash_key(cache_key, files=[manifest.loc[samp_bin, "filename"]])
+                    not in cache
+                ],
+                tmp=tmp,
+                manifest=manifest,
+                amr_annotations=amr_annotations,
+                batch_size_bp=batch_size_bp,
+                parallel_batches=parallel_bins,
+                alignment_tool=alignment_tool,
+                split_prodigal_jobs=split_prodigal_jobs,
+                include_loose=include_loose,
+                include_nudge=include_nudge,
+                low_quality=low_quality,
+                threads=bin_threads,
             )
-            txt_path = os.path.join(bin_dir, "amr_annotation.txt")
-            json_path = os.path.join(bin_dir, "amr_annotation.json")
-
-            shutil.move(f"{tmp}/output.txt", txt_path)
-            shutil.move(f"{tmp}/output.json", json_path)
-            samp_bin_name = os.path.join(samp_bin[0], samp_bin[1])
-            frequency_df = read_in_txt(
-                path=txt_path, samp_bin_name=samp_bin_name, data_type="mags"
+
+        annotate_bin = partial(
+            _annotate_bin,
+            tmp=tmp,
+            manifest=manifest,
+            amr_annotations=amr_annotations,
+            alignment_tool=alignment_tool,
+            split_prodigal_jobs=split_prodigal_jobs,
+            include_loose=include_loose,
+            include_nudge=include_nudge,
+            low_quality=low_quality,
+            threads=bin_threads,
+            cache=cache,
+            cache_key=cache_key,
+            batched=batched,
+        )
+
+        # The first bin is annotated on its own so that RGI sets up its alignment
+        # database only once, before the remaining bins are annotated concurrently
+        results = [annotate_bin(samp_bins[0])] if samp_bins else []
+        with ThreadPoolExecutor(max_workers=parallel_bins) as executor:
+            results.extend(executor.map(annotate_bin, samp_bins[1:]))
+
+        if cache is not None:
+            hits = sum(hit for _, hit in results)
+            print(
+                colorify(f"Result cache: {hits} hits, {len(results) - hits} misses."),
+                flush=True,
             )
-            frequency_list.append(frequency_df)
-        feature_table = create_count_table(df_list=frequency_list)
+
+        feature_table = create_count_table(df_list=[df for df, _ in results])
     return (
         amr_annotations,
         feature_table,
     )
 
 
+def _annotate_bin(
+    samp_bin,
+    tmp,
+    manifest,
+    amr_annotations,
+    alignment_tool,
+    split_prodigal_jobs,
+    include_loose,
+    include_nudge,
+    low_quality,
+    threads,
+    cache=None,
+    cache_key=None,
+    batched=(),
+):
+    bin_dir = os.path.join(str(amr_annotations), samp_bin[0], samp_bin[1])
+    os.makedirs(bin_dir, exist_ok=True)
+    input_sequence = manifest.loc[samp_bin, "filename"]
+
+    annotate = partial(
+        _run_rgi_main_into,
+        tmp=tmp,
+        input_sequence=input_sequence,
+        alignment_tool=alignment_tool,
+        split_prodigal_jobs=split_prodigal_jobs,
+        include_loose=include_loose,
+        include_nudge=include_nudge,
+        low_quality=low_quality,
+        threads=threads,
+    )
+    txt_path = os.path.join(bin_dir, "amr_annotation.txt")
+
+    hit = False
+    if samp_bin in batched:
+        # The bin was annotated in a batch, so its results only have to be cached
+        if cache is not None:
+            key = hash_key(cache_key, files=[input_sequence])
+            with cache.use(key, lambda path: link_tree(bin_dir, path)):
+                pass
+    elif cache is None:
+        annotate(bin_dir)
+    else:
+        # The MAG is identified by the hash of its content
+        key = hash_key(cache_key, files=[input_sequence])
+        hit = key in cache
+        if hit:
+            # RGI only runs if the entry was evicted after the check
+            with cache.use(key, annotate) as entry:
+                link_tree(entry, bin_dir)
+        else:
+            # RGI runs outside of the cache lock, so that bins that are annotated
+            # concurrently don't wait for each other
+            annotate(bin_dir)
+            with cache.use(key, lambda path: link_tree(bin_dir, path)):
+                pass
+
+    samp_bin_name = os.path.join(samp_bin[0], samp_bin[1])
+    return (
+        read_in_txt(path=txt_path, samp_bin_name=samp_bin_name, data_type="mags"),
+        hit,
+    )
+
+
+def _run_rgi_main_into(
+    out_dir,
+    tmp,
+    input_sequence,
+    alignment_tool,
+    split_prodigal_jobs,
+    include_loose,
+    include_nudge,
+    low_quality,
+    threads,
+):
+    # Every bin gets its own scratch directory so that concurrent RGI runs don't
+    # overwrite each other's intermediate and output files
+    bin_tmp = tempfile.mkdtemp(dir=tmp)
+    link_local_db(tmp, bin_tmp)
+    run_rgi_main(
+        bin_tmp,
+        input_sequence,
+        alignment_tool,
+        split_prodigal_jobs,
+        include_loose,
+        include_nudge,
+        low_quality,
+        threads,
+    )
+    shutil.move(f"{bin_tmp}/output.txt", os.path.join(out_dir, "amr_annotation.txt"))
+    shutil.move(f"{bin_tmp}/output.json", os.path.join(out_dir, "amr_annotation.json"))
+    shutil.rmtree(bin_tmp)
+
+
+def _annotate_batches(
+    samp_bins,
+    tmp,
+    manifest,
+    amr_annotations,
+    batch_size_bp,
+    parallel_batches,
+    alignment_tool,
+    split_prodigal_jobs,
+    include_loose,
+    include_nudge,
+    low_quality,
+    threads,
+):
+    """
+    Packs MAGs into batches of about batch_size_bp bases, annotates every batch
+    with one RGI run and splits the results into the directories of the MAGs.
+
+    Args:
+        samp_bins (list): (sample, bin) tuples of the MAGs to annotate.
+        tmp (str): Directory with the loaded CARD database.
+        manifest (pd.DataFrame): MAG manifest indexed by (sample, bin).
+        amr_annotations (CARDAnnotationDirectoryFormat): Output directory.
+        batch_size_bp (int): Target number of bases per batch.
+        parallel_batches (int): Number of batches to annotate at the same time.
+
+    Returns:
+        set: (sample, bin) tuples of all annotated MAGs.
+    """
+    batches = _write_batches(
+        [manifest.loc[samp_bin, "filename"] for samp_bin in samp_bins],
+        tmp,
+        batch_size_bp,
+    )
+
+    def annotate_batch(batch):
+        batch_fasta, bins = batch
+        out_dirs = []
+        for index, _ in bins:
+            samp_bin = samp_bins[index]
+            out_dirs.append(os.path.join(str(amr_annotations), *samp_bin))
+            os.makedirs(out_dirs[-1], exist_ok=True)
+
+        batch_tmp = tempfile.mkdtemp(dir=tmp)
+        link_local_db(tmp, batch_tmp)
+        run_rgi_main(
+            batch_tmp,
+            batch_fasta,
+            alignment_tool,
+            split_prodigal_jobs,
+            include_loose,
+            include_nudge,
+            low_quality,
+            threads,
+        )
+        # With split_prodigal_jobs, Prodigal runs on every contig separately and
+        # numbers every contig as the first sequence
+        seq_offsets = None
+        if not split_prodigal_jobs:
+            seq_offsets = [offset for _, offset in bins]
+        _split_batch_output(batch_tmp, out_dirs, seq_offsets)
+        shutil.rmtree(batch_tmp)
+        os.remove(batch_fasta)
+
+    # The first batch is annotated on its own so that RGI sets up its alignment
+    # database only once
+    if batches:
+        annotate_batch(batches[0])
+    with ThreadPoolExecutor(max_workers=parallel_batches) as executor:
+        list(executor.map(annotate_batch, batches[1:]))
+
+    print(
+        colorify(f"Annotated {len(samp_bins)} MAGs in {len(batches)} batches."),
+        flush=True,
+    )
+    return set(samp_bins)
+
+
+# Contig names in a batch are prefixed with the index of their MAG in the batch
+_BATCH_PREFIX = re.compile(r"^q2rgi(\d+)__")
+_PRODIGAL_ID = re.compile(r"# ID=(\d+)_")
+
+
+def _write_batches(input_sequences, tmp, batch_size_bp):
+    """
+    Writes MAGs into combined FASTA files of at least batch_size_bp bases, except for
+    the last one. The names of the contigs are prefixed with the index of their MAG
+    in the batch.
+
+    Args:
+        input_sequences (list): Paths to the FASTA files of the MAGs.
+        tmp (str): Directory in which the batch files are created.
+        batch_size_bp (int): Target number of bases per batch.
+
+    Returns:
+        list: Tuples of the path to the batch file and a list of (index of the MAG in
+            input_sequences, number of sequences before the MAG in the batch).
+    """
+    batches = []
+    out = None
+    for index, input_sequence in enumerate(input_sequences):
+        if out is None:
+            batch_fasta = os.path.join(tmp, f"batch_{len(batches)}.fasta")
+            out = open(batch_fasta, "w")
+            batches.append((batch_fasta, []))
+            n_bases = n_seqs = 0
+
+        bins = batches[-1][1]
+        bins.append((index, n_seqs))
+        prefix = f">q2rgi{len(bins) - 1}__"
+        line = "\n"
+        with open(input_sequence) as f:
+            for line in f:
+                if line.startswith(">"):
+                    out.write(prefix + line[1:])
+                    n_seqs += 1
+                else:
+                    out.write(line)
+                    n_bases += len(line.strip())
+        if not line.endswith("\n"):
+            out.write("\n")
+
+        # A batch is closed once it has enough bases, a MAG is never split
+        if n_bases >= batch_size_bp:
+            out.close()
+            out = None
+
+    if out is not None:
+        out.close()
+    return batches
+
+
+def _unbatch_name(name, seq_offsets):
+    # Returns the index of the MAG of a contig, ORF or hit name and the name without
+    # the batch prefix and with the Prodigal sequence number of the MAG
+    match = _BATCH_PREFIX.match(name)
+    if match is None:
+        return None, name
+    index = int(match.group(1))
+    name = name[match.end() :]
+    if seq_offsets is not None:
+        name = _PRODIGAL_ID.sub(
+            lambda m: f"# ID={int(m.group(1)) - seq_offsets[index]}_", name, count=1
+        )
+    return index, name
+
+
+def _split_batch_output(batch_tmp, out_dirs, seq_offsets=None):
+    """
+    Splits the output.txt and output.json files of an RGI run on a batch into the
+    annotation files of its MAGs.
+
+    Args:
+        batch_tmp (str): Directory with the output files of the batch.
+        out_dirs (list): Output directories of the MAGs in the order of the batch.
+        seq_offsets (list): Number of sequences before every MAG in the batch, used
+            to restore the sequence numbers in the Prodigal IDs. None if Prodigal
+            numbered the sequences of every contig on its own.
+    """
+    # Rows of the text output are assigned by the prefix of their ORF, and the ORF
+    # and contig names are restored
+    with open(os.path.join(batch_tmp, "output.txt")) as f:
+        header = f.readline()
+        columns = header.rstrip("\n").split("\t")
+        orf_column = columns.index("ORF_ID")
+        contig_column = columns.index("Contig")
+        lines = [[header] for _ in out_dirs]
+        for line in f:
+            fields = line.split("\t")
+            index, fields[orf_column] = _unbatch_name(fields[orf_column], seq_offsets)
+            fields[contig_column] = _unbatch_name(fields[contig_column], None)[1]
+            lines[index].append("\t".join(fields))
+    for out_dir, bin_lines in zip(out_dirs, lines):
+        with open(os.path.join(out_dir, "amr_annotation.txt"), "w") as f:
+            f.writelines(bin_lines)
+
+    # Items of the JSON output are assigned by the prefix of their ORF. Items that
+    # don't belong to an ORF, like metadata, are part of every output
+    with open(os.path.join(batch_tmp, "output.json")) as f:
+        results = json.load(f)
+    jsons = [{} for _ in out_dirs]
+    for key, value in results.items():
+        index, key = _unbatch_name(key, seq_offsets)
+        if index is None:
+            for bin_json in jsons:
+                bin_json[key] = value
+            continue
+        for hsp in value.values():
+            if isinstance(hsp, dict) and "orf_from" in hsp:
+                hsp["orf_from"] = _unbatch_name(hsp["orf_from"], None)[1]
+        jsons[index][key] = value
+    for out_dir, bin_json in zip(out_dirs, jsons):
+        with open(os.path.join(out_dir, "amr_annotation.json"), "w") as f:
+            json.dump(bin_json, f)
+
+
 def run_rgi_main(
     tmp,
     input_sequence: str,
@@ -79,6 +455,7 @@ def run_rgi_main(
         alignment_tool,
         "--input_type",
         "contig",
+        "--local",
     ]
     if include_loose:
         cmd.append("--include_loose")
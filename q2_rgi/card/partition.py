@@ -1,11 +1,13 @@
+import heapq
 import os
 import warnings
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 
 import numpy as np
-from qiime2.util import duplicate
 
-from q2_rgi.card.utils import copy_files
+from q2_rgi.card.utils import colorify, copy_files, link_or_copy
 from q2_rgi.types import (
     CARDAlleleAnnotationDirectoryFormat,
     CARDAnnotationDirectoryFormat,
@@ -54,72 +56,68 @@ def collate_reads_gene_kmer_analyses(
 
 def _collate(partition_list):
     collated_partitions = type(partition_list[0])()
-    # For every partition
+
+    # If artifacts are annotations or kmer analyses from MAGs, files are in MAG
+    # directories inside the sample directories. Otherwise they are directly in the
+    # sample directories
+    if isinstance(
+        partition_list[0],
+        (CARDAnnotationDirectoryFormat, CARDMAGsKmerAnalysisDirectoryFormat),
+    ):
+        pattern, id_type = "*/*", "MAG"
+    else:
+        pattern, id_type = "*", "Sample"
+
+    # Map every directory of the collated artifact to the directory it is collated
+    # from. Collisions are detected here, before any files are added
+    dirs = {}
     for partition in partition_list:
-        # For every sample
-        for sample in partition.path.iterdir():
-            # If artifacts are annotations or kmer analyses from MAGs
-            if isinstance(
-                partition_list[0],
-                (CARDAnnotationDirectoryFormat, CARDMAGsKmerAnalysisDirectoryFormat),
-            ):
-                # For every MAG
-                for mag in sample.iterdir():
-                    # Create directories in collate. If dir already exists raise error
-                    try:
-                        os.makedirs(collated_partitions.path / sample.name / mag.name)
-                    except FileExistsError as e:
-                        raise FileExistsError(
-                            f"The directory already exists: {e.filename}. MAG IDs must"
-                            f" be unique across all artifacts. Each artifact in the"
-                            f" list must be unique and cannot be repeated."
-                        )
-
-                    # Copy every file in the MAG directory to the collated directory
-                    for file in mag.iterdir():
-                        duplicate(
-                            file,
-                            collated_partitions.path
-                            / sample.name
-                            / mag.name
-                            / file.name,
-                        )
-
-            # If artifacts are annotations or kmer analyses are from reads
-            else:
-                # Create directories in collate. If dir already exists raise error
-                try:
-                    os.makedirs(collated_partitions.path / sample.name)
-                except FileExistsError as e:
-                    raise FileExistsError(
-                        f"The directory already exists: {e.filename}. Sample IDs must"
-                        f" be unique across all artifacts. Each artifact in the"
-                        f" list must be unique and cannot be repeated."
-                    )
-
-                # Copy every file in the sample directory to the collated directory
-                for file in sample.iterdir():
-                    duplicate(file, collated_partitions.path / sample.name / file.name)
+        for src_dir in sorted(partition.path.glob(pattern)):
+            dst_dir = collated_partitions.path / src_dir.relative_to(partition.path)
+            if dst_dir in dirs:
+                raise FileExistsError(
+                    f"The directory already exists: {dst_dir}. {id_type} IDs must"
+                    f" be unique across all artifacts. Each artifact in the"
+                    f" list must be unique and cannot be repeated."
+                )
+            dirs[dst_dir] = src_dir
+
+    # Create directories in collated artifact and link or copy all files
+    # concurrently
+    files = []
+    for dst_dir, src_dir in dirs.items():
+        os.makedirs(dst_dir)
+        files.extend((file, dst_dir / file.name) for file in src_dir.iterdir())
+
+    with ThreadPoolExecutor() as executor:
+        strategies = Counter(executor.map(lambda file: link_or_copy(*file), files))
+    _report_strategies(strategies, "collated artifact")
 
     return collated_partitions
 
 
 def partition_mags_annotations(
-    annotations: CARDAnnotationDirectoryFormat, num_partitions: int = None
+    annotations: CARDAnnotationDirectoryFormat,
+    num_partitions: int = None,
+    balance: str = "count",
 ) -> CARDAnnotationDirectoryFormat:
-    return _partition_annotations(annotations, num_partitions)
+    return _partition_annotations(annotations, num_partitions, balance)
 
 
 def partition_reads_allele_annotations(
-    annotations: CARDAlleleAnnotationDirectoryFormat, num_partitions: int = None
+    annotations: CARDAlleleAnnotationDirectoryFormat,
+    num_partitions: int = None,
+    balance: str = "count",
 ) -> CARDAlleleAnnotationDirectoryFormat:
-    return _partition_annotations(annotations, num_partitions)
+    return _partition_annotations(annotations, num_partitions, balance)
 
 
 def partition_reads_gene_annotations(
-    annotations: CARDGeneAnnotationDirectoryFormat, num_partitions: int = None
+    annotations: CARDGeneAnnotationDirectoryFormat,
+    num_partitions: int = None,
+    balance: str = "count",
 ) -> CARDGeneAnnotationDirectoryFormat:
-    return _partition_annotations(annotations, num_partitions)
+    return _partition_annotations(annotations, num_partitions, balance)
 
 
 def _partition_annotations(
@@ -129,6 +127,7 @@ def _partition_annotations(
         CARDAlleleAnnotationDirectoryFormat,
     ],
     num_partitions: int = None,
+    balance: str = "count",
 ):
     partitioned_annotations = {}
     annotations_all = []
@@ -163,10 +162,27 @@ def _partition_annotations(
         )
         num_partitions = num_annotations
 
-    # Splits annotations into the specified number of arrays
-    arrays = np.array_split(np.array(annotations_all, dtype=object), num_partitions)
+    # Split annotations into partitions with the same number of annotations or with
+    # about the same total file size
+    if balance == "size":
+        costs = [
+            sum(os.path.getsize(path) for path in annotation[-1])
+            for annotation in annotations_all
+        ]
+        arrays = [
+            [annotations_all[j] for j in indices]
+            for indices in _balance_partitions(costs, num_partitions)
+        ]
+    else:
+        arrays = np.array_split(np.array(annotations_all, dtype=object), num_partitions)
 
+    # Number of files that were added to the partitions per strategy
+    strategies = Counter()
     for i, annotation_tuple in enumerate(arrays, 1):
+        # Partitions without annotations are skipped
+        if len(annotation_tuple) == 0:
+            continue
+
         # Creates directory with same format as input
         partitioned_annotation = type(annotations)()
 
@@ -174,12 +190,16 @@ def _partition_annotations(
         # directories
         if isinstance(annotations, CARDAnnotationDirectoryFormat):
             for sample_id, mag_id, file_paths in annotation_tuple:
-                copy_files(file_paths, partitioned_annotation.path, sample_id, mag_id)
+                strategies += copy_files(
+                    file_paths, partitioned_annotation.path, sample_id, mag_id
+                )
 
         else:
             mag_id = None
             for sample_id, file_paths in annotation_tuple:
-                copy_files(file_paths, partitioned_annotation.path, sample_id)
+                strategies += copy_files(
+                    file_paths, partitioned_annotation.path, sample_id
+                )
 
         # Set key for partitioned_annotations dict to mag_id or sample_id
         partitioned_annotation_key = mag_id if mag_id else sample_id
@@ -190,4 +210,46 @@ def _partition_annotations(
         else:
             partitioned_annotations[i] = partitioned_annotation
 
+    _report_strategies(strategies, "partitions")
+
     return partitioned_annotations
+
+
+def _balance_partitions(costs: list, num_partitions: int) -> list:
+    """
+    Assigns items to partitions so that every partition gets about the same total
+    cost. Items are assigned greedily in order of decreasing cost, each to the
+    partition with the lowest cost so far (longest processing time first).
+
+    Args:
+        costs (list): Cost of every item.
+        num_partitions (int): Number of partitions.
+
+    Returns:
+        list: Sorted lists with the indices of the items in every partition.
+    """
+    partitions = [[] for _ in range(num_partitions)]
+    loads = [(0, 0, i) for i in range(num_partitions)]
+
+    # Ties are broken by the number of items in the partition, so that items without
+    # cost don't leave partitions empty, and by item and partition index for
+    # consistent splitting behaviour
+    for j in sorted(range(len(costs)), key=lambda j: (-costs[j], j)):
+        load, count, i = heapq.heappop(loads)
+        partitions[i].append(j)
+        heapq.heappush(loads, (load + costs[j], count + 1, i))
+
+    return [sorted(partition) for partition in partitions]
+
+
+def _report_strategies(strategies: Counter, target: str):
+    # Prints how many files were added to target by every strategy of link_or_copy
+    print(
+        colorify(
+            f"Files added to {target}: "
+            + ", ".join(
+                f"{n} by {strategy}" for strategy, n in sorted(strategies.items())
+            )
+        ),
+        flush=True,
+    )
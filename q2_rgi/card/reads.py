@@ -1,10 +1,15 @@
+import json
 import os
 import shutil
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import Union
 
+import biom
 import pandas as pd
+import qiime2
 from q2_types.per_sample_sequences import (
     PairedEndSequencesWithQuality,
     SequencesWithQuality,
@@ -13,13 +18,29 @@ from q2_types.per_sample_sequences import (
 )
 from q2_types.sample_data import SampleData
 
-from q2_rgi.card.utils import create_count_table, load_card_db, read_in_txt, run_command
+from q2_rgi.card.database import card_version, check_card_index
+from q2_rgi.card.utils import (
+    auto_parallel_jobs,
+    create_count_table,
+    load_card_db,
+    read_in_txt,
+    run_command,
+    split_threads,
+)
 from q2_rgi.types import (
+    CARDAlignerIndexDirectoryFormat,
     CARDAlleleAnnotationDirectoryFormat,
     CARDDatabaseDirectoryFormat,
     CARDGeneAnnotationDirectoryFormat,
 )
 
+# kma, bowtie2 and bwa scale poorly beyond this number of threads
+MAX_THREADS_PER_SAMPLE = 8
+
+# File in every sample directory of the annotations that stores the CARD version and
+# settings the sample was annotated with, so that samples can be added later
+SETTINGS_FILE = "annotation_settings.json"
+
 
 def annotate_reads_card(
     ctx,
@@ -30,6 +51,12 @@ def annotate_reads_card(
     include_wildcard=False,
     include_other_models=False,
     num_partitions=None,
+    parallel_samples=None,
+    card_index=None,
+    existing_allele_annotation=None,
+    existing_gene_annotation=None,
+    existing_allele_table=None,
+    existing_gene_table=None,
 ):
     # Get all actions used by the pipeline
     if reads.type <= SampleData[SequencesWithQuality]:
@@ -45,25 +72,73 @@ def annotate_reads_card(
     collate_gene_annotations = ctx.get_action("rgi", "collate_reads_gene_annotations")
     merge_tables = ctx.get_action("feature-table", "merge")
 
-    # Partition the reads
-    (partitioned_seqs,) = partition_method(reads, num_partitions)
-
     allele_annotations = []
     gene_annotations = []
     allele_tables = []
     gene_tables = []
 
-    # Run _annotate_reads_card for every partition
-    for read in partitioned_seqs.values():
-        (allele_annotation, gene_annotation, allele_table, gene_table) = annotate(
-            read, card_db, aligner, threads, include_wildcard, include_other_models
-        )
+    # If existing results are given, only samples that are not part of them are
+    # annotated and the new results are merged into the existing ones
+    existing = [
+        existing_allele_annotation,
+        existing_gene_annotation,
+        existing_allele_table,
+        existing_gene_table,
+    ]
+    if any(result is not None for result in existing):
+        if any(result is None for result in existing):
+            raise ValueError(
+                "To add samples to existing results, the existing allele and gene "
+                "annotations and the existing allele and gene feature tables have "
+                "to be provided."
+            )
+
+        _check_existing_samples(*existing)
 
-        # Append output artifacts to lists
-        allele_annotations.append(allele_annotation)
-        gene_annotations.append(gene_annotation)
-        allele_tables.append(allele_table)
-        gene_tables.append(gene_table)
+        settings = {
+            "card_version": card_version(
+                str(card_db.view(CARDDatabaseDirectoryFormat))
+            ),
+            "aligner": aligner,
+            "include_wildcard": include_wildcard,
+            "include_other_models": include_other_models,
+        }
+        for annotation, fmt in zip(
+            existing[:2],
+            [CARDAlleleAnnotationDirectoryFormat, CARDGeneAnnotationDirectoryFormat],
+        ):
+            _check_annotation_settings(annotation.view(fmt), settings)
+
+        allele_annotations.append(existing_allele_annotation)
+        gene_annotations.append(existing_gene_annotation)
+        allele_tables.append(existing_allele_table)
+        gene_tables.append(existing_gene_table)
+
+        reads = _filter_new_samples(ctx, reads, existing_allele_annotation)
+
+    # Only run the annotation if there are samples to annotate
+    if reads is not None:
+        # Partition the reads
+        (partitioned_seqs,) = partition_method(reads, num_partitions)
+
+        # Run _annotate_reads_card for every partition
+        for read in partitioned_seqs.values():
+            allele_annotation, gene_annotation, allele_table, gene_table = annotate(
+                read,
+                card_db,
+                aligner,
+                threads,
+                include_wildcard,
+                include_other_models,
+                parallel_samples,
+                card_index=card_index,
+            )
+
+            # Append output artifacts to lists
+            allele_annotations.append(allele_annotation)
+            gene_annotations.append(gene_annotation)
+            allele_tables.append(allele_table)
+            gene_tables.append(gene_table)
 
     # Collate annotation and feature table artifacts
     (collated_allele_annotations,) = collate_allele_annotations(allele_annotations)
@@ -79,6 +154,90 @@ def annotate_reads_card(
     )
 
 
+def _check_annotation_settings(annotation, settings: dict):
+    """
+    Checks that all samples of an existing reads annotation were annotated with the
+    same CARD version and settings. They are read from the annotation_settings.json
+    file that _annotate_reads_card writes into every sample directory.
+
+    Args:
+        annotation: Existing allele or gene annotation directory format.
+        settings (dict): CARD version and parameters of the current run.
+
+    Raises:
+        ValueError: If samples were annotated with different settings. Samples
+        without recorded settings are treated as different.
+    """
+    different = set()
+    for sample in sorted(annotation.path.iterdir()):
+        path = os.path.join(sample, SETTINGS_FILE)
+        if not os.path.exists(path):
+            different.update(settings)
+            continue
+        with open(path) as f:
+            used = json.load(f)
+        different.update(key for key in settings if used.get(key) != settings[key])
+
+    if different:
+        raise ValueError(
+            "The existing annotation was created with a different CARD version or "
+            "settings and can't be merged with new results. "
+            f"Different: {', '.join(sorted(different, key=list(settings).index))}."
+        )
+
+
+def _check_existing_samples(
+    allele_annotation, gene_annotation, allele_table, gene_table
+):
+    # The existing annotations and feature tables have to come from the same run.
+    # Samples without any hits are not part of the feature tables
+    samples = set(
+        allele_annotation.view(CARDAlleleAnnotationDirectoryFormat).sample_dict()
+    )
+    gene_samples = set(
+        gene_annotation.view(CARDGeneAnnotationDirectoryFormat).sample_dict()
+    )
+    if samples != gene_samples:
+        raise ValueError(
+            "The existing allele and gene annotations contain different samples: "
+            f"{', '.join(sorted(samples ^ gene_samples))}."
+        )
+
+    for name, table in [("allele", allele_table), ("gene", gene_table)]:
+        unknown = set(table.view(biom.Table).ids(axis="sample")) - samples
+        if unknown:
+            raise ValueError(
+                f"The existing {name} feature table contains samples that are not "
+                f"part of the existing annotations: {', '.join(sorted(unknown))}."
+            )
+
+
+def _filter_new_samples(ctx, reads, existing_annotation):
+    # Returns the reads of all samples that are not in the existing annotation or
+    # None if there are none
+    fmt = (
+        SingleLanePerSampleSingleEndFastqDirFmt
+        if reads.type <= SampleData[SequencesWithQuality]
+        else SingleLanePerSamplePairedEndFastqDirFmt
+    )
+    samples = set(reads.view(fmt).manifest.view(pd.DataFrame).index)
+    existing_samples = set(
+        existing_annotation.view(CARDAlleleAnnotationDirectoryFormat).sample_dict()
+    )
+
+    if not samples - existing_samples:
+        return None
+    if not samples & existing_samples:
+        return reads
+
+    filter_samples = ctx.get_action("demux", "filter_samples")
+    metadata = qiime2.Metadata(
+        pd.DataFrame(index=pd.Index(sorted(existing_samples), name="id"))
+    )
+    (filtered_reads,) = filter_samples(reads, metadata=metadata, exclude_ids=True)
+    return filtered_reads
+
+
 def _annotate_reads_card(
     reads: Union[
         SingleLanePerSamplePairedEndFastqDirFmt, SingleLanePerSampleSingleEndFastqDirFmt
@@ -88,84 +247,75 @@ def _annotate_reads_card(
     threads: int = 1,
     include_wildcard: bool = False,
     include_other_models: bool = False,
+    parallel_samples: int = None,
+    card_index: CARDAlignerIndexDirectoryFormat = None,
 ) -> (
     CARDAlleleAnnotationDirectoryFormat,
     CARDGeneAnnotationDirectoryFormat,
-    pd.DataFrame,
-    pd.DataFrame,
+    biom.Table,
+    biom.Table,
 ):
     paired = isinstance(reads, SingleLanePerSamplePairedEndFastqDirFmt)
     manifest = reads.manifest.view(pd.DataFrame)
-    allele_frequency_list, gene_frequency_list = [], []
+    samples = list(manifest.index)
 
     amr_allele_annotation = CARDAlleleAnnotationDirectoryFormat()
     amr_gene_annotation = CARDGeneAnnotationDirectoryFormat()
 
-    with tempfile.TemporaryDirectory() as tmp:
-        # Load CARD database files
-        load_card_db(
-            card_db=card_db,
-            fasta=True,
+    # Pick the number of concurrently processed samples from the thread budget if it
+    # is not specified and split the threads between them
+    if parallel_samples is None:
+        parallel_samples = auto_parallel_jobs(
+            threads, len(samples), MAX_THREADS_PER_SAMPLE
+        )
+    parallel_samples, sample_threads = split_threads(threads, parallel_samples)
+
+    # A prebuilt aligner index has to match the CARD database and settings
+    if card_index is not None:
+        check_card_index(
+            card_index,
+            card_db,
+            aligner=aligner,
+            include_wildcard=include_wildcard,
             include_other_models=include_other_models,
+        )
+
+    # Load CARD database files, or the prebuilt index that already contains them
+    with tempfile.TemporaryDirectory() as tmp, load_card_db(
+        card_db=card_db,
+        fasta=True,
+        include_other_models=include_other_models,
+        include_wildcard=include_wildcard,
+        cwd=tmp,
+        card_index=card_index,
+    ):
+        annotate_sample = partial(
+            _annotate_sample,
+            tmp=tmp,
+            manifest=manifest,
+            paired=paired,
+            amr_allele_annotation=amr_allele_annotation,
+            amr_gene_annotation=amr_gene_annotation,
+            aligner=aligner,
+            threads=sample_threads,
             include_wildcard=include_wildcard,
+            include_other_models=include_other_models,
+            settings={
+                "card_version": card_version(str(card_db)),
+                "aligner": aligner,
+                "include_wildcard": include_wildcard,
+                "include_other_models": include_other_models,
+            },
         )
-        for samp in list(manifest.index):
-            # Set paths for forward and reverse reads files
-            fwd = manifest.loc[samp, "forward"]
-            rev = manifest.loc[samp, "reverse"] if paired else None
-
-            # Create sample directories in the output directories
-            samp_allele_dir = os.path.join(str(amr_allele_annotation), samp)
-            samp_gene_dir = os.path.join(str(amr_gene_annotation), samp)
-            os.makedirs(samp_allele_dir)
-            os.makedirs(samp_gene_dir)
-
-            # Create sample directory in the tmp directory
-            samp_tmp_dir = os.path.join(tmp, samp)
-            os.makedirs(samp_tmp_dir)
-
-            # Run annotation
-            run_rgi_bwt(
-                cwd=tmp,
-                samp=samp,
-                fwd=fwd,
-                rev=rev,
-                aligner=aligner,
-                threads=threads,
-                include_wildcard=include_wildcard,
-                include_other_models=include_other_models,
-            )
 
-            # Create a frequency table for gene and allele mapping data and add it to
-            # the frequency table lists
-            for map_type, table_list in zip(
-                ["allele", "gene"], [allele_frequency_list, gene_frequency_list]
-            ):
-                path_txt = os.path.join(
-                    samp_tmp_dir, f"output.{map_type}_mapping_data.txt"
-                )
-                frequency_table = read_in_txt(
-                    path=path_txt,
-                    samp_bin_name=samp,
-                    data_type="reads",
-                    map_type=map_type,
-                )
-                table_list.append(frequency_table)
-
-            # Move mapping and stats files to the sample allele and gene directories
-            for map_type, des_dir in zip(
-                ["allele", "gene"], [samp_allele_dir, samp_gene_dir]
-            ):
-                files = [f"{map_type}_mapping_data.txt"]
-                # mapping statistics only go to the allele directories
-                if map_type == "allele":
-                    files.extend(["overall_mapping_stats.txt", "sorted.length_100.bam"])
-
-                for file in files:
-                    shutil.copy(
-                        os.path.join(samp_tmp_dir, "output." + file),
-                        os.path.join(des_dir, file),
-                    )
+        # The first sample is annotated on its own so that RGI builds the aligner
+        # index only once, before the remaining samples are annotated concurrently
+        frequency_tables = [annotate_sample(samples[0])] if samples else []
+        with ThreadPoolExecutor(max_workers=parallel_samples) as executor:
+            frequency_tables.extend(executor.map(annotate_sample, samples[1:]))
+
+    allele_frequency_list = [tables[0] for tables in frequency_tables]
+    gene_frequency_list = [tables[1] for tables in frequency_tables]
 
     # Merge all frequency tables into one for alleles and genes separately
     allele_feature_table = create_count_table(allele_frequency_list)
@@ -178,6 +328,82 @@ def _annotate_reads_card(
     )
 
 
+def _annotate_sample(
+    samp,
+    tmp,
+    manifest,
+    paired,
+    amr_allele_annotation,
+    amr_gene_annotation,
+    aligner,
+    threads,
+    include_wildcard,
+    include_other_models,
+    settings,
+):
+    # Set paths for forward and reverse reads files
+    fwd = manifest.loc[samp, "forward"]
+    rev = manifest.loc[samp, "reverse"] if paired else None
+
+    # Create sample directories in the output directories
+    samp_allele_dir = os.path.join(str(amr_allele_annotation), samp)
+    samp_gene_dir = os.path.join(str(amr_gene_annotation), samp)
+    os.makedirs(samp_allele_dir)
+    os.makedirs(samp_gene_dir)
+
+    # Create sample directory in the tmp directory
+    samp_tmp_dir = os.path.join(tmp, samp)
+    os.makedirs(samp_tmp_dir)
+
+    # Run annotation
+    run_rgi_bwt(
+        cwd=tmp,
+        samp=samp,
+        fwd=fwd,
+        rev=rev,
+        aligner=aligner,
+        threads=threads,
+        include_wildcard=include_wildcard,
+        include_other_models=include_other_models,
+    )
+
+    # Create a frequency table for allele and gene mapping data
+    frequency_tables = []
+    for map_type in ["allele", "gene"]:
+        path_txt = os.path.join(samp_tmp_dir, f"output.{map_type}_mapping_data.txt")
+        frequency_tables.append(
+            read_in_txt(
+                path=path_txt,
+                samp_bin_name=samp,
+                data_type="reads",
+                map_type=map_type,
+            )
+        )
+
+    # Move mapping and stats files to the sample allele and gene directories
+    for map_type, des_dir in zip(["allele", "gene"], [samp_allele_dir, samp_gene_dir]):
+        files = [f"{map_type}_mapping_data.txt"]
+        # mapping statistics only go to the allele directories
+        if map_type == "allele":
+            files.extend(["overall_mapping_stats.txt", "sorted.length_100.bam"])
+
+        for file in files:
+            shutil.move(
+                os.path.join(samp_tmp_dir, "output." + file),
+                os.path.join(des_dir, file),
+            )
+
+        # Record the settings, so that samples can be added to the annotation later
+        with open(os.path.join(des_dir, SETTINGS_FILE), "w") as f:
+            json.dump(settings, f)
+
+    # Remove the remaining RGI output of the sample right away, so that scratch space
+    # is only used by the samples that are being annotated
+    shutil.rmtree(samp_tmp_dir)
+
+    return tuple(frequency_tables)
+
+
 def run_rgi_bwt(
     cwd: str,
     samp: str,
@@ -200,6 +426,7 @@ def run_rgi_bwt(
         "--clean",
         "--aligner",
         aligner,
+        "--local",
     ]
     if rev:
         cmd.extend(["--read_two", rev])
@@ -0,0 +1,133 @@
+import os
+from unittest.mock import MagicMock, patch
+
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_rgi.card.cache import DirectoryCache, hash_key
+
+
+class TestDirectoryCache(TestPluginBase):
+    package = "q2_rgi.card.tests"
+
+    def setUp(self):
+        super().setUp()
+        self.root = os.path.join(self.temp_dir.name, "cache")
+
+    @staticmethod
+    def create_entry(size):
+        def create(path):
+            with open(os.path.join(path, "data"), "wb") as f:
+                f.write(b"0" * size)
+
+        return create
+
+    def test_use_creates_entry_once(self):
+        cache = DirectoryCache(self.root, max_size=100)
+        create = MagicMock(side_effect=self.create_entry(10))
+
+        with cache.use("key", create) as path_1:
+            self.assertTrue(os.path.exists(os.path.join(path_1, "data")))
+        with cache.use("key", create) as path_2:
+            pass
+
+        create.assert_called_once()
+        self.assertEqual(path_1, path_2)
+
+    def test_failed_create_leaves_no_entry(self):
+        cache = DirectoryCache(self.root, max_size=100)
+
+        with self.assertRaises(ValueError):
+            with cache.use("key", MagicMock(side_effect=ValueError)):
+                pass
+
+        self.assertEqual(
+            [f for f in os.listdir(self.root) if not f.endswith(".lock")], []
+        )
+
+    def test_evicts_least_recently_used(self):
+        cache = DirectoryCache(self.root, max_size=25)
+
+        for key in ["a", "b"]:
+            with cache.use(key, self.create_entry(10)):
+                pass
+
+        # Use "a" again so that "b" becomes the least recently used entry
+        os.utime(os.path.join(self.root, "b"), (0, 0))
+        with cache.use("a", self.create_entry(10)):
+            pass
+
+        with cache.use("c", self.create_entry(10)):
+            pass
+
+        self.assertTrue(os.path.isdir(os.path.join(self.root, "a")))
+        self.assertFalse(os.path.isdir(os.path.join(self.root, "b")))
+        self.assertTrue(os.path.isdir(os.path.join(self.root, "c")))
+
+    def test_entries_in_use_are_not_evicted(self):
+        cache = DirectoryCache(self.root, max_size=15)
+
+        with cache.use("a", self.create_entry(10)):
+            with cache.use("b", self.create_entry(10)):
+                pass
+
+            self.assertTrue(os.path.isdir(os.path.join(self.root, "a")))
+            self.assertTrue(os.path.isdir(os.path.join(self.root, "b")))
+
+    def test_keeps_running_total_size(self):
+        cache = DirectoryCache(self.root, max_size=100)
+
+        with patch("q2_rgi.card.cache._directory_size", return_value=10) as size:
+            for key in ["a", "b"]:
+                with cache.use(key, self.create_entry(10)):
+                    pass
+
+        # Only the new entries are measured, existing entries aren't walked again
+        self.assertEqual(size.call_count, 2)
+        with open(os.path.join(self.root, ".size")) as f:
+            self.assertEqual(f.read(), "20")
+
+    def test_entry_created_concurrently_is_kept(self):
+        cache = DirectoryCache(self.root, max_size=100)
+
+        # Another process moves the same entry into place while this one creates it
+        def create(path):
+            os.makedirs(os.path.join(self.root, "key"))
+            with open(os.path.join(self.root, "key", "data"), "w") as f:
+                f.write("other")
+            with open(os.path.join(path, "data"), "w") as f:
+                f.write("this")
+
+        with cache.use("key", create) as path:
+            with open(os.path.join(path, "data")) as f:
+                self.assertEqual(f.read(), "other")
+
+        self.assertFalse(any(f.startswith(".staging-") for f in os.listdir(self.root)))
+
+    def test_from_env(self):
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertIsNone(DirectoryCache.from_env("load"))
+
+        env = {"Q2_RGI_CACHE_DIR": self.root, "Q2_RGI_CACHE_SIZE": "2"}
+        with patch.dict(os.environ, env):
+            cache = DirectoryCache.from_env("load")
+
+        self.assertEqual(cache.root, os.path.join(self.root, "load"))
+        self.assertEqual(cache.max_size, 2 * 1024**3)
+
+    def test_hash_key(self):
+        path_1 = os.path.join(self.temp_dir.name, "file_1")
+        path_2 = os.path.join(self.temp_dir.name, "file_2")
+        for path in [path_1, path_2]:
+            with open(path, "w") as f:
+                f.write("content")
+
+        # Files with the same content at different paths produce the same key
+        self.assertEqual(
+            hash_key(["--flag"], files=[path_1]), hash_key(["--flag"], files=[path_2])
+        )
+        self.assertNotEqual(
+            hash_key(["--flag"], files=[path_1]), hash_key(["--other"], files=[path_1])
+        )
+
+        # Values are hashed as strings even if they are paths to existing files
+        self.assertNotEqual(hash_key([path_1]), hash_key([path_2]))
@@ -1,19 +1,48 @@
+import gzip
+import json
 import os
 import shutil
 import subprocess
 import tarfile
-from unittest.mock import MagicMock, patch
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import ANY, MagicMock, patch
 
 import requests
 from qiime2.plugin.testing import TestPluginBase
 
-from q2_rgi.card.database import download_with_progress_bar, fetch_card_db, preprocess
+from q2_rgi.card.database import (
+    CARD_URL,
+    WILDCARD_URL,
+    check_card_index,
+    download_with_progress_bar,
+    extract_members,
+    fetch_card_db,
+    gunzip,
+    partial_download_path,
+    preprocess,
+)
 from q2_rgi.types import CARDDatabaseDirectoryFormat, CARDKmerDatabaseDirectoryFormat
 
 
 class TestAnnotateMagsCard(TestPluginBase):
     package = "q2_rgi.card.tests"
 
+    def setUp(self):
+        super().setUp()
+        RangeRequestHandler.drop_after = None
+        RangeRequestHandler.received = []
+
+        # Serve test downloads from a local HTTP server
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/data"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
     def mock_preprocess(self, dir, operation):
         if operation == "card":
             src_des = [
@@ -30,18 +59,20 @@ class TestAnnotateMagsCard(TestPluginBase):
                 self.get_data_path(file_name_src), os.path.join(dir, file_name_des)
             )
 
-    def test_fetch_card_db(self):
-        # Open dummy archives for CARD and WildCARD download
-        card_tar = self.get_data_path("card.tar.bz2")
-        wildcard_tar = self.get_data_path("wildcard_data.tar.bz2")
+    def mock_download(self, url, description, tar_path, position):
+        # Copy dummy archives for CARD and WildCARD download
+        if url.endswith("data"):
+            shutil.copy(self.get_data_path("card.tar.bz2"), tar_path)
+        else:
+            shutil.copy(self.get_data_path("wildcard_data.tar.bz2"), tar_path)
+        return '"v1"'
 
-        # Patch requests.get,
-        with patch("q2_rgi.card.database.download_with_progress_bar"), patch(
-            "q2_rgi.card.database.preprocess", side_effect=self.mock_preprocess
-        ), patch(
-            "tarfile.open",
-            side_effect=[tarfile.open(card_tar), tarfile.open(wildcard_tar)],
-        ):
+    def test_fetch_card_db(self):
+        # Patch download_with_progress_bar and preprocess
+        with patch(
+            "q2_rgi.card.database.download_with_progress_bar",
+            side_effect=self.mock_download,
+        ), patch("q2_rgi.card.database.preprocess", side_effect=self.mock_preprocess):
             obs = fetch_card_db()
 
         # Lists of filenames contained in CARD and Kmer database objects
@@ -73,6 +104,102 @@ class TestAnnotateMagsCard(TestPluginBase):
         self.assertIsInstance(obs[1], CARDKmerDatabaseDirectoryFormat)
         self.assertIsInstance(obs[2], CARDKmerDatabaseDirectoryFormat)
 
+        # Assert if the versions of the downloaded archives were saved
+        with open(os.path.join(str(obs[0]), "fetch_metadata.json")) as f:
+            metadata = json.load(f)
+        self.assertEqual(metadata[CARD_URL], '"v1"')
+        self.assertEqual(metadata[WILDCARD_URL], '"v1"')
+
+        # Assert if the sizes of the k-mer database files were saved
+        for db_obj in obs[1:]:
+            for file in os.listdir(str(db_obj)):
+                size = os.path.getsize(os.path.join(str(db_obj), file))
+                self.assertEqual(metadata[file], str(size))
+
+    def fetch_previous_card_db(self):
+        with patch(
+            "q2_rgi.card.database.download_with_progress_bar",
+            side_effect=self.mock_download,
+        ), patch("q2_rgi.card.database.preprocess", side_effect=self.mock_preprocess):
+            return fetch_card_db()
+
+    def test_fetch_card_db_unchanged(self):
+        previous = self.fetch_previous_card_db()
+
+        # Nothing is downloaded or preprocessed if the archives didn't change
+        with patch("q2_rgi.card.database.requests.head") as mock_head, patch(
+            "q2_rgi.card.database.download_with_progress_bar"
+        ) as mock_download, patch("q2_rgi.card.database.preprocess") as mock_preprocess:
+            mock_head.return_value.headers = {"etag": '"v1"'}
+            obs = fetch_card_db(*previous)
+
+        mock_download.assert_not_called()
+        mock_preprocess.assert_not_called()
+        for db_obs, db_previous in zip(obs, previous):
+            self.assertEqual(
+                sorted(os.listdir(str(db_obs))), sorted(os.listdir(str(db_previous)))
+            )
+
+    def test_fetch_card_db_same_card_version(self):
+        previous = self.fetch_previous_card_db()
+
+        # The CARD archive changed on the server, but card.json has the same version
+        with patch("q2_rgi.card.database.requests.head") as mock_head, patch(
+            "q2_rgi.card.database.download_with_progress_bar",
+            side_effect=self.mock_download,
+        ) as mock_download, patch(
+            "q2_rgi.card.database.preprocess", side_effect=self.mock_preprocess
+        ) as mock_preprocess:
+            mock_head.return_value.headers = {"etag": '"v2"'}
+            fetch_card_db(previous_card_db=previous[0])
+
+        # Both archives are downloaded because the previous k-mer databases are
+        # missing, but only WildCARD has to be preprocessed
+        self.assertEqual(mock_download.call_count, 2)
+        mock_preprocess.assert_called_once_with(dir=ANY, operation="wildcard")
+
+    def test_fetch_card_db_wildcard_changed(self):
+        previous = self.fetch_previous_card_db()
+
+        def mock_head(url, **kwargs):
+            response = MagicMock()
+            response.headers = {"etag": '"v2"' if url == WILDCARD_URL else '"v1"'}
+            return response
+
+        with patch("q2_rgi.card.database.requests.head", side_effect=mock_head), patch(
+            "q2_rgi.card.database.download_with_progress_bar",
+            side_effect=self.mock_download,
+        ) as mock_download, patch(
+            "q2_rgi.card.database.preprocess", side_effect=self.mock_preprocess
+        ) as mock_preprocess:
+            fetch_card_db(*previous)
+
+        # Only WildCARD is downloaded and preprocessed again
+        mock_download.assert_called_once()
+        self.assertEqual(mock_download.call_args.kwargs["url"], WILDCARD_URL)
+        mock_preprocess.assert_called_once_with(dir=ANY, operation="wildcard")
+
+    def test_fetch_card_db_kmer_db_mismatch(self):
+        previous = self.fetch_previous_card_db()
+
+        # The 61-mer database was fetched together with a different CARD database
+        with open(os.path.join(str(previous[1]), "61_kmer_db.json"), "a") as f:
+            f.write("\n")
+
+        with patch("q2_rgi.card.database.requests.head") as mock_head, patch(
+            "q2_rgi.card.database.download_with_progress_bar",
+            side_effect=self.mock_download,
+        ) as mock_download, patch(
+            "q2_rgi.card.database.preprocess", side_effect=self.mock_preprocess
+        ) as mock_preprocess:
+            mock_head.return_value.headers = {"etag": '"v1"'}
+            fetch_card_db(*previous)
+
+        # WildCARD is fetched again instead of reusing mismatched k-mer databases
+        mock_download.assert_called_once()
+        self.assertEqual(mock_download.call_args.kwargs["url"], WILDCARD_URL)
+        mock_preprocess.assert_called_once_with(dir=ANY, operation="wildcard")
+
     def test_connection_error(self):
         # Simulate a ConnectionError during requests.get
         with patch(
@@ -91,6 +218,49 @@ class TestAnnotateMagsCard(TestPluginBase):
         ), self.assertRaisesRegex(tarfile.ReadError, "Tarfile is invalid."):
             fetch_card_db()
 
+    def test_extract_members(self):
+        # Only requested files are extracted, "._" files of macOS are skipped
+        obs = list(
+            extract_members(
+                self.get_data_path("wildcard_data.tar.bz2"),
+                (
+                    "61_kmer_db.json.gz",
+                    "nucleotide_fasta_protein_homolog_model_variants.fasta.gz",
+                ),
+                self.temp_dir.name,
+            )
+        )
+
+        self.assertEqual(
+            sorted(os.listdir(self.temp_dir.name)),
+            [
+                "61_kmer_db.json.gz",
+                "nucleotide_fasta_protein_homolog_model_variants.fasta.gz",
+            ],
+        )
+        self.assertEqual(len(obs), 2)
+
+    def test_extract_members_missing(self):
+        with self.assertRaisesRegex(tarfile.ReadError, "missing.json"):
+            list(
+                extract_members(
+                    self.get_data_path("card.tar.bz2"),
+                    ("card.json", "missing.json"),
+                    self.temp_dir.name,
+                )
+            )
+
+    def test_gunzip(self):
+        src = os.path.join(self.temp_dir.name, "file.txt.gz")
+        dst = os.path.join(self.temp_dir.name, "file.txt")
+        with gzip.open(src, "wb") as f:
+            f.write(b"content" * 1000)
+
+        gunzip(src, dst)
+
+        with open(dst, "rb") as f:
+            self.assertEqual(f.read(), b"content" * 1000)
+
     def test_subprocess_error(self):
         # Simulate a subprocess.CalledProcessError during run_command
         with patch(
@@ -135,31 +305,143 @@ class TestAnnotateMagsCard(TestPluginBase):
             )
 
     def test_download_with_progressbar(self):
-        url = "http://example.com"
-        progressbar_desc = "Downloading"
-        tar_path = "/path/to/downloaded/file.tar"
-
-        with patch("requests.get") as mock_get, patch(
-            "q2_rgi.card.database.tqdm"
-        ) as mock_tqdm, patch("builtins.open") as mock_open:
-            # Mock response object
-            response_mock = MagicMock()
-            response_mock.headers = {"content-length": "1024"}
-            response_mock.iter_content.return_value = [b"data"]
-
-            # Patch the requests.get to return our response_mock
-            mock_get.return_value = response_mock
-
-            # Mock the open function to avoid creating files
-            mock_open.return_value.__enter__.return_value = MagicMock()
-
-            # Call the function
-            download_with_progress_bar(url, progressbar_desc, tar_path)
-
-            # Assertions
-            mock_get.assert_called_once_with(url=url, stream=True)
-            mock_tqdm.assert_called_once_with(
-                total=1024, unit="B", unit_scale=True, desc=progressbar_desc
+        tar_path = os.path.join(self.temp_dir.name, "file.tar")
+
+        with patch.dict(os.environ, {}, clear=True):
+            download_with_progress_bar(self.url, "Downloading", tar_path, chunk_size=7)
+
+        with open(tar_path, "rb") as f:
+            self.assertEqual(f.read(), RangeRequestHandler.content)
+        self.assertFalse(os.path.exists(f"{tar_path}.part"))
+        self.assertNotIn("Range", RangeRequestHandler.received[0])
+
+    def test_check_card_index(self):
+        card_db = CARDDatabaseDirectoryFormat()
+        shutil.copy(
+            self.get_data_path("card_test.json"),
+            os.path.join(str(card_db), "card.json"),
+        )
+        card_index = self.temp_dir.name
+        with open(os.path.join(card_index, "index_metadata.json"), "w") as f:
+            json.dump(
+                {
+                    "card_version": "3.2.5",
+                    "aligner": "kma",
+                    "include_wildcard": False,
+                    "include_other_models": False,
+                },
+                f,
             )
-            mock_open.assert_called_once_with(tar_path, "wb")
-            response_mock.iter_content.assert_called_once_with(chunk_size=8192)
+
+        check_card_index(card_index, card_db, aligner="kma", include_wildcard=False)
+        with self.assertRaisesRegex(ValueError, "Different: aligner, include_wildcard"):
+            check_card_index(card_index, card_db, aligner="bwa", include_wildcard=True)
+
+        with open(os.path.join(str(card_db), "card.json"), "w") as f:
+            json.dump({"_version": "3.2.9"}, f)
+        with self.assertRaisesRegex(ValueError, "Different: card_version"):
+            check_card_index(card_index, card_db, aligner="kma")
+
+    def test_download_resumes_partial_file(self):
+        tar_path = os.path.join(self.temp_dir.name, "file.tar")
+        env = {"Q2_RGI_CACHE_DIR": os.path.join(self.temp_dir.name, "cache")}
+
+        # Create a partial file in the cache from an earlier download
+        with patch.dict(os.environ, env):
+            part_path = partial_download_path(self.url, tar_path)
+            with open(part_path, "wb") as f:
+                f.write(RangeRequestHandler.content[:100])
+            with open(f"{part_path}.validator", "w") as f:
+                f.write(RangeRequestHandler.etag)
+
+            download_with_progress_bar(self.url, "Downloading", tar_path)
+
+        with open(tar_path, "rb") as f:
+            self.assertEqual(f.read(), RangeRequestHandler.content)
+        self.assertFalse(os.path.exists(part_path))
+        self.assertEqual(RangeRequestHandler.received[0]["Range"], "bytes=100-")
+
+    def test_download_restarts_changed_file(self):
+        tar_path = os.path.join(self.temp_dir.name, "file.tar")
+
+        # Partial file of an older version of the file on the server
+        with open(f"{tar_path}.part", "wb") as f:
+            f.write(b"x" * 100)
+        with open(f"{tar_path}.part.validator", "w") as f:
+            f.write('"old"')
+
+        with patch.dict(os.environ, {}, clear=True):
+            download_with_progress_bar(self.url, "Downloading", tar_path)
+
+        with open(tar_path, "rb") as f:
+            self.assertEqual(f.read(), RangeRequestHandler.content)
+
+    def test_download_resumes_dropped_connection(self):
+        tar_path = os.path.join(self.temp_dir.name, "file.tar")
+        RangeRequestHandler.drop_after = 300
+
+        with patch.dict(os.environ, {}, clear=True), patch(
+            "q2_rgi.card.database.time.sleep"
+        ) as mock_sleep:
+            download_with_progress_bar(
+                self.url, "Downloading", tar_path, chunk_size=100
+            )
+
+        with open(tar_path, "rb") as f:
+            self.assertEqual(f.read(), RangeRequestHandler.content)
+        mock_sleep.assert_called_once_with(1)
+        self.assertEqual(len(RangeRequestHandler.received), 2)
+        self.assertEqual(RangeRequestHandler.received[1]["Range"], "bytes=300-")
+
+    def test_download_restarts_without_validator(self):
+        tar_path = os.path.join(self.temp_dir.name, "file.tar")
+
+        # Partial file from a server that sent neither ETag nor Last-Modified
+        with open(f"{tar_path}.part", "wb") as f:
+            f.write(b"x" * 100)
+        with open(f"{tar_path}.part.validator", "w") as f:
+            f.write("")
+
+        with patch.dict(os.environ, {}, clear=True):
+            download_with_progress_bar(self.url, "Downloading", tar_path)
+
+        with open(tar_path, "rb") as f:
+            self.assertEqual(f.read(), RangeRequestHandler.content)
+        self.assertNotIn("Range", RangeRequestHandler.received[0])
+        self.assertNotIn("If-Range", RangeRequestHandler.received[0])
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    # Local stand-in for the CARD server that supports range requests
+    content = bytes(range(256)) * 4
+    etag = '"v1"'
+    drop_after = None
+    received = []
+
+    def do_GET(self):
+        type(self).received.append(dict(self.headers))
+
+        start = 0
+        if self.headers.get("If-Range") == self.etag and "Range" in self.headers:
+            start = int(self.headers["Range"][len("bytes=") : -1])
+            self.send_response(206)
+            self.send_header(
+                "Content-Range",
+                f"bytes {start}-{len(self.content) - 1}/{len(self.content)}",
+            )
+        else:
+            self.send_response(200)
+
+        body = self.content[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", self.etag)
+        self.end_headers()
+
+        # Drop the connection once after sending part of the body
+        if self.drop_after is not None:
+            body = body[: self.drop_after]
+            type(self).drop_after = None
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
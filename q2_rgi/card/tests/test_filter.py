@@ -0,0 +1,159 @@
+import json
+import os
+
+import pandas as pd
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_rgi.card.filter import (
+    _rethreshold,
+    _rethreshold_hsps,
+    filter_mags_annotations,
+)
+from q2_rgi.types import CARDAnnotationDirectoryFormat
+
+
+class TestFilterMagsAnnotations(TestPluginBase):
+    package = "q2_rgi.card.tests"
+
+    def create_annotations(self):
+        # Adds a loose hit and a loose hit that can be nudged to the RGI output of
+        # every bin
+        table = pd.read_csv(
+            self.get_data_path("rgi_output.txt"), sep="\t", dtype=str, na_filter=False
+        )
+        with open(self.get_data_path("rgi_output.json")) as f:
+            results = json.load(f)
+        hsp = next(iter(results.values()))["gnl|BL_ORD_ID|1173|hsp_num:0"]
+
+        rows = []
+        for orf, identity, aro in [
+            ("loose_orf", "50.0", "ARO1"),
+            ("nudge_orf", "96.0", "ARO2"),
+        ]:
+            row = table.iloc[[0]].copy()
+            row[["ORF_ID", "Cut_Off", "Best_Identities", "Best_Hit_ARO"]] = [
+                orf,
+                "Loose",
+                identity,
+                aro,
+            ]
+            rows.append(row)
+            results[orf] = {
+                "gnl|BL_ORD_ID|1|hsp_num:0": {
+                    **hsp,
+                    "type_match": "Loose",
+                    "perc_identity": float(identity),
+                }
+            }
+        table = pd.concat([table] + rows)
+
+        annotations = CARDAnnotationDirectoryFormat()
+        for samp_bin in ["sample1/bin1", "sample2/bin1"]:
+            bin_dir = os.path.join(str(annotations), samp_bin)
+            os.makedirs(bin_dir)
+            table.to_csv(
+                os.path.join(bin_dir, "amr_annotation.txt"), sep="\t", index=False
+            )
+            with open(os.path.join(bin_dir, "amr_annotation.json"), "w") as f:
+                json.dump(results, f)
+        return annotations
+
+    def read_bin(self, annotations, samp_bin):
+        bin_dir = os.path.join(str(annotations), samp_bin)
+        table = pd.read_csv(
+            os.path.join(bin_dir, "amr_annotation.txt"),
+            sep="\t",
+            dtype=str,
+            na_filter=False,
+        )
+        with open(os.path.join(bin_dir, "amr_annotation.json")) as f:
+            return table, json.load(f)
+
+    def test_filter_mags_annotations(self):
+        annotations = self.create_annotations()
+
+        filtered, feature_table = filter_mags_annotations(annotations)
+
+        table, results = self.read_bin(filtered, "sample1/bin1")
+        self.assertListEqual(list(table["Cut_Off"]), ["Perfect", "Strict"])
+        self.assertEqual(set(results), set(table["ORF_ID"]))
+        self.assertEqual(feature_table.shape, (2, 2))
+
+    def test_filter_mags_annotations_loose_nudge(self):
+        annotations = self.create_annotations()
+
+        filtered, feature_table = filter_mags_annotations(
+            annotations, include_nudge=True, min_identity=90
+        )
+
+        table, results = self.read_bin(filtered, "sample2/bin1")
+        self.assertListEqual(list(table["ORF_ID"])[2:], ["nudge_orf"])
+        self.assertListEqual(list(table["Cut_Off"]), ["Perfect", "Strict", "Strict"])
+        self.assertEqual(table["Nudged"].iloc[2], "True")
+        hsp = results["nudge_orf"]["gnl|BL_ORD_ID|1|hsp_num:0"]
+        self.assertEqual(hsp["type_match"], "Strict")
+        self.assertTrue(hsp["nudged"])
+        self.assertIn("ARO2", feature_table.ids(axis="observation"))
+
+    def test_filter_mags_annotations_quotes(self):
+        annotations = self.create_annotations()
+
+        # Quote characters in values are written back unchanged
+        path = os.path.join(str(annotations), "sample1/bin1", "amr_annotation.txt")
+        with open(path) as f:
+            lines = f.read().replace("AAC(2')-Ic", '"AAC(2\')-Ic" variant')
+        with open(path, "w") as f:
+            f.write(lines)
+
+        filtered, _ = filter_mags_annotations(annotations)
+
+        path = os.path.join(str(filtered), "sample1/bin1", "amr_annotation.txt")
+        with open(path) as f:
+            self.assertIn('\t"AAC(2\')-Ic" variant\t', f.read())
+
+    def test_filter_mags_annotations_none_left(self):
+        annotations = self.create_annotations()
+        with self.assertRaisesRegex(ValueError, "None of the annotations"):
+            filter_mags_annotations(annotations, min_coverage=101)
+
+    def test_rethreshold_revert_nudge(self):
+        annotations = pd.DataFrame(
+            {
+                "Cut_Off": ["Strict", "Strict", "Loose"],
+                "Nudged": ["", "True", ""],
+                "Model_type": ["protein homolog model"] * 3,
+                "Best_Identities": ["99.0", "97.0", "40.0"],
+                "Percentage Length of Reference Sequence": ["100.0", "n/a", "80.0"],
+            }
+        )
+
+        # Nudged hits are loose hits without include_nudge, rows without coverage
+        # are kept
+        obs = _rethreshold(annotations, True, False, 0, 90)
+        self.assertListEqual(list(obs["Cut_Off"]), ["Strict", "Loose"])
+        self.assertListEqual(list(obs["Nudged"]), ["", ""])
+
+        obs = _rethreshold(annotations, False, False, 0, 0)
+        self.assertListEqual(list(obs.index), [0])
+
+    def test_rethreshold_hsps(self):
+        hsps = {
+            "low_identity": {"type_match": "Strict", "perc_identity": 50.0},
+            "low_coverage": {
+                "type_match": "Strict",
+                "perc_identity": 99.0,
+                "orf_prot_sequence": "MK",
+                "sequence_from_broadstreet": "MKLV",
+            },
+            "kept": {
+                "type_match": "Strict",
+                "perc_identity": 99.0,
+                "orf_prot_sequence": "MKLV",
+                "sequence_from_broadstreet": "MKLV",
+            },
+            "no_values": {"type_match": "Strict"},
+        }
+
+        # Hits without identity or sequences are kept
+        obs = _rethreshold_hsps(hsps, False, False, 90, 60)
+        self.assertListEqual(list(obs), ["kept", "no_values"])
@@ -0,0 +1,89 @@
+import json
+import os
+import shutil
+from contextlib import nullcontext
+from unittest.mock import patch
+
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_rgi.card.index import build_card_index
+from q2_rgi.types import CARDAlignerIndexDirectoryFormat, CARDDatabaseDirectoryFormat
+
+
+class TestBuildCardIndex(TestPluginBase):
+    package = "q2_rgi.card.tests"
+
+    def setUp(self):
+        super().setUp()
+        self.card_db = CARDDatabaseDirectoryFormat()
+        shutil.copy(
+            self.get_data_path("card_test.json"),
+            os.path.join(str(self.card_db), "card.json"),
+        )
+        with open(
+            os.path.join(
+                str(self.card_db),
+                "nucleotide_fasta_protein_homolog_model_variants.fasta",
+            ),
+            "w",
+        ) as f:
+            f.write(">gene1 description\nACGT\nACGT\n>gene2\nTTTT\n")
+
+    def mock_load_card_db(self, card_db, cwd, **kwargs):
+        os.makedirs(os.path.join(cwd, "localDB"))
+        with open(os.path.join(cwd, "localDB", "card.json"), "w") as f:
+            f.write("{}")
+        return nullcontext()
+
+    def mock_run_rgi_bwt(self, cwd, samp, fwd, **kwargs):
+        # RGI builds the index into the local database on its first run
+        with open(fwd) as f:
+            self.query = f.read()
+        os.makedirs(os.path.join(cwd, "localDB", "kma"))
+        with open(os.path.join(cwd, "localDB", "kma", "index.name"), "w") as f:
+            f.write("index")
+
+    def test_build_card_index(self):
+        with patch(
+            "q2_rgi.card.index.load_card_db", side_effect=self.mock_load_card_db
+        ), patch(
+            "q2_rgi.card.index.run_rgi_bwt", side_effect=self.mock_run_rgi_bwt
+        ) as mock_run_rgi_bwt:
+            card_index = build_card_index(self.card_db, include_wildcard=True)
+
+        self.assertIsInstance(card_index, CARDAlignerIndexDirectoryFormat)
+        card_index.validate()
+        self.assertEqual(self.query, "@gene1\nACGTACGT\n+\nIIIIIIII\n")
+        self.assertEqual(mock_run_rgi_bwt.call_args.kwargs["aligner"], "kma")
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(str(card_index), "localDB", "kma", "index.name")
+            )
+        )
+        with open(os.path.join(str(card_index), "index_metadata.json")) as f:
+            self.assertEqual(
+                json.load(f),
+                {
+                    "card_version": "3.2.5",
+                    "aligner": "kma",
+                    "include_wildcard": True,
+                    "include_other_models": False,
+                },
+            )
+
+    def test_build_card_index_mags(self):
+        with patch(
+            "q2_rgi.card.index.load_card_db", side_effect=self.mock_load_card_db
+        ) as mock_load_card_db, patch(
+            "q2_rgi.card.index.run_rgi_main"
+        ) as mock_run_rgi_main:
+            build_card_index(self.card_db, aligner="DIAMOND", threads=4)
+
+        # rgi main only uses card.json
+        self.assertFalse(mock_load_card_db.call_args.kwargs["fasta"])
+        self.assertEqual(mock_run_rgi_main.call_args.args[2], "DIAMOND")
+        self.assertEqual(mock_run_rgi_main.call_args.kwargs["num_threads"], 4)
+
+    def test_build_card_index_mags_wildcard(self):
+        with self.assertRaisesRegex(ValueError, "kma, bowtie2 and bwa"):
+            build_card_index(self.card_db, aligner="BLAST", include_wildcard=True)
@@ -85,7 +85,9 @@ class TestKmer(TestPluginBase):
         # Patch _run_rgi_kmer_query and load_card_db functions
         with pytest.warns(UserWarning, match=warning), patch(
             "q2_rgi.card.kmer._run_rgi_kmer_query", side_effect=mock_run_rgi_kmer_query
-        ), patch("q2_rgi.card.kmer.load_card_db", return_value="61"):
+        ), patch("q2_rgi.card.kmer.load_card_db") as mock_load_card_db:
+            mock_load_card_db.return_value.__enter__.return_value = "61"
+
             # Run _kmer_query_reads or _kmer_query_mags
             result = query_function(card_db, kmer_db, amr_annotations)
 
@@ -159,6 +161,7 @@ class TestKmer(TestPluginBase):
                     "4",
                     "--output",
                     "output",
+                    "--local",
                 ],
                 "path_tmp",
                 verbose=True,
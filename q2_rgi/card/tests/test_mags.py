@@ -1,11 +1,14 @@
+import json
 import os
 import shutil
+import stat
 import subprocess
 from unittest.mock import MagicMock, patch
 
 from q2_types.per_sample_sequences import MultiMAGSequencesDirFmt
 from qiime2.plugin.testing import TestPluginBase
 
+from q2_rgi.card.cache import CACHE_DIR_ENV
 from q2_rgi.card.mags import annotate_mags_card, run_rgi_main
 from q2_rgi.types import CARDAnnotationDirectoryFormat, CARDDatabaseDirectoryFormat
 
@@ -61,6 +64,144 @@ class TestAnnotateMagsCard(TestPluginBase):
                 )
             )
 
+    def test_annotate_mags_card_parallel_bins(self):
+        manifest = self.get_data_path("MANIFEST_mags")
+        mag = MultiMAGSequencesDirFmt()
+        card_db = CARDDatabaseDirectoryFormat()
+        shutil.copy(manifest, os.path.join(str(mag), "MANIFEST"))
+
+        mock_run_rgi_main = MagicMock(side_effect=self.mock_run_rgi_main)
+        with patch("q2_rgi.card.mags.run_rgi_main", mock_run_rgi_main), patch(
+            "q2_rgi.card.mags.load_card_db"
+        ), patch("q2_rgi.card.mags.read_in_txt"), patch(
+            "q2_rgi.card.mags.create_count_table"
+        ):
+            result = annotate_mags_card(mag, card_db, threads=4, parallel_bins=2)
+
+        # Every bin runs in its own scratch directory with half of the threads
+        tmp_dirs = {c.args[0] for c in mock_run_rgi_main.call_args_list}
+        self.assertEqual(len(tmp_dirs), 3)
+        for c in mock_run_rgi_main.call_args_list:
+            self.assertEqual(c.args[-1], 2)
+
+        for samp_bin in ["sample1/bin1", "sample2/bin1", "sample2/bin2"]:
+            for file in ["amr_annotation.txt", "amr_annotation.json"]:
+                self.assertTrue(
+                    os.path.exists(os.path.join(str(result[0]), samp_bin, file))
+                )
+
+    def test_annotate_mags_card_result_cache(self):
+        manifest = self.get_data_path("MANIFEST_mags")
+        mag = MultiMAGSequencesDirFmt()
+        card_db = CARDDatabaseDirectoryFormat()
+        shutil.copy(manifest, os.path.join(str(mag), "MANIFEST"))
+        for i, samp_bin in enumerate(["sample1/bin1", "sample2/bin1", "sample2/bin2"]):
+            os.makedirs(
+                os.path.join(str(mag), os.path.dirname(samp_bin)), exist_ok=True
+            )
+            with open(os.path.join(str(mag), f"{samp_bin}.fasta"), "w") as f:
+                f.write(f">contig{i}\nACGT\n")
+        with open(os.path.join(str(card_db), "card.json"), "w") as f:
+            json.dump({"_version": "3.2.9"}, f)
+
+        mock_run_rgi_main = MagicMock(side_effect=self.mock_run_rgi_main)
+        with patch("q2_rgi.card.mags.run_rgi_main", mock_run_rgi_main), patch(
+            "q2_rgi.card.mags.load_card_db"
+        ), patch("q2_rgi.card.mags.read_in_txt"), patch(
+            "q2_rgi.card.mags.create_count_table"
+        ), patch(
+            "q2_rgi.card.mags.rgi_version", return_value="6.0.3"
+        ) as mock_rgi_version, patch.dict(
+            os.environ, {CACHE_DIR_ENV: os.path.join(self.temp_dir.name, "cache")}
+        ):
+            annotate_mags_card(mag, card_db)
+            result = annotate_mags_card(mag, card_db)
+
+            # RGI only runs for the first annotation, the second one is taken from
+            # the cache
+            self.assertEqual(mock_run_rgi_main.call_count, 3)
+
+            # A different setting is a cache miss
+            annotate_mags_card(mag, card_db, include_loose=True)
+            self.assertEqual(mock_run_rgi_main.call_count, 6)
+
+            # A different RGI version is a cache miss
+            mock_rgi_version.return_value = "6.0.4"
+            annotate_mags_card(mag, card_db)
+            self.assertEqual(mock_run_rgi_main.call_count, 9)
+
+        # Results share their files with the cache, so they are read-only
+        for samp_bin in ["sample1/bin1", "sample2/bin1", "sample2/bin2"]:
+            for file in ["amr_annotation.txt", "amr_annotation.json"]:
+                path = os.path.join(str(result[0]), samp_bin, file)
+                self.assertTrue(os.path.exists(path))
+                self.assertFalse(os.stat(path).st_mode & stat.S_IWUSR)
+
+    def mock_run_rgi_main_contigs(self, tmp, input_sequence, *args):
+        # Reports one ORF per contig, numbered like Prodigal does
+        rows = []
+        results = {"_metadata": {"software_version": "6.0.3"}}
+        with open(input_sequence) as f:
+            contigs = [line[1:].split()[0] for line in f if line.startswith(">")]
+        for i, contig in enumerate(contigs, 1):
+            orf = f"{contig}_1 # 1 # 8 # 1 # ID={i}_1;partial=00"
+            rows.append(f"{orf}\t{contig}_1\t1\t8\n")
+            results[orf] = {"gnl|BL_ORD_ID|1|hsp_num:0": {"orf_from": f"{contig}_1"}}
+        with open(f"{tmp}/output.txt", "w") as f:
+            f.write("ORF_ID\tContig\tStart\tStop\n")
+            f.writelines(rows)
+        with open(f"{tmp}/output.json", "w") as f:
+            json.dump(results, f)
+
+    def test_annotate_mags_card_batches(self):
+        manifest = self.get_data_path("MANIFEST_mags")
+        mag = MultiMAGSequencesDirFmt()
+        card_db = CARDDatabaseDirectoryFormat()
+        shutil.copy(manifest, os.path.join(str(mag), "MANIFEST"))
+        samp_bins = ["sample1/bin1", "sample2/bin1", "sample2/bin2"]
+        for i, samp_bin in enumerate(samp_bins):
+            os.makedirs(
+                os.path.join(str(mag), os.path.dirname(samp_bin)), exist_ok=True
+            )
+            with open(os.path.join(str(mag), f"{samp_bin}.fasta"), "w") as f:
+                for j in range(i + 1):
+                    f.write(f">contig{j} bin{i}\nACGTACGT\n")
+
+        results = {}
+        for batch_size_bp, n_runs in [(0, 3), (10, 2), (1000, 1)]:
+            mock_run_rgi_main = MagicMock(side_effect=self.mock_run_rgi_main_contigs)
+            with patch("q2_rgi.card.mags.run_rgi_main", mock_run_rgi_main), patch(
+                "q2_rgi.card.mags.load_card_db"
+            ), patch("q2_rgi.card.mags.read_in_txt"), patch(
+                "q2_rgi.card.mags.create_count_table"
+            ):
+                result = annotate_mags_card(
+                    mag, card_db, low_quality=True, batch_size_bp=batch_size_bp
+                )
+            self.assertEqual(mock_run_rgi_main.call_count, n_runs)
+
+            results[batch_size_bp] = {}
+            for samp_bin in samp_bins:
+                for file in ["amr_annotation.txt", "amr_annotation.json"]:
+                    with open(os.path.join(str(result[0]), samp_bin, file)) as f:
+                        results[batch_size_bp][samp_bin, file] = f.read()
+
+        # The annotations of batches are the same as the annotations of single bins
+        self.assertIn(
+            "contig1_1 # 1 # 8 # 1 # ID=2_1",
+            results[0]["sample2/bin2", "amr_annotation.txt"],
+        )
+        self.assertEqual(results[10], results[0])
+        self.assertEqual(results[1000], results[0])
+
+    def test_annotate_mags_card_batches_low_quality(self):
+        with self.assertRaisesRegex(ValueError, "low-quality"):
+            annotate_mags_card(
+                MultiMAGSequencesDirFmt(),
+                CARDDatabaseDirectoryFormat(),
+                batch_size_bp=1000,
+            )
+
     def test_run_rgi_main(self):
         with patch("q2_rgi.card.mags.run_command") as mock_run_command:
             run_rgi_main("path_tmp", "path_input", "DIAMOND", True, True, True, True, 8)
@@ -78,6 +219,7 @@ class TestAnnotateMagsCard(TestPluginBase):
                     "DIAMOND",
                     "--input_type",
                     "contig",
+                    "--local",
                     "--include_loose",
                     "--include_nudge",
                     "--low_quality",
@@ -1,8 +1,11 @@
 import os
+import shutil
+from unittest.mock import patch
 
 from qiime2.plugin.testing import TestPluginBase
 
 from q2_rgi.card.partition import (
+    _balance_partitions,
     collate_mags_annotations,
     collate_mags_kmer_analyses,
     collate_reads_allele_annotations,
@@ -155,6 +158,21 @@ class TestPartition(TestPluginBase):
         with self.assertRaisesRegex(FileExistsError, pattern):
             collate_reads_allele_kmer_analyses(artifacts)
 
+    @patch("q2_rgi.card.partition.link_or_copy")
+    def test_collate_collision_before_linking(self, mock_link_or_copy):
+        # Collisions in the last artifact are found before any file is added
+        artifacts = [
+            CARDAnnotationDirectoryFormat(
+                path=self.get_data_path(f"partitioned/annotate_mags_output_{i}"),
+                mode="r",
+            )
+            for i in [1, 2, 2]
+        ]
+
+        with self.assertRaisesRegex(FileExistsError, "sample2/bin1"):
+            collate_mags_annotations(artifacts)
+        mock_link_or_copy.assert_not_called()
+
     def test_partition_mags_annotations(self):
         # Set up for annotations
         path = self.get_data_path("collated/card_annotation")
@@ -320,3 +338,37 @@ class TestPartition(TestPluginBase):
         # Assert if all files exist in the right location
         for file_path in file_paths:
             self.assertTrue(os.path.exists(file_path))
+
+    def test_partition_mags_annotations_size(self):
+        # The annotation with the largest files gets a partition of its own
+        path = os.path.join(self.temp_dir.name, "card_annotation")
+        shutil.copytree(self.get_data_path("collated/card_annotation"), path)
+        with open(
+            os.path.join(
+                path,
+                "sample2",
+                "aa447c99-ecd9-4c4a-a53b-4df6999815dd",
+                "amr_annotation.txt",
+            ),
+            "a",
+        ) as f:
+            f.write("\n" * 100000)
+        annotations = CARDAnnotationDirectoryFormat(path=path, mode="r")
+
+        obs = partition_mags_annotations(
+            annotations=annotations, num_partitions=2, balance="size"
+        )
+
+        self.assertEqual(
+            [os.listdir(obs[1].path / "sample2"), sorted(os.listdir(obs[2].path))],
+            [["aa447c99-ecd9-4c4a-a53b-4df6999815dd"], ["sample1", "sample2"]],
+        )
+
+    def test_balance_partitions(self):
+        obs = _balance_partitions([1, 5, 2, 2, 4, 1], 3)
+        self.assertEqual(obs, [[1], [0, 4], [2, 3, 5]])
+
+    def test_balance_partitions_zero_costs(self):
+        # Items without cost are spread over all partitions
+        obs = _balance_partitions([3, 0, 0, 0], 3)
+        self.assertEqual(obs, [[0], [1, 3], [2]])
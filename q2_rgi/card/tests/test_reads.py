@@ -1,16 +1,27 @@
+import json
 import os
 import shutil
 import subprocess
 from unittest.mock import ANY, MagicMock, call, patch
 
+import biom
+import numpy as np
 from q2_types.per_sample_sequences import (
+    SequencesWithQuality,
     SingleLanePerSamplePairedEndFastqDirFmt,
     SingleLanePerSampleSingleEndFastqDirFmt,
 )
+from q2_types.sample_data import SampleData
 from qiime2 import Artifact
 from qiime2.plugin.testing import TestPluginBase
 
-from q2_rgi.card.reads import _annotate_reads_card, annotate_reads_card, run_rgi_bwt
+from q2_rgi.card.reads import (
+    _annotate_reads_card,
+    _check_annotation_settings,
+    _check_existing_samples,
+    annotate_reads_card,
+    run_rgi_bwt,
+)
 from q2_rgi.types import (
     CARDAlleleAnnotationDirectoryFormat,
     CARDDatabaseDirectoryFormat,
@@ -42,6 +53,12 @@ class TestAnnotateReadsCARD(TestPluginBase):
     def test_annotate_reads_card_paired(self):
         self.annotate_reads_card_test_body("paired")
 
+    def create_card_db(self):
+        card_db = CARDDatabaseDirectoryFormat()
+        with open(os.path.join(str(card_db), "card.json"), "w") as f:
+            f.write('{"_version": "3.3.0"}')
+        return card_db
+
     def copy_needed_files(self, cwd, samp, **kwargs):
         # Create a sample directory
         samp_dir = os.path.join(cwd, samp)
@@ -59,7 +76,7 @@ class TestAnnotateReadsCARD(TestPluginBase):
             if read_type == "single"
             else SingleLanePerSamplePairedEndFastqDirFmt()
         )
-        card_db = CARDDatabaseDirectoryFormat()
+        card_db = self.create_card_db()
 
         # Copy manifest file to reads object
         manifest = self.get_data_path(f"MANIFEST_reads_{read_type}")
@@ -112,6 +129,8 @@ class TestAnnotateReadsCARD(TestPluginBase):
                     fasta=True,
                     include_other_models=False,
                     include_wildcard=False,
+                    cwd=tmp_dir,
+                    card_index=None,
                 ),
             ]
 
@@ -156,6 +175,69 @@ class TestAnnotateReadsCARD(TestPluginBase):
                             os.path.exists(os.path.join(str(result[num]), samp, file))
                         )
 
+                    # The settings are recorded in every sample directory
+                    path = os.path.join(
+                        str(result[num]), samp, "annotation_settings.json"
+                    )
+                    with open(path) as f:
+                        self.assertEqual(
+                            json.load(f),
+                            {
+                                "card_version": "3.3.0",
+                                "aligner": "kma",
+                                "include_wildcard": False,
+                                "include_other_models": False,
+                            },
+                        )
+
+    def test_annotate_reads_card_parallel_samples(self):
+        reads = SingleLanePerSampleSingleEndFastqDirFmt()
+        card_db = self.create_card_db()
+        manifest = self.get_data_path("MANIFEST_reads_single")
+        shutil.copy(manifest, os.path.join(str(reads), "MANIFEST"))
+
+        mock_run_rgi_bwt = MagicMock(side_effect=self.copy_needed_files)
+        with patch("q2_rgi.card.reads.run_rgi_bwt", mock_run_rgi_bwt), patch(
+            "q2_rgi.card.reads.load_card_db"
+        ), patch("q2_rgi.card.reads.read_in_txt"), patch(
+            "q2_rgi.card.reads.create_count_table"
+        ):
+            _annotate_reads_card(reads, card_db, threads=16)
+
+        # Two samples run at the same time with eight threads each
+        self.assertEqual(mock_run_rgi_bwt.call_count, 2)
+        for c in mock_run_rgi_bwt.call_args_list:
+            self.assertEqual(c.kwargs["threads"], 8)
+
+    def test_annotate_reads_card_removes_sample_tmp_dir(self):
+        reads = SingleLanePerSampleSingleEndFastqDirFmt()
+        card_db = self.create_card_db()
+        manifest = self.get_data_path("MANIFEST_reads_single")
+        shutil.copy(manifest, os.path.join(str(reads), "MANIFEST"))
+
+        # Record the sample directories in the tmp directory before every run
+        tmp_contents = []
+
+        def run_rgi_bwt(cwd, samp, **kwargs):
+            tmp_contents.append(sorted(os.listdir(cwd)))
+            self.copy_needed_files(cwd, samp)
+
+        with patch("q2_rgi.card.reads.run_rgi_bwt", side_effect=run_rgi_bwt), patch(
+            "q2_rgi.card.reads.load_card_db"
+        ), patch("q2_rgi.card.reads.read_in_txt"), patch(
+            "q2_rgi.card.reads.create_count_table"
+        ):
+            result = _annotate_reads_card(reads, card_db)
+
+        # The tmp directory of the first sample is gone when the second one runs and
+        # the BAM file was moved to the allele annotation
+        self.assertEqual(tmp_contents, [["sample1"], ["sample2"]])
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(str(result[0]), "sample1", "sorted.length_100.bam")
+            )
+        )
+
     def test_run_rgi_bwt(self):
         with patch("q2_rgi.card.reads.run_command") as mock_run_command:
             run_rgi_bwt(
@@ -181,6 +263,7 @@ class TestAnnotateReadsCARD(TestPluginBase):
                     "--clean",
                     "--aligner",
                     "bowtie2",
+                    "--local",
                     "--read_two",
                     "path_rev",
                     "--include_wildcard",
@@ -238,7 +321,8 @@ class TestAnnotateReadsCARD(TestPluginBase):
         ]
 
         # Call function with mocked ctx
-        result = annotate_reads_card(ctx=mock_ctx, reads=reads, card_db=None)
+        with patch("q2_rgi.card.reads.card_version", return_value="3.3.0"):
+            result = annotate_reads_card(ctx=mock_ctx, reads=reads, card_db=MagicMock())
 
         self.assertEqual(
             result,
@@ -249,3 +333,205 @@ class TestAnnotateReadsCARD(TestPluginBase):
                 "artifact_feature_table_merged",
             ),
         )
+
+    def test_annotate_reads_card_pipeline_existing(self):
+        # Existing results are collated and merged with the results of new samples
+        reads = MagicMock()
+        reads.type = SampleData[SequencesWithQuality]
+        card_db = MagicMock()
+        annotate = MagicMock(
+            return_value=(
+                "allele_new",
+                "gene_new",
+                "allele_table_new",
+                "gene_table_new",
+            )
+        )
+        collate_allele = MagicMock(return_value=("allele_collated",))
+        collate_gene = MagicMock(return_value=("gene_collated",))
+        merge = MagicMock(return_value=("table_merged",))
+        mock_ctx = MagicMock()
+        mock_ctx.get_action.side_effect = [
+            MagicMock(return_value=({"1": "reads_new"},)),
+            annotate,
+            collate_allele,
+            collate_gene,
+            merge,
+        ]
+
+        allele_old = MagicMock()
+        gene_old = MagicMock()
+
+        with patch("q2_rgi.card.reads._check_annotation_settings") as mock_check, patch(
+            "q2_rgi.card.reads._check_existing_samples"
+        ) as mock_check_samples, patch(
+            "q2_rgi.card.reads._filter_new_samples", return_value="reads_new"
+        ), patch(
+            "q2_rgi.card.reads.card_version", return_value="3.3.0"
+        ):
+            annotate_reads_card(
+                ctx=mock_ctx,
+                reads=reads,
+                card_db=card_db,
+                existing_allele_annotation=allele_old,
+                existing_gene_annotation=gene_old,
+                existing_allele_table="allele_table_old",
+                existing_gene_table="gene_table_old",
+            )
+
+        settings = {
+            "card_version": "3.3.0",
+            "aligner": "kma",
+            "include_wildcard": False,
+            "include_other_models": False,
+        }
+        mock_check_samples.assert_called_once_with(
+            allele_old, gene_old, "allele_table_old", "gene_table_old"
+        )
+        allele_old.view.assert_called_once_with(CARDAlleleAnnotationDirectoryFormat)
+        gene_old.view.assert_called_once_with(CARDGeneAnnotationDirectoryFormat)
+        mock_check.assert_has_calls(
+            [
+                call(allele_old.view.return_value, settings),
+                call(gene_old.view.return_value, settings),
+            ]
+        )
+        annotate.assert_called_once()
+        collate_allele.assert_called_once_with([allele_old, "allele_new"])
+        collate_gene.assert_called_once_with([gene_old, "gene_new"])
+        merge.assert_has_calls(
+            [
+                call(["allele_table_old", "allele_table_new"]),
+                call(["gene_table_old", "gene_table_new"]),
+            ]
+        )
+
+    def test_annotate_reads_card_pipeline_existing_no_new_samples(self):
+        reads = MagicMock()
+        reads.type = SampleData[SequencesWithQuality]
+        partition = MagicMock()
+        annotate = MagicMock()
+        mock_ctx = MagicMock()
+        mock_ctx.get_action.side_effect = [
+            partition,
+            annotate,
+            MagicMock(return_value=("allele_collated",)),
+            MagicMock(return_value=("gene_collated",)),
+            MagicMock(return_value=("table_merged",)),
+        ]
+
+        with patch("q2_rgi.card.reads._check_annotation_settings"), patch(
+            "q2_rgi.card.reads._check_existing_samples"
+        ), patch("q2_rgi.card.reads._filter_new_samples", return_value=None), patch(
+            "q2_rgi.card.reads.card_version", return_value="3.3.0"
+        ):
+            annotate_reads_card(
+                ctx=mock_ctx,
+                reads=reads,
+                card_db=MagicMock(),
+                existing_allele_annotation=MagicMock(),
+                existing_gene_annotation=MagicMock(),
+                existing_allele_table="allele_table_old",
+                existing_gene_table="gene_table_old",
+            )
+
+        partition.assert_not_called()
+        annotate.assert_not_called()
+
+    def test_annotate_reads_card_pipeline_existing_incomplete(self):
+        reads = MagicMock()
+        reads.type = SampleData[SequencesWithQuality]
+        with self.assertRaisesRegex(ValueError, "have to be provided"), patch(
+            "q2_rgi.card.reads.card_version", return_value="3.3.0"
+        ):
+            annotate_reads_card(
+                ctx=MagicMock(),
+                reads=reads,
+                card_db=MagicMock(),
+                existing_allele_annotation="allele_old",
+            )
+
+    def _annotation(self, samples):
+        # Creates a gene annotation with the settings of every sample, or without
+        # settings file for samples that map to None
+        annotation = CARDGeneAnnotationDirectoryFormat()
+        for samp, settings in samples.items():
+            os.makedirs(os.path.join(str(annotation), samp))
+            if settings is not None:
+                path = os.path.join(str(annotation), samp, "annotation_settings.json")
+                with open(path, "w") as f:
+                    json.dump(settings, f)
+        return annotation
+
+    def test_check_annotation_settings(self):
+        settings = {
+            "card_version": "3.3.0",
+            "aligner": "kma",
+            "include_wildcard": False,
+            "include_other_models": False,
+        }
+        _check_annotation_settings(
+            self._annotation({"sample1": settings, "sample2": settings}), settings
+        )
+
+        with self.assertRaisesRegex(ValueError, "Different: aligner"):
+            _check_annotation_settings(
+                self._annotation(
+                    {"sample1": settings, "sample2": {**settings, "aligner": "bwa"}}
+                ),
+                settings,
+            )
+
+        with self.assertRaisesRegex(ValueError, "Different: card_version"):
+            _check_annotation_settings(
+                self._annotation({"sample1": {**settings, "card_version": "3.2.9"}}),
+                settings,
+            )
+
+        # Samples annotated before the settings were recorded are treated as different
+        with self.assertRaisesRegex(
+            ValueError,
+            "Different: card_version, aligner, include_wildcard, include_other_models",
+        ):
+            _check_annotation_settings(
+                self._annotation({"sample1": settings, "sample2": None}), settings
+            )
+
+    def test_check_existing_samples(self):
+        def annotation(samples):
+            artifact = MagicMock()
+            artifact.view.return_value.sample_dict.return_value = {
+                samp: [] for samp in samples
+            }
+            return artifact
+
+        def table(samples):
+            artifact = MagicMock()
+            artifact.view.return_value = biom.Table(
+                np.ones((1, len(samples))), ["ARO:1"], samples
+            )
+            return artifact
+
+        # Samples without hits are missing from the feature tables
+        _check_existing_samples(
+            annotation(["sample1", "sample2"]),
+            annotation(["sample1", "sample2"]),
+            table(["sample1"]),
+            table(["sample1", "sample2"]),
+        )
+
+        with self.assertRaisesRegex(ValueError, "different samples: sample2"):
+            _check_existing_samples(
+                annotation(["sample1", "sample2"]),
+                annotation(["sample1"]),
+                table(["sample1"]),
+                table(["sample1"]),
+            )
+
+        with self.assertRaisesRegex(ValueError, "gene feature table .* sample3"):
+            _check_existing_samples(
+                annotation(["sample1", "sample2"]),
+                annotation(["sample1", "sample2"]),
+                table(["sample1"]),
+                table(["sample1", "sample3"]),
+            )
@@ -1,17 +1,24 @@
 import os
 import shutil
+import stat
 import subprocess
 from unittest.mock import call, patch
 
+import biom
 import pandas as pd
 from qiime2.plugin.testing import TestPluginBase
 
 from q2_rgi.card.utils import (
+    auto_parallel_jobs,
     colorify,
     copy_files,
     create_count_table,
+    link_or_copy,
+    link_tree,
     load_card_db,
     read_in_txt,
+    read_rgi_table,
+    split_threads,
 )
 from q2_rgi.types import CARDDatabaseDirectoryFormat, CARDKmerDatabaseDirectoryFormat
 
@@ -29,32 +36,32 @@ class TestUtilsCARD(TestPluginBase):
                     "ARO:3000805|ID:172|Name:OprN|NCBI:AE004091.2",
                     "ARO:3000026|ID:377|Name:mepA|NCBI:AY661734.1",
                 ],
-                "sample1": ["1", "1", "1", "1"],
+                "sample1": [1, 1, 1, 1],
             }
         )
 
         cls.gene_count_df = pd.DataFrame(
             {
                 "ARO Term": ["mdtF", "mgrA", "OprN", "mepA"],
-                "sample1": ["1", "1", "1", "1"],
+                "sample1": [1, 1, 1, 1],
             }
         )
 
         cls.mag_count_df = pd.DataFrame(
             {
                 "Best_Hit_ARO": ["mdtF", "OprN", "mepA"],
-                "sample1/bin1": ["2", "1", "1"],
+                "sample1/bin1": [2, 1, 1],
             }
         )
 
         cls.frequency_table = pd.DataFrame(
             {
                 "sample_id": ["sample1", "sample2"],
-                "OprN": ["1", "1"],
-                "mdtE": ["0", "1"],
-                "mdtF": ["1", "0"],
-                "mepA": ["1", "1"],
-                "mgrA": ["1", "1"],
+                "OprN": [1, 1],
+                "mdtE": [0, 1],
+                "mdtF": [1, 0],
+                "mepA": [1, 1],
+                "mgrA": [1, 1],
             }
         )
         cls.frequency_table.set_index("sample_id", inplace=True)
@@ -79,14 +86,15 @@ class TestUtilsCARD(TestPluginBase):
         with patch("q2_rgi.card.utils.run_command") as mock_run_command:
             # Run load_card_db two times with include_other_models set to True and False
             for parameters in [False, True]:
-                kmer_size = load_card_db(
+                with load_card_db(
                     card_db=card_db,
                     kmer_db=kmer_db,
                     kmer=True,
                     fasta=True,
                     include_wildcard=True,
                     include_other_models=parameters,
-                )
+                ) as kmer_size:
+                    pass
 
             # Create two expected call objects
             flags = ["", "_all_models"]
@@ -128,6 +136,99 @@ class TestUtilsCARD(TestPluginBase):
             # Assert if function was called with expected calls
             mock_run_command.assert_has_calls(expected_calls, any_order=False)
 
+    def test_load_card_db_local(self):
+        card_db = CARDDatabaseDirectoryFormat()
+        shutil.copy(
+            self.get_data_path("card_test.json"),
+            os.path.join(str(card_db), "card.json"),
+        )
+
+        # Without a cache the database is loaded into the working directory
+        with patch.dict(os.environ, {"Q2_RGI_CACHE_DIR": ""}), patch(
+            "q2_rgi.card.utils.run_command"
+        ) as mock_run_command:
+            with load_card_db(card_db=card_db, cwd="path_tmp"):
+                pass
+
+        mock_run_command.assert_called_once_with(
+            cmd=[
+                "rgi",
+                "load",
+                "--card_json",
+                os.path.join(str(card_db), "card.json"),
+                "--local",
+            ],
+            cwd="path_tmp",
+            verbose=True,
+        )
+
+    def test_load_card_db_cache(self):
+        card_db = CARDDatabaseDirectoryFormat()
+        shutil.copy(
+            self.get_data_path("card_test.json"),
+            os.path.join(str(card_db), "card.json"),
+        )
+        cache_dir = os.path.join(self.temp_dir.name, "cache")
+
+        def mock_run_command(cmd, cwd, verbose):
+            os.makedirs(os.path.join(cwd, "localDB"))
+            with open(os.path.join(cwd, "localDB", "loaded_databases.json"), "w") as f:
+                f.write("{}")
+
+        with patch.dict(os.environ, {"Q2_RGI_CACHE_DIR": cache_dir}), patch(
+            "q2_rgi.card.utils.run_command", side_effect=mock_run_command
+        ) as mock_run, patch(
+            "q2_rgi.card.utils.rgi_version", return_value="6.0.3"
+        ) as mock_rgi_version:
+            # Load the same database twice into two different working directories
+            for i in range(2):
+                cwd = os.path.join(self.temp_dir.name, f"cwd{i}")
+                os.makedirs(cwd)
+                with load_card_db(card_db=card_db, cwd=cwd):
+                    local_db = os.path.join(cwd, "localDB")
+                    self.assertTrue(os.path.isdir(local_db))
+                    self.assertFalse(os.path.islink(local_db))
+
+                    # Files that RGI adds to the local database stay private
+                    with open(os.path.join(local_db, "index.name"), "w") as f:
+                        f.write("index")
+
+            entries = [
+                e for e in os.listdir(os.path.join(cache_dir, "load")) if "." not in e
+            ]
+            self.assertEqual(
+                os.listdir(os.path.join(cache_dir, "load", entries[0], "localDB")),
+                ["loaded_databases.json"],
+            )
+
+            # rgi load only runs once and loads into a local database
+            mock_run.assert_called_once()
+            self.assertEqual(mock_run.call_args.kwargs["cmd"][-1], "--local")
+
+            # A different RGI version loads the database again
+            mock_rgi_version.return_value = "6.0.4"
+            cwd = os.path.join(self.temp_dir.name, "cwd2")
+            os.makedirs(cwd)
+            with load_card_db(card_db=card_db, cwd=cwd):
+                pass
+            self.assertEqual(mock_run.call_count, 2)
+
+    def test_load_card_db_card_index(self):
+        card_index = os.path.join(self.temp_dir.name, "card_index")
+        os.makedirs(os.path.join(card_index, "localDB", "kma"))
+        for file in ["card.json", "kma/index.name"]:
+            with open(os.path.join(card_index, "localDB", file), "w") as f:
+                f.write(file)
+        cwd = os.path.join(self.temp_dir.name, "cwd")
+        os.makedirs(cwd)
+
+        # The local database of the index is used instead of loading the database
+        with patch("q2_rgi.card.utils.run_command") as mock_run_command:
+            with load_card_db(card_db=None, fasta=True, cwd=cwd, card_index=card_index):
+                with open(os.path.join(cwd, "localDB", "kma", "index.name")) as f:
+                    self.assertEqual(f.read(), "kma/index.name")
+        mock_run_command.assert_not_called()
+
     def test_exception_raised(self):
         # Simulate a subprocess.CalledProcessError during run_command
         expected_message = (
@@ -170,6 +271,31 @@ class TestUtilsCARD(TestPluginBase):
             map_type="gene",
         )
 
+    def test_read_rgi_table_usecols(self):
+        # Only the requested columns are read with the requested dtypes
+        obs = read_rgi_table(
+            self.get_data_path("output.gene_mapping_data.txt"),
+            usecols=["All Mapped Reads", "ARO Term"],
+            dtype={"ARO Term": str, "All Mapped Reads": "int64"},
+        )
+        self.assertEqual(list(obs.columns), ["ARO Term", "All Mapped Reads"])
+        self.assertEqual(obs["All Mapped Reads"].dtype, "int64")
+
+    def test_read_rgi_table_c_engine(self):
+        # amr_annotation.txt files with omitted trailing fields are read with the
+        # C engine
+        obs = read_rgi_table(
+            self.get_data_path("output.mags.txt"), usecols=["Best_Hit_ARO"], engine="c"
+        )
+        self.assertEqual(list(obs.columns), ["Best_Hit_ARO"])
+        self.assertEqual(len(obs), 4)
+
+    def assert_count_table_equal(self, exp, obs):
+        # Compare a sample x feature dataframe with a biom table
+        obs = obs.to_dataframe(dense=True).T
+        obs.index.name = "sample_id"
+        pd.testing.assert_frame_equal(exp, obs, check_dtype=False)
+
     def read_in_txt_test_body(
         self, filename, samp_bin_name, exp, data_type, map_type=None
     ):
@@ -187,18 +313,42 @@ class TestUtilsCARD(TestPluginBase):
 
         # Create observed count table with create_count_table function
         obs = create_count_table(df_list)
-        obs = obs.astype(str)
 
         # Define expected count table
         exp = self.frequency_table
 
         # Compare expected and observed count table
-        pd.testing.assert_frame_equal(exp, obs)
+        self.assertIsInstance(obs, biom.Table)
+        self.assert_count_table_equal(exp, obs)
+
+    def test_create_count_table_duplicate_features(self):
+        # Counts of features that occur more than once in a sample are added up
+        df = pd.DataFrame({"ARO Term": ["mdtF", "OprN", "mdtF"], "sample1": [1, 2, 3]})
+
+        obs = create_count_table([df])
+
+        exp = pd.DataFrame(
+            {"OprN": [2], "mdtF": [4]}, index=pd.Index(["sample1"], name="sample_id")
+        )
+        self.assert_count_table_equal(exp, obs)
 
     def test_create_count_table_value_error(self):
         # Assert if ValueError is called when empy list is passed
         self.assertRaises(ValueError, create_count_table, [])
 
+    def test_split_threads(self):
+        self.assertEqual(split_threads(8, 2), (2, 4))
+        self.assertEqual(split_threads(7, 2), (2, 3))
+        self.assertEqual(split_threads(2, 4), (2, 1))
+        self.assertEqual(split_threads(1, 1), (1, 1))
+
+    def test_auto_parallel_jobs(self):
+        self.assertEqual(auto_parallel_jobs(64, 100, 8), 8)
+        self.assertEqual(auto_parallel_jobs(12, 100, 8), 2)
+        self.assertEqual(auto_parallel_jobs(64, 3, 8), 3)
+        self.assertEqual(auto_parallel_jobs(1, 10, 8), 1)
+        self.assertEqual(auto_parallel_jobs(8, 0, 8), 1)
+
     def test_colorify(self):
         # Test if colorify function correctly adds color codes
         string = "Hello, world!"
@@ -232,3 +382,63 @@ class TestUtilsCARD(TestPluginBase):
 
         self.assertTrue(os.path.exists(dst_path_1))
         self.assertTrue(os.path.exists(dst_path_2))
+
+    def test_link_or_copy_hardlink(self):
+        src = os.path.join(self.temp_dir.name, "src.fasta")
+        dst = os.path.join(self.temp_dir.name, "dst.fasta")
+        shutil.copy(self.get_data_path("DNA_fasta.fasta"), src)
+
+        self.assertEqual(link_or_copy(src, dst), "hardlink")
+        self.assertTrue(os.path.samefile(src, dst))
+
+    @patch("fcntl.ioctl", side_effect=OSError("Operation not supported"))
+    @patch("os.link", side_effect=OSError("Invalid cross-device link"))
+    def test_link_or_copy_copy(self, mock_link, mock_ioctl):
+        # Files are copied if they can neither be linked nor cloned
+        src = os.path.join(self.temp_dir.name, "src.fasta")
+        dst = os.path.join(self.temp_dir.name, "dst.fasta")
+        shutil.copy(self.get_data_path("DNA_fasta.fasta"), src)
+
+        self.assertEqual(link_or_copy(src, dst), "copy")
+        self.assertFalse(os.path.samefile(src, dst))
+        with open(src) as f_src, open(dst) as f_dst:
+            self.assertEqual(f_src.read(), f_dst.read())
+
+    @patch("fcntl.ioctl")
+    @patch("os.link", side_effect=OSError("Invalid cross-device link"))
+    def test_link_or_copy_reflink(self, mock_link, mock_ioctl):
+        src = os.path.join(self.temp_dir.name, "src.fasta")
+        dst = os.path.join(self.temp_dir.name, "dst.fasta")
+        shutil.copy(self.get_data_path("DNA_fasta.fasta"), src)
+
+        self.assertEqual(link_or_copy(src, dst), "reflink")
+        mock_ioctl.assert_called_once()
+
+    def test_copy_files_strategies(self):
+        src = os.path.join(self.temp_dir.name, "DNA_fasta.fasta")
+        shutil.copy(self.get_data_path("DNA_fasta.fasta"), src)
+
+        obs = copy_files([src], self.temp_dir.name, "dst")
+
+        self.assertEqual(obs, {"hardlink": 1})
+
+    def test_link_tree(self):
+        src = os.path.join(self.temp_dir.name, "src")
+        os.makedirs(os.path.join(src, "kma"))
+        for file in ["loaded_databases.json", "kma/index.name"]:
+            with open(os.path.join(src, file), "w") as f:
+                f.write(file)
+        dst = os.path.join(self.temp_dir.name, "dst")
+
+        obs = link_tree(src, dst)
+
+        # Linked files are read-only and files that RGI rewrites are copies
+        self.assertEqual(obs, {"hardlink": 1, "copy": 1})
+        index = os.path.join(dst, "kma", "index.name")
+        self.assertTrue(os.path.samefile(os.path.join(src, "kma", "index.name"), index))
+        self.assertFalse(os.stat(index).st_mode & stat.S_IWUSR)
+        loaded = os.path.join(dst, "loaded_databases.json")
+        self.assertFalse(
+            os.path.samefile(os.path.join(src, "loaded_databases.json"), loaded)
+        )
+        self.assertTrue(os.stat(loaded).st_mode & stat.S_IWUSR)
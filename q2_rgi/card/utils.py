@@ -1,11 +1,22 @@
+import fcntl
+import functools
 import glob
 import json
+import math
 import os
+import shutil
+import stat
 import subprocess
-from functools import reduce
+from collections import Counter
+from contextlib import contextmanager
 
+import biom
+import numpy as np
 import pandas as pd
-from qiime2.util import duplicate
+from scipy.sparse import coo_matrix
+
+from q2_rgi.card.cache import DirectoryCache, hash_key
+from q2_rgi.types._util import read_rgi_table
 
 EXTERNAL_CMD_WARNING = (
     "Running external command line application(s). "
@@ -15,6 +26,19 @@ EXTERNAL_CMD_WARNING = (
     "temporary files that no longer exist."
 )
 
+# ioctl request that clones a file on copy-on-write filesystems like Btrfs and XFS
+FICLONE = 0x40049409
+
+# Name of the directory that RGI uses for a local database when run with --local
+LOCAL_DB = "localDB"
+
+# Files of a local database that RGI rewrites in place when it builds an aligner
+# index, so they are copied instead of linked
+RGI_WRITABLE_FILES = ("loaded_databases.json",)
+
+# Write permission bits that are removed from linked files
+WRITE_PERMISSIONS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
 
 def run_command(cmd, cwd, verbose=True):
     if verbose:
@@ -24,6 +48,57 @@ def run_command(cmd, cwd, verbose=True):
     subprocess.run(cmd, check=True, cwd=cwd)
 
 
+@functools.lru_cache(maxsize=None)
+def rgi_version() -> str:
+    # Version of the installed RGI. It is part of cache keys, as new releases can
+    # change the results
+    try:
+        result = subprocess.run(
+            ["rgi", "main", "--version"], capture_output=True, text=True, check=True
+        )
+    except subprocess.CalledProcessError as e:
+        raise Exception(
+            f"An error was encountered while running rgi, "
+            f"(return code {e.returncode}), please inspect "
+            "stdout and stderr to learn more."
+        )
+    return result.stdout.strip()
+
+
+def split_threads(threads: int, parallel_jobs: int):
+    """
+    Splits a total thread budget between jobs that run at the same time.
+
+    Args:
+        threads (int): Total number of threads available to all jobs.
+        parallel_jobs (int): Requested number of concurrent jobs.
+
+    Returns:
+        tuple: Number of concurrent jobs, capped by the thread budget, and the number
+        of threads every job can use.
+    """
+    parallel_jobs = max(1, min(parallel_jobs, threads))
+    return parallel_jobs, max(1, threads // parallel_jobs)
+
+
+def auto_parallel_jobs(threads: int, num_jobs: int, max_threads_per_job: int):
+    """
+    Picks how many jobs should run at the same time so that no job gets more threads
+    than it can make use of.
+
+    Args:
+        threads (int): Total number of threads available to all jobs.
+        num_jobs (int): Number of jobs that have to be run.
+        max_threads_per_job (int): Number of threads beyond which a single job stops
+        scaling.
+
+    Returns:
+        int: Number of concurrent jobs.
+    """
+    return max(1, min(num_jobs, math.ceil(threads / max_threads_per_job)))
+
+
+@contextmanager
 def load_card_db(
     card_db,
     kmer_db=None,
@@ -31,23 +106,51 @@ def load_card_db(
     fasta: bool = False,
     include_other_models: bool = False,
     include_wildcard: bool = False,
+    cwd: str = None,
+    card_index=None,
 ):
+    """
+    Loads the CARD database files with "rgi load" and yields the k-mer size of the
+    loaded k-mer database.
+
+    If a working directory is given, the database is loaded as a local database into
+    that directory, so that actions running in parallel never share loaded database
+    files. RGI commands running in the working directory have to be called with
+    --local. If the persistent cache is enabled by setting Q2_RGI_CACHE_DIR, the
+    local database is kept in the cache and its files are linked into a private local
+    database in the working directory. Loads with the same RGI and CARD versions,
+    flags and database file names and sizes reuse the cached local database instead
+    of running "rgi load" again. Cache entries are never written to: linked files are
+    read-only, the files that RGI rewrites are copied and the aligner indices that RGI
+    builds on first use end up in the private local database. Without a working
+    directory the database is loaded into RGI's global data directory.
+
+    If a prebuilt CARD aligner index is given, its local database, which already
+    contains the indices of the aligner, is linked into the working directory instead
+    of loading the database.
+    """
+    if card_index is not None:
+        link_tree(os.path.join(str(card_index), LOCAL_DB), os.path.join(cwd, LOCAL_DB))
+        yield None
+        return
+
     # Get path to card.json
     path_card_json = str(card_db.path / "card.json")
 
-    # Base command that only loads card.json
+    # Base command that only loads card.json. All loaded files are collected for the
+    # cache key
     cmd = ["rgi", "load", "--card_json", path_card_json]
+    files = [path_card_json]
+
+    # Retrieve the database version number from card.json file
+    with open(path_card_json) as f:
+        version = json.load(f)["_version"]
 
     # Define suffixes for card fasta file
     models = ("_all", "_all_models") if include_other_models is True else ("", "")
 
     # Extend base command with flag to load card fasta file
     if fasta:
-        # Retrieve the database version number from card.jason file
-        with open(path_card_json) as f:
-            card_data = json.load(f)
-            version = card_data["_version"]
-
         # Define path to card fasta file
         path_card_fasta = os.path.join(
             str(card_db), f"card_database_v{version}{models[0]}.fasta"
@@ -55,17 +158,23 @@ def load_card_db(
 
         # Extend base command
         cmd.extend([f"--card_annotation{models[1]}", path_card_fasta])
+        files.append(path_card_fasta)
 
     # Extend base command with flag to load wildcard fasta file and index
     if include_wildcard:
+        wildcard_files = [
+            os.path.join(str(card_db), f"wildcard_database_v0{models[0]}.fasta"),
+            os.path.join(str(card_db), "index-for-model-sequences.txt"),
+        ]
         cmd.extend(
             [
                 f"--wildcard_annotation{models[1]}",
-                os.path.join(str(card_db), f"wildcard_database_v0{models[0]}.fasta"),
+                wildcard_files[0],
                 "--wildcard_index",
-                os.path.join(str(card_db), "index-for-model-sequences.txt"),
+                wildcard_files[1],
             ]
         )
+        files.extend(wildcard_files)
     # Extend base command with flag to load kmer json and txt database files
     kmer_size = None
     if kmer:
@@ -82,39 +191,122 @@ def load_card_db(
                 os.path.basename(path_kmer_json).split("_")[0],
             ]
         )
+        files.extend([path_kmer_json, path_kmer_txt])
+
+    if cwd is None:
+        _run_rgi_load(cmd=cmd, cwd=None)
+        yield kmer_size
+        return
+
+    cache = DirectoryCache.from_env("load")
+    if cache is None:
+        _run_rgi_load(cmd=cmd + ["--local"], cwd=cwd)
+        yield kmer_size
+        return
 
-    # Run command
+    # The cache key is made of the RGI and CARD versions, the flags and the names and
+    # sizes of all loaded files, so that identical databases are found regardless of
+    # the artifact they come from. Hashing the content of the large FASTA and k-mer
+    # files would take about as long as loading them
+    key = hash_key(
+        [rgi_version(), version]
+        + [arg for arg in cmd if arg not in files]
+        + [f"{os.path.basename(path)}:{os.path.getsize(path)}" for path in files]
+    )
+    print(colorify(f"Using cached local CARD database {key}."), flush=True)
+    with cache.use(
+        key, lambda path: _run_rgi_load(cmd=cmd + ["--local"], cwd=path)
+    ) as entry:
+        link_tree(os.path.join(entry, LOCAL_DB), os.path.join(cwd, LOCAL_DB))
+
+    # The linked files don't depend on the entry anymore, so it can be evicted
+    yield kmer_size
+
+
+def _run_rgi_load(cmd, cwd):
     try:
-        run_command(cmd=cmd, cwd=None, verbose=True)
+        run_command(cmd=cmd, cwd=cwd, verbose=True)
     except subprocess.CalledProcessError as e:
         raise Exception(
             f"An error was encountered while running rgi, "
             f"(return code {e.returncode}), please inspect "
             "stdout and stderr to learn more."
         )
-    return kmer_size
 
 
-def read_in_txt(path: str, samp_bin_name: str, data_type: str, map_type=None):
-    # Read in txt file to pd.Dataframe
-    df = pd.read_csv(path, sep="\t")
+def link_local_db(src_dir: str, dst_dir: str):
+    """
+    Makes the local RGI database that was loaded into src_dir available to RGI
+    commands running in dst_dir.
+    """
+    os.symlink(
+        os.path.realpath(os.path.join(src_dir, LOCAL_DB)),
+        os.path.join(dst_dir, LOCAL_DB),
+    )
 
-    # Process the df depending on the data type and mapping type
+
+def link_tree(src_dir: str, dst_dir: str, copy: tuple = RGI_WRITABLE_FILES) -> Counter:
+    """
+    Recreates the directory tree of src_dir in dst_dir and links or copies all files
+    into it with link_or_copy. Hard links share their content with src_dir, so the
+    linked files are made read-only and writing to them fails instead of changing
+    src_dir. Files with a name in copy are always copied and stay writable.
+
+    Args:
+        src_dir (str): Directory to be linked.
+        dst_dir (str): Destination directory. Created if it doesn't exist.
+        copy (tuple): Names of files that are copied instead of linked.
+
+    Returns:
+        Counter: Number of files per strategy that was used to create them.
+    """
+    strategies = Counter()
+    for root, _, files in os.walk(src_dir):
+        dst = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+        os.makedirs(dst, exist_ok=True)
+        for file in files:
+            src_path = os.path.join(root, file)
+            dst_path = os.path.join(dst, file)
+            if file in copy:
+                shutil.copyfile(src_path, dst_path)
+                strategies["copy"] += 1
+                continue
+
+            strategies[link_or_copy(src_path, dst_path)] += 1
+            mode = os.stat(dst_path).st_mode
+            if mode & WRITE_PERMISSIONS:
+                # Files owned by other users can be linked but not changed
+                try:
+                    os.chmod(dst_path, mode & ~WRITE_PERMISSIONS)
+                except PermissionError:
+                    pass
+    return strategies
+
+
+def read_in_txt(path: str, samp_bin_name: str, data_type: str, map_type=None):
+    # Read in only the needed columns of the txt file to pd.Dataframe
     if data_type == "reads":
         colname = "Reference Sequence" if map_type == "allele" else "ARO Term"
+        df = read_rgi_table(
+            path,
+            usecols=[colname, "All Mapped Reads"],
+            dtype={colname: str, "All Mapped Reads": "int64"},
+        )
         df = df[[colname, "All Mapped Reads"]]
         df.rename(columns={"All Mapped Reads": samp_bin_name}, inplace=True)
     else:
+        df = read_rgi_table(
+            path, usecols=["Best_Hit_ARO"], dtype={"Best_Hit_ARO": str}, engine="c"
+        )
         df = df["Best_Hit_ARO"].value_counts().reset_index()
 
         # Rename the columns
         df.columns = ["Best_Hit_ARO", samp_bin_name]
 
-    df = df.astype(str)
     return df
 
 
-def create_count_table(df_list: list) -> pd.DataFrame:
+def create_count_table(df_list: list) -> biom.Table:
     # Remove all empty lists from df_list
     df_list = [df for df in df_list if not df.empty]
 
@@ -124,38 +316,82 @@ def create_count_table(df_list: list) -> pd.DataFrame:
             "RGI did not identify any AMR genes. No output can be created."
         )
 
-    # Merge all dfs contained in df_list
-    df = reduce(
-        lambda left, right: pd.merge(left, right, on=left.columns[0], how="outer"),
-        df_list,
-    )
+    # Collect (sample, feature, count) triples from all dfs. Every df holds the
+    # features in its first and the counts of one sample in its second column
+    samples = [df.columns[1] for df in df_list]
+    sample_idx = np.repeat(np.arange(len(df_list)), [len(df) for df in df_list])
+    features = np.concatenate([df.iloc[:, 0].astype(str).to_numpy() for df in df_list])
+    counts = np.concatenate([pd.to_numeric(df.iloc[:, 1]).to_numpy() for df in df_list])
 
-    # Process the df to meet all requirements for a FeatureTable
-    df = df.transpose()
-    df = df.fillna(0)
-    df.columns = df.iloc[0]
-    df = df.drop(df.index[0])
-    df.columns.name = None
-    df.index.name = "sample_id"
-    return df
+    # Assign every feature a row in the count table in sorted order
+    feature_idx, feature_ids = pd.factorize(features, sort=True)
+
+    # Build a sparse feature x sample matrix from the triples. Counts of features
+    # that occur more than once in a sample are added up when converting to CSR
+    data = coo_matrix(
+        (counts, (feature_idx, sample_idx)), shape=(len(feature_ids), len(samples))
+    ).tocsr()
+
+    return biom.Table(data, observation_ids=list(feature_ids), sample_ids=samples)
 
 
 def colorify(string: str):
     return "%s%s%s" % ("\033[1;32m", string, "\033[0m")
 
 
-def copy_files(file_paths: list, *dst_path_components):
+def link_or_copy(src: str, dst: str) -> str:
+    """
+    Creates dst as a hard link to src. If that isn't possible on the same
+    filesystem, for example because the file reached the maximum number of links or
+    hard links to it aren't permitted, dst is created as a reflink on filesystems that
+    support it. Reflinks can't cross filesystems either, so files on different
+    filesystems are copied.
+
+    Args:
+        src (str): Path to the source file.
+        dst (str): Path to the destination file.
+
+    Returns:
+        str: The strategy that was used, "hardlink", "reflink" or "copy".
+    """
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except FileExistsError:
+        raise
+    except OSError:
+        pass
+
+    try:
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        return "reflink"
+    except OSError:
+        # Remove the empty destination file if the clone failed
+        if os.path.exists(dst):
+            os.remove(dst)
+
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def copy_files(file_paths: list, *dst_path_components) -> Counter:
     """
     Creates a destination file path out of the *dst_path_components. Then creates
     the directory for the destination file path if it doesn't exist already and
-    finally copies the file from source path to destination path.
+    finally links or copies the file from source path to destination path with
+    link_or_copy.
 
     Args:
         file_paths (list): A list of source file paths to be copied.
         *dst_path_components: Variable number of arguments representing destination
         path components that will be joined together to form the destination file
         path.
+
+    Returns:
+        Counter: Number of files per strategy that was used to create them.
     """
+    strategies = Counter()
     for src in file_paths:
         # Construct destination file path with destination file path components
         dst = os.path.join(*dst_path_components, os.path.basename(src))
@@ -163,5 +399,7 @@ def copy_files(file_paths: list, *dst_path_components):
         # Create destination directory if it not already exists
         os.makedirs(os.path.dirname(dst), exist_ok=True)
 
-        # Copy file from source to destination
-        duplicate(src, dst)
+        # Link or copy file from source to destination
+        strategies[link_or_copy(src, dst)] += 1
+
+    return strategies
@@ -19,6 +19,7 @@ from qiime2.core.type import (
     Bool,
     Choices,
     Collection,
+    Float,
     Int,
     List,
     Properties,
@@ -29,8 +30,10 @@ from qiime2.plugin import Citations, Plugin
 
 from q2_rgi import __version__
 from q2_rgi.card.database import fetch_card_db
+from q2_rgi.card.filter import filter_mags_annotations
 from q2_rgi.card.get_gene_lengths import get_gene_lengths
 from q2_rgi.card.heatmap import heatmap
+from q2_rgi.card.index import build_card_index
 from q2_rgi.card.kmer import (
     _kmer_query_mags,
     _kmer_query_reads,
@@ -57,11 +60,16 @@ from q2_rgi.types import (
     CARDDatabase,
     CARDDatabaseDirectoryFormat,
     CARDDatabaseFormat,
+    CARDFetchMetadataFormat,
 )
 from q2_rgi.types._format import (
+    CARDAlignerIndexDirectoryFormat,
+    CARDAlignerIndexFileFormat,
+    CARDAlignerIndexMetadataFormat,
     CARDAlleleAnnotationDirectoryFormat,
     CARDAlleleAnnotationFormat,
     CARDAnnotationDirectoryFormat,
+    CARDAnnotationSettingsFormat,
     CARDAnnotationStatsFormat,
     CARDGeneAnnotationDirectoryFormat,
     CARDGeneAnnotationFormat,
@@ -80,6 +88,7 @@ from q2_rgi.types._format import (
     GapDNAFASTAFormat,
 )
 from q2_rgi.types._type import (
+    CARDAlignerIndex,
     CARDAlleleAnnotation,
     CARDAnnotation,
     CARDGeneAnnotation,
@@ -103,14 +112,28 @@ plugin = Plugin(
 )
 plugin.methods.register_function(
     function=fetch_card_db,
-    inputs={},
+    inputs={
+        "previous_card_db": CARDDatabase,
+        "previous_61_mer_db": CARDKmerDatabase,
+        "previous_15_mer_db": CARDKmerDatabase,
+    },
     parameters={},
     outputs=[
         ("card_db", CARDDatabase),
         ("61_mer_db", CARDKmerDatabase),
         ("15_mer_db", CARDKmerDatabase),
     ],
-    input_descriptions={},
+    input_descriptions={
+        "previous_card_db": "Previously fetched CARD database. If provided, the CARD "
+        "archive is only downloaded and preprocessed if it changed on the server "
+        "and files of the previous database are reused otherwise.",
+        "previous_61_mer_db": "Previously fetched 61-mer database. WildCARD data is "
+        "only reused if the previous CARD, 61-mer and 15-mer databases are all "
+        "provided.",
+        "previous_15_mer_db": "Previously fetched 15-mer database. WildCARD data is "
+        "only reused if the previous CARD, 61-mer and 15-mer databases are all "
+        "provided.",
+    },
     parameter_descriptions={},
     output_descriptions={
         "card_db": "CARD and WildCARD database of resistance genes, their products and "
@@ -123,13 +146,19 @@ plugin.methods.register_function(
         "plasmids, or promiscuous plasmids.",
     },
     name="Download CARD and WildCARD data.",
-    description="Download the latest version of the CARD and WildCARD databases.",
+    description="Download the latest version of the CARD and WildCARD databases. "
+    "If previously fetched databases are provided, only archives that changed on "
+    "the server are downloaded and preprocessed again.",
     citations=[citations["alcock_card_2023"]],
 )
 
 plugin.methods.register_function(
     function=annotate_mags_card,
-    inputs={"mag": SampleData[MAGs], "card_db": CARDDatabase},
+    inputs={
+        "mag": SampleData[MAGs],
+        "card_db": CARDDatabase,
+        "card_index": CARDAlignerIndex,
+    },
     parameters={
         "alignment_tool": Str % Choices(["BLAST", "DIAMOND"]),
         "split_prodigal_jobs": Bool,
@@ -137,6 +166,8 @@ plugin.methods.register_function(
         "include_nudge": Bool,
         "low_quality": Bool,
         "threads": Int % Range(0, None, inclusive_start=False),
+        "parallel_bins": Int % Range(0, None, inclusive_start=False),
+        "batch_size_bp": Int % Range(0, None),
     },
     outputs=[
         ("amr_annotations", SampleData[CARDAnnotation]),
@@ -145,6 +176,9 @@ plugin.methods.register_function(
     input_descriptions={
         "mag": "MAGs to be annotated with CARD.",
         "card_db": "CARD Database.",
+        "card_index": "CARD aligner index built with build-card-index from the same "
+        "CARD database for the same alignment tool. If provided, RGI doesn't build "
+        "the index of the alignment tool.",
     },
     parameter_descriptions={
         "alignment_tool": "Specify alignment tool BLAST or DIAMOND.",
@@ -153,7 +187,15 @@ plugin.methods.register_function(
         "include_loose": "Include loose hits in addition to strict and perfect hits.",
         "include_nudge": "Include hits nudged from loose to strict hits.",
         "low_quality": "Use for short contigs to predict partial genes.",
-        "threads": "Number of threads (CPUs) to use in the BLAST search.",
+        "threads": "Total number of threads (CPUs) to use in the BLAST or DIAMOND "
+        "search. The threads are split evenly between the bins that are annotated "
+        "at the same time.",
+        "parallel_bins": "Number of bins (or batches) to annotate at the same time. "
+        "Capped by the number of threads.",
+        "batch_size_bp": "Pack bins into batches of about this number of bases "
+        "that are annotated with one RGI run each, which saves the fixed cost of "
+        "every run for small bins. The annotations are split back into the bins. "
+        "Requires low-quality. 0 annotates every bin on its own.",
     },
     output_descriptions={
         "amr_annotations": "AMR annotation as .txt and .json file.",
@@ -164,11 +206,86 @@ plugin.methods.register_function(
     citations=[citations["alcock_card_2023"]],
 )
 
+plugin.methods.register_function(
+    function=filter_mags_annotations,
+    inputs={"amr_annotations": SampleData[CARDAnnotation]},
+    parameters={
+        "include_loose": Bool,
+        "include_nudge": Bool,
+        "min_identity": Float % Range(0, 100, inclusive_end=True),
+        "min_coverage": Float % Range(0, None),
+    },
+    outputs=[
+        ("filtered_annotations", SampleData[CARDAnnotation]),
+        ("feature_table", FeatureTable[Frequency]),
+    ],
+    input_descriptions={
+        "amr_annotations": "AMR annotations of MAGs created by annotate-mags-card "
+        "with include-loose, so that they contain all hits.",
+    },
+    parameter_descriptions={
+        "include_loose": "Include loose hits in addition to strict and perfect hits.",
+        "include_nudge": "Include hits nudged from loose to strict hits. Loose hits "
+        "of protein homolog models with at least 95% identity are nudged, hits that "
+        "were nudged before are reverted to loose hits if not set.",
+        "min_identity": "Minimum percent identity of a hit. Applied to the best hit "
+        "of every ORF in the TXT output and to every hit in the JSON output.",
+        "min_coverage": "Minimum percentage length of the reference sequence that is "
+        "covered by a hit. Applied like min-identity.",
+    },
+    output_descriptions={
+        "filtered_annotations": "AMR annotations that meet the criteria as .txt and "
+        ".json file.",
+        "feature_table": "Frequency table of ARGs in all samples.",
+    },
+    name="Filter MAG annotations with new criteria.",
+    description="Apply new loose, nudge, identity and coverage criteria to existing "
+    "MAG annotations without running RGI again.",
+    citations=[citations["alcock_card_2023"]],
+)
+
+plugin.methods.register_function(
+    function=build_card_index,
+    inputs={"card_db": CARDDatabase},
+    parameters={
+        "aligner": Str % Choices("kma", "bowtie2", "bwa", "BLAST", "DIAMOND"),
+        "include_wildcard": Bool,
+        "include_other_models": Bool,
+        "threads": Int % Range(0, None, inclusive_start=False),
+    },
+    outputs=[("card_index", CARDAlignerIndex)],
+    input_descriptions={"card_db": "CARD Database."},
+    parameter_descriptions={
+        "aligner": "Aligner to build the index for. kma, bowtie2 and bwa are used by "
+        "annotate-reads-card, BLAST and DIAMOND by annotate-mags-card.",
+        "include_wildcard": "Include the in silico predicted allelic variants of "
+        "CARD's Resistomes & Variants data set in the index. Only for kma, bowtie2 "
+        "and bwa. Has to match the setting of annotate-reads-card.",
+        "include_other_models": "Include protein variant models, rRNA mutation "
+        "models and protein over-expression models in the index. Only for kma, "
+        "bowtie2 and bwa. Has to match the setting of annotate-reads-card.",
+        "threads": "Number of threads (CPUs) to use.",
+    },
+    output_descriptions={
+        "card_index": "Loaded CARD database with the index of the aligner.",
+    },
+    name="Build a CARD aligner index.",
+    description="Load the CARD database and build the index of an aligner once, so "
+    "that annotate-reads-card and annotate-mags-card don't have to build it in every "
+    "run or partition.",
+    citations=[citations["alcock_card_2023"]],
+)
+
 plugin.pipelines.register_function(
     function=annotate_reads_card,
     inputs={
         "reads": SampleData[PairedEndSequencesWithQuality | SequencesWithQuality],
         "card_db": CARDDatabase,
+        "card_index": CARDAlignerIndex,
+        "existing_allele_annotation": SampleData[CARDAlleleAnnotation],
+        "existing_gene_annotation": SampleData[CARDGeneAnnotation],
+        "existing_allele_table": FeatureTable[Frequency],
+        "existing_gene_table": FeatureTable[Frequency],
     },
     parameters={
         "aligner": Str % Choices("kma", "bowtie2", "bwa"),
@@ -176,6 +293,7 @@ plugin.pipelines.register_function(
         "include_wildcard": Bool,
         "include_other_models": Bool,
         "num_partitions": Int % Range(0, None, inclusive_start=False),
+        "parallel_samples": Int % Range(0, None, inclusive_start=False),
     },
     outputs=[
         ("amr_allele_annotation", SampleData[CARDAlleleAnnotation]),
@@ -186,10 +304,21 @@ plugin.pipelines.register_function(
     input_descriptions={
         "reads": "Paired or single end reads.",
         "card_db": "CARD Database.",
+        "card_index": "CARD aligner index built with build-card-index from the same "
+        "CARD database with the same aligner, include-wildcard and "
+        "include-other-models settings. If provided, RGI doesn't build the index "
+        "of the aligner.",
+        "existing_allele_annotation": "Allele annotations of an earlier run of "
+        "annotate-reads-card. Only samples that are not part of it are annotated and "
+        "the new results are merged into the existing ones. The earlier run must have "
+        "used the same CARD version and settings.",
+        "existing_gene_annotation": "Gene annotations of the same earlier run.",
+        "existing_allele_table": "Allele feature table of the same earlier run.",
+        "existing_gene_table": "Gene feature table of the same earlier run.",
     },
     parameter_descriptions={
         "aligner": "Specify alignment tool.",
-        "threads": "Number of threads (CPUs) to use.",
+        "threads": "Total number of threads (CPUs) to use.",
         "include_wildcard": "Additionally align reads to the in silico predicted "
         "allelic variants available in CARD's Resistomes & Variants"
         " data set. This is highly recommended for non-clinical "
@@ -206,6 +335,10 @@ plugin.pipelines.register_function(
         "but RGI as of yet does not perform this comparison. "
         "Use these results with caution.",
         "num_partitions": "Number of partitions that should run in parallel.",
+        "parallel_samples": "Number of samples to annotate at the same time within "
+        "a partition. The threads are split evenly between them. By default it is "
+        "chosen so that every sample gets at most 8 threads, as the aligners scale "
+        "poorly beyond that.",
     },
     output_descriptions={
         "amr_allele_annotation": "AMR annotation mapped on alleles.",
@@ -225,12 +358,14 @@ plugin.methods.register_function(
     inputs={
         "reads": SampleData[PairedEndSequencesWithQuality | SequencesWithQuality],
         "card_db": CARDDatabase,
+        "card_index": CARDAlignerIndex,
     },
     parameters={
         "aligner": Str % Choices("kma", "bowtie2", "bwa"),
         "threads": Int % Range(0, None, inclusive_start=False),
         "include_wildcard": Bool,
         "include_other_models": Bool,
+        "parallel_samples": Int % Range(0, None, inclusive_start=False),
     },
     outputs=[
         ("amr_allele_annotation", SampleData[CARDAlleleAnnotation]),
@@ -241,10 +376,14 @@ plugin.methods.register_function(
     input_descriptions={
         "reads": "Paired or single end reads.",
         "card_db": "CARD Database.",
+        "card_index": "CARD aligner index built with build-card-index from the same "
+        "CARD database with the same aligner, include-wildcard and "
+        "include-other-models settings. If provided, RGI doesn't build the index "
+        "of the aligner.",
     },
     parameter_descriptions={
         "aligner": "Specify alignment tool.",
-        "threads": "Number of threads (CPUs) to use.",
+        "threads": "Total number of threads (CPUs) to use.",
         "include_wildcard": "Additionally align reads to the in silico predicted "
         "allelic variants available in CARD's Resistomes & Variants"
         " data set. This is highly recommended for non-clinical "
@@ -260,6 +399,10 @@ plugin.methods.register_function(
         "resistance from antibiotic susceptible alleles, "
         "but RGI as of yet does not perform this comparison. "
         "Use these results with caution.",
+        "parallel_samples": "Number of samples to annotate at the same time. The "
+        "threads are split evenly between them. By default it is chosen so that "
+        "every sample gets at most 8 threads, as the aligners scale poorly beyond "
+        "that.",
     },
     output_descriptions={
         "amr_allele_annotation": "AMR annotation mapped on alleles.",
@@ -307,6 +450,7 @@ plugin.pipelines.register_function(
         "minimum": Int % Range(0, None, inclusive_start=False),
         "threads": Int % Range(0, None, inclusive_start=False),
         "num_partitions": Int % Range(0, None, inclusive_start=False),
+        "partition_balance": Str % Choices("count", "size"),
     },
     outputs=[
         ("mags_kmer_analysis", SampleData[CARDMAGsKmerAnalysis]),
@@ -324,6 +468,9 @@ plugin.pipelines.register_function(
         "classification to be made.",
         "threads": "Number of threads (CPUs) to use.",
         "num_partitions": "Number of partitions that should run in parallel.",
+        "partition_balance": "How annotations are assigned to partitions. 'size' "
+        "gives every partition about the same total file size, 'count' the same "
+        "number of annotations.",
     },
     output_descriptions={
         "mags_kmer_analysis": "K-mer analysis as JSON file and TXT summary.",
@@ -381,6 +528,7 @@ plugin.pipelines.register_function(
         "minimum": Int % Range(0, None, inclusive_start=False),
         "threads": Int % Range(0, None, inclusive_start=False),
         "num_partitions": Int % Range(0, None, inclusive_start=False),
+        "partition_balance": Str % Choices("count", "size"),
     },
     outputs=[
         ("reads_allele_kmer_analysis", SampleData[CARDReadsAlleleKmerAnalysis]),
@@ -399,6 +547,9 @@ plugin.pipelines.register_function(
         "classification to be made.",
         "threads": "Number of threads (CPUs) to use.",
         "num_partitions": "Number of partitions that should run in parallel.",
+        "partition_balance": "How annotations are assigned to partitions. 'size' "
+        "gives every partition about the same total file size, 'count' the same "
+        "number of annotations.",
     },
     output_descriptions={
         "reads_allele_kmer_analysis": "K-mer analysis for mapped alleles as JSON file "
@@ -536,12 +687,19 @@ plugin.methods.register_function(
 plugin.methods.register_function(
     function=partition_mags_annotations,
     inputs={"annotations": SampleData[CARDAnnotation]},
-    parameters={"num_partitions": Int % Range(1, None)},
+    parameters={
+        "num_partitions": Int % Range(1, None),
+        "balance": Str % Choices("count", "size"),
+    },
     outputs={"partitioned_annotations": Collection[SampleData[CARDAnnotation]]},
     input_descriptions={"annotations": "The annotations to partition."},
     parameter_descriptions={
         "num_partitions": "The number of partitions to split the annotations "
-        "into. Defaults to partitioning into individual annotations."
+        "into. Defaults to partitioning into individual annotations.",
+        "balance": "How annotations are assigned to partitions. 'count' splits the "
+        "sorted annotations into partitions with the same number of annotations. "
+        "'size' assigns them so that every partition has about the same total "
+        "file size, which evens out the runtime of the partitions.",
     },
     output_descriptions={"partitioned_annotations": "Partitioned annotations."},
     name="Partition annotations",
@@ -552,12 +710,19 @@ plugin.methods.register_function(
 plugin.methods.register_function(
     function=partition_reads_allele_annotations,
     inputs={"annotations": SampleData[CARDAlleleAnnotation]},
-    parameters={"num_partitions": Int % Range(1, None)},
+    parameters={
+        "num_partitions": Int % Range(1, None),
+        "balance": Str % Choices("count", "size"),
+    },
     outputs={"partitioned_annotations": Collection[SampleData[CARDAlleleAnnotation]]},
     input_descriptions={"annotations": "The annotations to partition."},
     parameter_descriptions={
         "num_partitions": "The number of partitions to split the annotations "
-        "into. Defaults to partitioning into individual annotations."
+        "into. Defaults to partitioning into individual annotations.",
+        "balance": "How annotations are assigned to partitions. 'count' splits the "
+        "sorted annotations into partitions with the same number of annotations. "
+        "'size' assigns them so that every partition has about the same total "
+        "file size, which evens out the runtime of the partitions.",
     },
     output_descriptions={"partitioned_annotations": "Partitioned annotations."},
     name="Partition annotations",
@@ -568,12 +733,19 @@ plugin.methods.register_function(
 plugin.methods.register_function(
     function=partition_reads_gene_annotations,
     inputs={"annotations": SampleData[CARDGeneAnnotation]},
-    parameters={"num_partitions": Int % Range(1, None)},
+    parameters={
+        "num_partitions": Int % Range(1, None),
+        "balance": Str % Choices("count", "size"),
+    },
     outputs={"partitioned_annotations": Collection[SampleData[CARDGeneAnnotation]]},
     input_descriptions={"annotations": "The annotations to partition."},
     parameter_descriptions={
         "num_partitions": "The number of partitions to split the annotations"
-        " into. Defaults to partitioning into individual annotations."
+        " into. Defaults to partitioning into individual annotations.",
+        "balance": "How annotations are assigned to partitions. 'count' splits the "
+        "sorted annotations into partitions with the same number of annotations. "
+        "'size' assigns them so that every partition has about the same total "
+        "file size, which evens out the runtime of the partitions.",
     },
     output_descriptions={"partitioned_annotations": "Partitioned annotations."},
     name="Partition annotations",
@@ -666,12 +838,19 @@ plugin.methods.register_function(
 plugin.methods.register_function(
     function=partition_mags_annotations,
     inputs={"annotations": SampleData[CARDAnnotation]},
-    parameters={"num_partitions": Int % Range(1, None)},
+    parameters={
+        "num_partitions": Int % Range(1, None),
+        "balance": Str % Choices("count", "size"),
+    },
     outputs={"partitioned_annotations": Collection[SampleData[CARDAnnotation]]},
     input_descriptions={"annotations": "The annotations to partition."},
     parameter_descriptions={
         "num_partitions": "The number of partitions to split the annotations "
-        "into. Defaults to partitioning into individual annotations."
+        "into. Defaults to partitioning into individual annotations.",
+        "balance": "How annotations are assigned to partitions. 'count' splits the "
+        "sorted annotations into partitions with the same number of annotations. "
+        "'size' assigns them so that every partition has about the same total "
+        "file size, which evens out the runtime of the partitions.",
     },
     output_descriptions={"partitioned_annotations": "Partitioned annotations."},
     name="Partition annotations",
@@ -682,12 +861,19 @@ plugin.methods.register_function(
 plugin.methods.register_function(
     function=partition_reads_allele_annotations,
     inputs={"annotations": SampleData[CARDAlleleAnnotation]},
-    parameters={"num_partitions": Int % Range(1, None)},
+    parameters={
+        "num_partitions": Int % Range(1, None),
+        "balance": Str % Choices("count", "size"),
+    },
     outputs={"partitioned_annotations": Collection[SampleData[CARDAlleleAnnotation]]},
     input_descriptions={"annotations": "The annotations to partition."},
     parameter_descriptions={
         "num_partitions": "The number of partitions to split the annotations "
-        "into. Defaults to partitioning into individual annotations."
+        "into. Defaults to partitioning into individual annotations.",
+        "balance": "How annotations are assigned to partitions. 'count' splits the "
+        "sorted annotations into partitions with the same number of annotations. "
+        "'size' assigns them so that every partition has about the same total "
+        "file size, which evens out the runtime of the partitions.",
     },
     output_descriptions={"partitioned_annotations": "partitioned annotations"},
     name="Partition annotations",
@@ -698,12 +884,19 @@ plugin.methods.register_function(
 plugin.methods.register_function(
     function=partition_reads_gene_annotations,
     inputs={"annotations": SampleData[CARDGeneAnnotation]},
-    parameters={"num_partitions": Int % Range(1, None)},
+    parameters={
+        "num_partitions": Int % Range(1, None),
+        "balance": Str % Choices("count", "size"),
+    },
     outputs={"partitioned_annotations": Collection[SampleData[CARDGeneAnnotation]]},
     input_descriptions={"annotations": "The annotations to partition."},
     parameter_descriptions={
         "num_partitions": "The number of partitions to split the annotations"
-        " into. Defaults to partitioning into individual annotations."
+        " into. Defaults to partitioning into individual annotations.",
+        "balance": "How annotations are assigned to partitions. 'count' splits the "
+        "sorted annotations into partitions with the same number of annotations. "
+        "'size' assigns them so that every partition has about the same total "
+        "file size, which evens out the runtime of the partitions.",
     },
     output_descriptions={"partitioned_annotations": "partitioned annotations"},
     name="Partition annotations",
@@ -722,6 +915,7 @@ plugin.pipelines.register_function(
         "minimum": Int % Range(0, None, inclusive_start=False),
         "threads": Int % Range(0, None, inclusive_start=False),
         "num_partitions": Int % Range(0, None, inclusive_start=False),
+        "partition_balance": Str % Choices("count", "size"),
     },
     outputs=[
         ("mags_kmer_analysis", SampleData[CARDMAGsKmerAnalysis]),
@@ -739,6 +933,9 @@ plugin.pipelines.register_function(
         "classification to be made.",
         "threads": "Number of threads (CPUs) to use.",
         "num_partitions": "Number of partitions that should run in parallel.",
+        "partition_balance": "How annotations are assigned to partitions. 'size' "
+        "gives every partition about the same total file size, 'count' the same "
+        "number of annotations.",
     },
     output_descriptions={
         "mags_kmer_analysis": "K-mer analysis as JSON file and TXT summary.",
@@ -796,6 +993,7 @@ plugin.pipelines.register_function(
         "minimum": Int % Range(0, None, inclusive_start=False),
         "threads": Int % Range(0, None, inclusive_start=False),
         "num_partitions": Int % Range(0, None, inclusive_start=False),
+        "partition_balance": Str % Choices("count", "size"),
     },
     outputs=[
         ("reads_allele_kmer_analysis", SampleData[CARDReadsAlleleKmerAnalysis]),
@@ -814,6 +1012,9 @@ plugin.pipelines.register_function(
         "classification to be made.",
         "threads": "Number of threads (CPUs) to use.",
         "num_partitions": "Number of partitions that should run in parallel.",
+        "partition_balance": "How annotations are assigned to partitions. 'size' "
+        "gives every partition about the same total file size, 'count' the same "
+        "number of annotations.",
     },
     output_descriptions={
         "reads_allele_kmer_analysis": "K-mer analysis for mapped alleles as JSON file "
@@ -922,6 +1123,7 @@ plugin.methods.register_function(
 plugin.register_semantic_types(
     CARDDatabase,
     CARDKmerDatabase,
+    CARDAlignerIndex,
     CARDAnnotation,
     CARDAlleleAnnotation,
     CARDGeneAnnotation,
@@ -936,6 +1138,9 @@ plugin.register_semantic_type_to_format(
 plugin.register_semantic_type_to_format(
     CARDDatabase, artifact_format=CARDDatabaseDirectoryFormat
 )
+plugin.register_semantic_type_to_format(
+    CARDAlignerIndex, artifact_format=CARDAlignerIndexDirectoryFormat
+)
 plugin.register_semantic_type_to_format(
     SampleData[CARDAnnotation], artifact_format=CARDAnnotationDirectoryFormat
 )
@@ -970,9 +1175,11 @@ plugin.register_formats(
     CARDAnnotationDirectoryFormat,
     CARDDatabaseFormat,
     CARDDatabaseDirectoryFormat,
+    CARDFetchMetadataFormat,
     CARDAlleleAnnotationFormat,
     CARDGeneAnnotationFormat,
     CARDAnnotationStatsFormat,
+    CARDAnnotationSettingsFormat,
     CARDAlleleAnnotationDirectoryFormat,
     CARDGeneAnnotationDirectoryFormat,
     CARDMAGsKmerAnalysisFormat,
@@ -982,6 +1189,9 @@ plugin.register_formats(
     CARDReadsKmerAnalysisJSONFormat,
     CARDReadsGeneKmerAnalysisDirectoryFormat,
     CARDReadsAlleleKmerAnalysisDirectoryFormat,
+    CARDAlignerIndexMetadataFormat,
+    CARDAlignerIndexFileFormat,
+    CARDAlignerIndexDirectoryFormat,
 )
 
 importlib.import_module("q2_rgi.types._transformer")
@@ -6,14 +6,19 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 from ._format import (
+    CARDAlignerIndexDirectoryFormat,
+    CARDAlignerIndexFileFormat,
+    CARDAlignerIndexMetadataFormat,
     CARDAlleleAnnotationDirectoryFormat,
     CARDAlleleAnnotationFormat,
     CARDAnnotationDirectoryFormat,
     CARDAnnotationJSONFormat,
+    CARDAnnotationSettingsFormat,
     CARDAnnotationStatsFormat,
     CARDAnnotationTXTFormat,
     CARDDatabaseDirectoryFormat,
     CARDDatabaseFormat,
+    CARDFetchMetadataFormat,
     CARDGeneAnnotationDirectoryFormat,
     CARDGeneAnnotationFormat,
     CARDKmerDatabaseDirectoryFormat,
@@ -31,6 +36,7 @@ from ._format import (
     GapDNAFASTAFormat,
 )
 from ._type import (
+    CARDAlignerIndex,
     CARDAlleleAnnotation,
     CARDAnnotation,
     CARDDatabase,
@@ -53,9 +59,11 @@ __all__ = [
     "CARDAnnotationDirectoryFormat",
     "CARDDatabaseFormat",
     "CARDDatabaseDirectoryFormat",
+    "CARDFetchMetadataFormat",
     "CARDAlleleAnnotationFormat",
     "CARDGeneAnnotationFormat",
     "CARDAnnotationStatsFormat",
+    "CARDAnnotationSettingsFormat",
     "CARDAlleleAnnotationDirectoryFormat",
     "CARDGeneAnnotationDirectoryFormat",
     "CARDMAGsKmerAnalysisFormat",
@@ -73,4 +81,8 @@ __all__ = [
     "CARDReadsGeneKmerAnalysis",
     "CARDReadsAlleleKmerAnalysis",
     "CARDMAGsKmerAnalysis",
+    "CARDAlignerIndexMetadataFormat",
+    "CARDAlignerIndexFileFormat",
+    "CARDAlignerIndexDirectoryFormat",
+    "CARDAlignerIndex",
 ]
@@ -5,10 +5,12 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import csv
+import itertools
 import json
 import os
 import re
-import warnings
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
 
 import pandas as pd
@@ -17,6 +19,142 @@ from q2_types.feature_data import DNAFASTAFormat
 from q2_types.per_sample_sequences._formats import BAMFormat, MultiDirValidationMixin
 from qiime2.plugin import ValidationError
 
+from ._util import iter_json_items, iter_json_keys
+
+# Environment variable that sets the number of threads used to validate the files of
+# multi-sample directory formats
+VALIDATION_WORKERS_ENV = "Q2_RGI_VALIDATION_WORKERS"
+
+
+class ParallelMultiDirValidationMixin(MultiDirValidationMixin):
+    """
+    Validates the files of a multi-sample directory format concurrently in a thread
+    pool instead of one at a time. DirectoryFormat.validate still collects the files,
+    checks for missing and unrecognized files and runs _validate_, only the files
+    that match a field are validated concurrently. The error of the first invalid
+    file of a field in sorted path order is raised. The number of threads is taken
+    from the environment variable Q2_RGI_VALIDATION_WORKERS or the
+    validation_workers class attribute and defaults to the ThreadPoolExecutor
+    default.
+    """
+
+    validation_workers = None
+
+    def validate(self, level="max"):
+        # DirectoryFormat.validate validates the files of every field with the
+        # _validate_members method of the bound field. While it runs, the fields are
+        # shadowed by bound fields that validate their files concurrently
+        workers = self._validation_workers()
+        for field in self._fields:
+            self.__dict__[field] = _ParallelBoundFile(
+                getattr(self, field), self, workers
+            )
+        try:
+            super().validate(level)
+        finally:
+            for field in self._fields:
+                del self.__dict__[field]
+
+    def _validation_workers(self):
+        workers = os.environ.get(VALIDATION_WORKERS_ENV)
+        if not workers:
+            return self.validation_workers
+
+        try:
+            workers = int(workers)
+        except ValueError:
+            workers = 0
+        if workers < 1:
+            raise ValueError(
+                f"{VALIDATION_WORKERS_ENV} has to be a positive integer, but it is set "
+                f"to {os.environ[VALIDATION_WORKERS_ENV]!r}."
+            )
+        return workers
+
+
+class _ParallelBoundFile:
+    # Bound field of a directory format that validates the files matching it
+    # concurrently. All other attributes are taken from the bound field
+    def __init__(self, bound, directory_format, workers):
+        self._bound = bound
+        self._directory_format = directory_format
+        self._workers = workers
+
+    def __getattr__(self, name):
+        return getattr(self._bound, name)
+
+    def _validate_members(self, collected_paths, level):
+        root = self._directory_format.path
+        paths = sorted(
+            path
+            for path in collected_paths
+            if re.fullmatch(self.pathspec, str(path.relative_to(root)))
+        )
+        for path in paths:
+            if collected_paths[path]:
+                raise ValueError(
+                    f"{path!r} was already validated by another field, the "
+                    "pathspecs (regexes) must overlap."
+                )
+            collected_paths[path] = True
+
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            for error in executor.map(
+                lambda path: self._validate_member(path, level), paths
+            ):
+                if error is not None:
+                    raise error
+
+        if not paths and not self.optional:
+            raise ValidationError(
+                "Missing one or more files for "
+                f"{self._directory_format.__class__.__name__}: {self.pathspec!r}"
+            )
+
+    def _validate_member(self, path, level):
+        try:
+            self.format(path, mode="r").validate(level)
+        except ValidationError as e:
+            return e
+
+
+class RGITableFormat(model.TextFileFormat):
+    """
+    Base class for tab separated RGI output tables. The header is read with a CSV
+    reader instead of parsing the whole table and has to contain all columns in
+    header_exp. At the max level, the first rows are checked for having no more
+    fields than the header. RGI omits empty trailing fields, so rows can be shorter.
+    """
+
+    header_exp = []
+    header_error = ""
+
+    def _validate(self, n_records=None):
+        with open(str(self), newline="") as file:
+            # RGI doesn't quote fields, so quotes in descriptions are kept as they are
+            reader = csv.reader(file, delimiter="\t", quoting=csv.QUOTE_NONE)
+            header_obs = next(reader, [])
+
+            if not set(self.header_exp).issubset(header_obs):
+                raise ValidationError(
+                    self.header_error
+                    + ", ".join(self.header_exp)
+                    + ".\n\nFound instead: "
+                    + ", ".join(header_obs)
+                )
+
+            for line_number, row in enumerate(
+                itertools.islice(reader, n_records), start=2
+            ):
+                if len(row) > len(header_obs):
+                    raise ValidationError(
+                        f"Line {line_number} has {len(row)} fields, but the header "
+                        f"only has {len(header_obs)}."
+                    )
+
+    def _validate_(self, level):
+        self._validate(n_records={"min": 0, "max": 1000}[level])
+
 
 class CARDDatabaseFormat(model.TextFileFormat):
     def _validate(self, n_records=None):
@@ -39,15 +177,28 @@ class CARDDatabaseFormat(model.TextFileFormat):
         ]
         header_exp_2 = copy(header_exp)
         header_exp_2.pop(10)
-        # Bug in pandas when reading mix of number-like and strings in the index
-        warnings.filterwarnings(
-            "ignore",
-            message="The behavior of 'to_datetime' with 'unit' when parsing strings is",
-            category=FutureWarning,
-        )
-        card_df = pd.read_json(str(self)).transpose()
-        header_obs = list(card_df.columns)
-        if header_obs != header_exp and header_obs != header_exp_2:
+
+        # Collect the keys of the model records and the comment in the order in which
+        # they first appear, streaming the file instead of reading it as a whole
+        header_obs = {}
+        try:
+            for i, (_, record) in enumerate(iter_json_items(str(self))):
+                if n_records is not None and i >= n_records:
+                    break
+                if isinstance(record, dict):
+                    header_obs.update(dict.fromkeys(record))
+        except ValueError as e:
+            raise ValidationError(f"File is not a valid JSON file: {e}")
+        header_obs = list(header_obs)
+
+        # All records have to be read to know all keys. If only some were read, their
+        # keys have to be among the expected ones
+        if n_records is None:
+            valid = header_obs in (header_exp, header_exp_2)
+        else:
+            valid = bool(header_obs) and set(header_obs).issubset(header_exp)
+
+        if not valid:
             raise ValidationError(
                 "Header line does not match CARDDatabase format. Must consist of "
                 "the following values: "
@@ -57,7 +208,7 @@ class CARDDatabaseFormat(model.TextFileFormat):
             )
 
     def _validate_(self, level):
-        self._validate()
+        self._validate(n_records={"min": 100, "max": None}[level])
 
 
 class CARDWildcardIndexFormat(model.TextFileFormat):
@@ -101,6 +252,26 @@ class GapDNAFASTAFormat(DNAFASTAFormat):
         self.alphabet += "-"
 
 
+class CARDFetchMetadataFormat(model.TextFileFormat):
+    def _validate(self, n_records=None):
+        try:
+            with open(str(self)) as f:
+                metadata = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValidationError(f"File is not a valid JSON file: {e}")
+
+        if not isinstance(metadata, dict) or not all(
+            isinstance(value, str) for value in metadata.values()
+        ):
+            raise ValidationError(
+                "Fetch metadata must map the URLs of the CARD archives to their ETag "
+                "or Last-Modified date and the k-mer database files to their sizes."
+            )
+
+    def _validate_(self, level):
+        self._validate()
+
+
 class CARDDatabaseDirectoryFormat(model.DirectoryFormat):
     card_fasta = model.File(
         r"card_database_v\d+\.\d+\.\d+.fasta", format=DNAFASTAFormat
@@ -129,33 +300,83 @@ class CARDDatabaseDirectoryFormat(model.DirectoryFormat):
         "nucleotide_fasta_rRNA_gene_variant_model_variants.fasta",
         format=GapDNAFASTAFormat,
     )
+    fetch_metadata = model.File(
+        "fetch_metadata.json", format=CARDFetchMetadataFormat, optional=True
+    )
+
+
+class CARDAlignerIndexMetadataFormat(model.TextFileFormat):
+    def _validate(self, n_records=None):
+        try:
+            with open(str(self)) as f:
+                metadata = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValidationError(f"File is not a valid JSON file: {e}")
+
+        keys_exp = {
+            "card_version",
+            "aligner",
+            "include_wildcard",
+            "include_other_models",
+        }
+        if not isinstance(metadata, dict) or not keys_exp.issubset(metadata):
+            raise ValidationError(
+                "Index metadata must contain the CARD version, aligner and settings "
+                f"the index was built with: {', '.join(sorted(keys_exp))}."
+            )
+
+    def _validate_(self, level):
+        self._validate()
+
+
+class CARDAlignerIndexFileFormat(model.BinaryFileFormat):
+    # Files of the local RGI database and aligner indices are created by RGI and
+    # the aligners and are not validated
+    def _validate_(self, level):
+        pass
+
+
+class CARDAlignerIndexDirectoryFormat(model.DirectoryFormat):
+    metadata = model.File("index_metadata.json", format=CARDAlignerIndexMetadataFormat)
+    local_db = model.FileCollection(r"localDB/.+", format=CARDAlignerIndexFileFormat)
+
+    @local_db.set_path_maker
+    def local_db_path_maker(self, relpath):
+        return f"localDB/{relpath}"
 
 
 class CARDKmerTXTFormat(model.TextFileFormat):
     def _validate(self, n_records=None):
-        pattern = r"^[AGCT]+\t\d+$"
+        pattern = re.compile(r"^[AGCT]+\t\d+$")
 
+        # Read the file line by line, so that only the validated lines are read
         with open(str(self), "r") as file:
-            lines = file.readlines()[:10]
-            for line in lines:
-                if not re.match(pattern, line.strip()):
+            for line in itertools.islice(file, n_records):
+                if not pattern.match(line.strip()):
                     raise ValidationError(
                         "The provided file is not the correct format. All lines must "
                         r"match the regex pattern r'^[AGCT]+\t\d+$'."
                     )
 
     def _validate_(self, level):
-        self._validate()
+        self._validate(n_records={"min": 10, "max": None}[level])
 
 
 class CARDKmerJSONFormat(model.TextFileFormat):
     def _validate(self, n_records=None):
         keys_exp = ["p", "c", "b", "s", "g"]
-        with open(str(self)) as json_file:
-            kmer_dict = json.load(json_file)
-        keys_obs = list(kmer_dict.keys())
 
-        if keys_obs != keys_exp:
+        # Scan the top-level keys without decoding the large k-mer dictionaries
+        keys_obs = []
+        try:
+            for key in iter_json_keys(str(self)):
+                keys_obs.append(key)
+                if n_records is not None and len(keys_obs) >= n_records:
+                    break
+        except ValueError as e:
+            raise ValidationError(f"File is not a valid JSON file: {e}")
+
+        if keys_obs != keys_exp[:n_records]:
             raise ValidationError(
                 "Keys do not match KMERJSON format. Must consist of "
                 "the following values: "
@@ -165,7 +386,9 @@ class CARDKmerJSONFormat(model.TextFileFormat):
             )
 
     def _validate_(self, level):
-        self._validate()
+        # Only the first key is checked at the min level, as reaching the following
+        # keys means scanning through the whole k-mer dictionary before them
+        self._validate(n_records={"min": 1, "max": None}[level])
 
 
 class CARDKmerDatabaseDirectoryFormat(model.DirectoryFormat):
@@ -173,49 +396,38 @@ class CARDKmerDatabaseDirectoryFormat(model.DirectoryFormat):
     kmer_fasta = model.File(r"all_amr_\d+mers.txt", format=CARDKmerTXTFormat)
 
 
-class CARDAnnotationTXTFormat(model.TextFileFormat):
-    def _validate(self, n_records=None):
-        header_exp = {
-            "ORF_ID",
-            "Contig",
-            "Start",
-            "Stop",
-            "Orientation",
-            "Cut_Off",
-            "Pass_Bitscore",
-            "Best_Hit_Bitscore",
-            "Best_Hit_ARO",
-            "Best_Identities",
-            "ARO",
-            "Model_type",
-            "SNPs_in_Best_Hit_ARO",
-            "Other_SNPs",
-            "Drug Class",
-            "Resistance Mechanism",
-            "AMR Gene Family",
-            "Predicted_DNA",
-            "Predicted_Protein",
-            "CARD_Protein_Sequence",
-            "Percentage Length of Reference Sequence",
-            "ID",
-            "Model_ID",
-            "Nudged",
-            "Note",
-        }
-        df = pd.read_csv(str(self), sep="\t")
-
-        header_obs = set(df.columns)
-        if not header_exp.issubset(header_obs):
-            raise ValidationError(
-                "Header line does not match CARDAnnotation format. Must at least "
-                "consist of the following values: "
-                + ", ".join(header_exp)
-                + ".\n\nFound instead: "
-                + ", ".join(header_obs)
-            )
-
-    def _validate_(self, level):
-        self._validate()
+class CARDAnnotationTXTFormat(RGITableFormat):
+    header_exp = [
+        "ORF_ID",
+        "Contig",
+        "Start",
+        "Stop",
+        "Orientation",
+        "Cut_Off",
+        "Pass_Bitscore",
+        "Best_Hit_Bitscore",
+        "Best_Hit_ARO",
+        "Best_Identities",
+        "ARO",
+        "Model_type",
+        "SNPs_in_Best_Hit_ARO",
+        "Other_SNPs",
+        "Drug Class",
+        "Resistance Mechanism",
+        "AMR Gene Family",
+        "Predicted_DNA",
+        "Predicted_Protein",
+        "CARD_Protein_Sequence",
+        "Percentage Length of Reference Sequence",
+        "ID",
+        "Model_ID",
+        "Nudged",
+        "Note",
+    ]
+    header_error = (
+        "Header line does not match CARDAnnotation format. Must at least "
+        "consist of the following values: "
+    )
 
 
 class CARDAnnotationJSONFormat(model.TextFileFormat):
@@ -249,29 +461,41 @@ class CARDAnnotationJSONFormat(model.TextFileFormat):
             "model_name",
             "orf_strand",
         ]
-        keys_obs = []
-        with open(str(self), "r") as f:
-            json_str = f.read()
-            json_data = json.loads(json_str)
-
-        for k, v in json_data.items():
-            for sub_k, sub_v in v.items():
-                keys_obs.extend(sub_v.keys())
-
-        if keys_obs and not set(keys_exp).issubset(set(keys_obs)):
+        # Stream the ORFs and collect the keys of their HSPs until all expected keys
+        # were found or n_records HSPs were read
+        keys_obs = set()
+        n_hsps = 0
+        hsps = (
+            hsp
+            for _, orf in iter_json_items(str(self))
+            if isinstance(orf, dict)
+            for hsp in orf.values()
+        )
+        try:
+            for n_hsps, hsp in enumerate(hsps, start=1):
+                if isinstance(hsp, dict):
+                    keys_obs.update(hsp)
+                if keys_obs.issuperset(keys_exp) or n_hsps == n_records:
+                    break
+        except ValueError as e:
+            raise ValidationError(f"File is not a valid JSON file: {e}")
+
+        if n_hsps and not keys_obs.issuperset(keys_exp):
             raise ValidationError(
                 "Dict keys do not match CARDAnnotation format. Must consist of "
                 "the following values: "
                 + ", ".join(keys_exp)
                 + ".\n\nFound instead: "
-                + ", ".join(set(keys_obs))
+                + ", ".join(sorted(keys_obs))
             )
 
     def _validate_(self, level):
-        self._validate()
+        self._validate(n_records={"min": 10, "max": None}[level])
 
 
-class CARDAnnotationDirectoryFormat(MultiDirValidationMixin, model.DirectoryFormat):
+class CARDAnnotationDirectoryFormat(
+    ParallelMultiDirValidationMixin, model.DirectoryFormat
+):
     json = model.FileCollection(
         r".+amr_annotation.json$", format=CARDAnnotationJSONFormat
     )
@@ -298,90 +522,68 @@ class CARDAnnotationDirectoryFormat(MultiDirValidationMixin, model.DirectoryForm
         return sample_dict
 
 
-class CARDAlleleAnnotationFormat(model.TextFileFormat):
-    def _validate(self, n_records=None):
-        header_exp = [
-            "Reference Sequence",
-            "ARO Term",
-            "ARO Accession",
-            "Reference Model Type",
-            "Reference DB",
-            "Reference Allele Source",
-            "Resistomes & Variants: Observed in Genome(s)",
-            "Resistomes & Variants: Observed in Plasmid(s)",
-            "Resistomes & Variants: Observed Pathogen(s)",
-            "Completely Mapped Reads",
-            "Mapped Reads with Flanking Sequence",
-            "All Mapped Reads",
-            "Percent Coverage",
-            "Length Coverage (bp)",
-            "Average MAPQ (Completely Mapped Reads)",
-            "Mate Pair Linkage",
-            "Reference Length",
-            "AMR Gene Family",
-            "Drug Class",
-            "Resistance Mechanism",
-        ]
-
-        df = pd.read_csv(str(self), sep="\t")
-        header_obs = list(df.columns)
-        if not set(header_exp).issubset(set(header_obs)):
-            raise ValidationError(
-                "Header line does not match CARDAlleleAnnotationFormat. Must contain"
-                "the following values: "
-                + ", ".join(header_exp)
-                + ".\n\nFound instead: "
-                + ", ".join(header_obs)
-            )
-
-    def _validate_(self, level):
-        self._validate()
-
-
-class CARDGeneAnnotationFormat(model.TextFileFormat):
-    def _validate(self, n_records=None):
-        header_exp = [
-            "ARO Term",
-            "ARO Accession",
-            "Reference Model Type",
-            "Reference DB",
-            "Alleles with Mapped Reads",
-            "Reference Allele(s) Identity to CARD Reference Protein (%)",
-            "Resistomes & Variants: Observed in Genome(s)",
-            "Resistomes & Variants: Observed in Plasmid(s)",
-            "Resistomes & Variants: Observed Pathogen(s)",
-            "Completely Mapped Reads",
-            "Mapped Reads with Flanking Sequence",
-            "All Mapped Reads",
-            "Average Percent Coverage",
-            "Average Length Coverage (bp)",
-            "Average MAPQ (Completely Mapped Reads)",
-            "Number of Mapped Baits",
-            "Number of Mapped Baits with Reads",
-            "Average Number of reads per Bait",
-            "Number of reads per Bait Coefficient of Variation (%)",
-            "Number of reads mapping to baits and mapping to complete gene",
-            "Number of reads mapping to baits and mapping to complete gene (%)",
-            "Mate Pair Linkage (# reads)",
-            "Reference Length",
-            "AMR Gene Family",
-            "Drug Class",
-            "Resistance Mechanism",
-        ]
+class CARDAlleleAnnotationFormat(RGITableFormat):
+    header_exp = [
+        "Reference Sequence",
+        "ARO Term",
+        "ARO Accession",
+        "Reference Model Type",
+        "Reference DB",
+        "Reference Allele Source",
+        "Resistomes & Variants: Observed in Genome(s)",
+        "Resistomes & Variants: Observed in Plasmid(s)",
+        "Resistomes & Variants: Observed Pathogen(s)",
+        "Completely Mapped Reads",
+        "Mapped Reads with Flanking Sequence",
+        "All Mapped Reads",
+        "Percent Coverage",
+        "Length Coverage (bp)",
+        "Average MAPQ (Completely Mapped Reads)",
+        "Mate Pair Linkage",
+        "Reference Length",
+        "AMR Gene Family",
+        "Drug Class",
+        "Resistance Mechanism",
+    ]
+    header_error = (
+        "Header line does not match CARDAlleleAnnotationFormat. Must contain"
+        "the following values: "
+    )
 
-        df = pd.read_csv(str(self), sep="\t")
-        header_obs = list(df.columns)
-        if not set(header_exp).issubset(set(header_obs)):
-            raise ValidationError(
-                "Header line does not match CARDGeneAnnotationFormat. Must contain"
-                "the following values: "
-                + ", ".join(header_exp)
-                + ".\n\nFound instead: "
-                + ", ".join(header_obs)
-            )
 
-    def _validate_(self, level):
-        self._validate()
+class CARDGeneAnnotationFormat(RGITableFormat):
+    header_exp = [
+        "ARO Term",
+        "ARO Accession",
+        "Reference Model Type",
+        "Reference DB",
+        "Alleles with Mapped Reads",
+        "Reference Allele(s) Identity to CARD Reference Protein (%)",
+        "Resistomes & Variants: Observed in Genome(s)",
+        "Resistomes & Variants: Observed in Plasmid(s)",
+        "Resistomes & Variants: Observed Pathogen(s)",
+        "Completely Mapped Reads",
+        "Mapped Reads with Flanking Sequence",
+        "All Mapped Reads",
+        "Average Percent Coverage",
+        "Average Length Coverage (bp)",
+        "Average MAPQ (Completely Mapped Reads)",
+        "Number of Mapped Baits",
+        "Number of Mapped Baits with Reads",
+        "Average Number of reads per Bait",
+        "Number of reads per Bait Coefficient of Variation (%)",
+        "Number of reads mapping to baits and mapping to complete gene",
+        "Number of reads mapping to baits and mapping to complete gene (%)",
+        "Mate Pair Linkage (# reads)",
+        "Reference Length",
+        "AMR Gene Family",
+        "Drug Class",
+        "Resistance Mechanism",
+    ]
+    header_error = (
+        "Header line does not match CARDGeneAnnotationFormat. Must contain"
+        "the following values: "
+    )
 
 
 class CARDAnnotationStatsFormat(model.TextFileFormat):
@@ -418,8 +620,33 @@ class CARDAnnotationStatsFormat(model.TextFileFormat):
         self._validate()
 
 
+class CARDAnnotationSettingsFormat(model.TextFileFormat):
+    def _validate(self, n_records=None):
+        try:
+            with open(str(self)) as f:
+                settings = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValidationError(f"File is not a valid JSON file: {e}")
+
+        keys_exp = {
+            "card_version",
+            "aligner",
+            "include_wildcard",
+            "include_other_models",
+        }
+        if not isinstance(settings, dict) or not keys_exp.issubset(settings):
+            raise ValidationError(
+                "Annotation settings must contain the CARD version, aligner and "
+                "settings the reads were annotated with: "
+                f"{', '.join(sorted(keys_exp))}."
+            )
+
+    def _validate_(self, level):
+        self._validate()
+
+
 class CARDAlleleAnnotationDirectoryFormat(
-    MultiDirValidationMixin, model.DirectoryFormat
+    ParallelMultiDirValidationMixin, model.DirectoryFormat
 ):
     allele = model.FileCollection(
         r".+allele_mapping_data.txt$", format=CARDAlleleAnnotationFormat
@@ -428,6 +655,11 @@ class CARDAlleleAnnotationDirectoryFormat(
         r".+overall_mapping_stats.txt$", format=CARDAnnotationStatsFormat
     )
     bam = model.FileCollection(r".+sorted.length_100.bam$", format=BAMFormat)
+    settings = model.FileCollection(
+        r".+annotation_settings.json$",
+        format=CARDAnnotationSettingsFormat,
+        optional=True,
+    )
 
     @allele.set_path_maker
     def allele_path_maker(self, sample_id):
@@ -441,6 +673,10 @@ class CARDAlleleAnnotationDirectoryFormat(
     def bam_path_maker(self, sample_id):
         return "%s/sorted.length_100.bam" % sample_id
 
+    @settings.set_path_maker
+    def settings_path_maker(self, sample_id):
+        return "%s/annotation_settings.json" % sample_id
+
     def sample_dict(self):
         sample_dict = {}
         for sample in self.path.iterdir():
@@ -448,51 +684,59 @@ class CARDAlleleAnnotationDirectoryFormat(
                 os.path.join(sample, "allele_mapping_data.txt"),
                 os.path.join(sample, "overall_mapping_stats.txt"),
                 os.path.join(sample, "sorted.length_100.bam"),
-            ]
+            ] + _settings_paths(sample)
         return sample_dict
 
 
-class CARDGeneAnnotationDirectoryFormat(MultiDirValidationMixin, model.DirectoryFormat):
+class CARDGeneAnnotationDirectoryFormat(
+    ParallelMultiDirValidationMixin, model.DirectoryFormat
+):
     gene = model.FileCollection(
         r".+gene_mapping_data.txt$", format=CARDGeneAnnotationFormat
     )
+    settings = model.FileCollection(
+        r".+annotation_settings.json$",
+        format=CARDAnnotationSettingsFormat,
+        optional=True,
+    )
 
     @gene.set_path_maker
     def gene_path_maker(self, sample_id):
         return "%s/gene_mapping_data.txt" % sample_id
 
+    @settings.set_path_maker
+    def settings_path_maker(self, sample_id):
+        return "%s/annotation_settings.json" % sample_id
+
     def sample_dict(self):
         sample_dict = {}
         for sample in self.path.iterdir():
-            sample_dict[sample.name] = [os.path.join(sample, "gene_mapping_data.txt")]
+            sample_dict[sample.name] = [
+                os.path.join(sample, "gene_mapping_data.txt")
+            ] + _settings_paths(sample)
         return sample_dict
 
 
-class CARDMAGsKmerAnalysisFormat(model.TextFileFormat):
-    def _validate(self, n_records=None):
-        header_exp = [
-            "ORF_ID",
-            "Contig",
-            "Cut_Off",
-            "Best_Hit_ARO",
-            "CARD*kmer Prediction",
-            "Taxonomic kmers",
-            "Genomic kmers",
-        ]
-
-        df = pd.read_csv(str(self), sep="\t")
-        header_obs = list(df.columns)
-        if not set(header_exp).issubset(set(header_obs)):
-            raise ValidationError(
-                "Header line does not match CARDMAGsKmerAnalysisFormat. Must contain"
-                "the following values: "
-                + ", ".join(header_exp)
-                + ".\n\nFound instead: "
-                + ", ".join(header_obs)
-            )
-
-    def _validate_(self, level):
-        self._validate()
+def _settings_paths(sample):
+    # Annotations created before the settings were recorded don't have this file
+    path = os.path.join(sample, "annotation_settings.json")
+    return [path] if os.path.exists(path) else []
+
+
+class CARDMAGsKmerAnalysisFormat(RGITableFormat):
+    header_exp = [
+        "ORF_ID",
+        "Contig",
+        "Cut_Off",
+        "Best_Hit_ARO",
+        "CARD*kmer Prediction",
+        "Taxonomic kmers",
+        "Genomic kmers",
+    ]
+    header_error = (
+        "Header line does not match CARDMAGsKmerAnalysisFormat. Must contain"
+        "the following values: "
+    )
 
 
 class CARDMAGsKmerAnalysisJSONFormat(model.TextFileFormat):
@@ -528,7 +772,7 @@ class CARDMAGsKmerAnalysisJSONFormat(model.TextFileFormat):
 
 
 class CARDMAGsKmerAnalysisDirectoryFormat(
-    MultiDirValidationMixin, model.DirectoryFormat
+    ParallelMultiDirValidationMixin, model.DirectoryFormat
 ):
     txt = model.FileCollection(
         r".+\d+mer_analysis_rgi_summary\.txt$", format=CARDMAGsKmerAnalysisFormat
@@ -548,74 +792,52 @@ class CARDMAGsKmerAnalysisDirectoryFormat(
         return f"{sample_id}/{bin_id}/{pattern}"
 
 
-class CARDReadsGeneKmerAnalysisFormat(model.TextFileFormat):
-    def _validate(self, n_records=None):
-        header_exp = [
-            "ARO term",
-            "Mapped reads with kmer DB hits",
-            "CARD*kmer Prediction",
-            "Single species (chromosome) reads",
-            "Single species (chromosome or plasmid) reads",
-            "Single species (plasmid) reads",
-            "Single species (no genomic info) reads",
-            "Single genus (chromosome) reads",
-            "Single genus (chromosome or plasmid) reads",
-            "Single genus (plasmid) reads",
-            "Single genus (no genomic info) reads",
-            "Promiscuous plasmid reads",
-            "Unknown taxonomy (chromosome) reads",
-            "Unknown taxonomy (chromosome or plasmid) reads",
-            "Unknown taxonomy (no genomic info) reads",
-        ]
-
-        df = pd.read_csv(str(self), sep="\t")
-        header_obs = list(df.columns)
-        if not set(header_exp).issubset(set(header_obs)):
-            raise ValidationError(
-                "Header line does not match CARDReadsGeneKmerAnalysisFormat. Must "
-                "contain the following values: "
-                + ", ".join(header_exp)
-                + ".\n\nFound instead: "
-                + ", ".join(header_obs)
-            )
-
-    def _validate_(self, level):
-        self._validate()
+class CARDReadsGeneKmerAnalysisFormat(RGITableFormat):
+    header_exp = [
+        "ARO term",
+        "Mapped reads with kmer DB hits",
+        "CARD*kmer Prediction",
+        "Single species (chromosome) reads",
+        "Single species (chromosome or plasmid) reads",
+        "Single species (plasmid) reads",
+        "Single species (no genomic info) reads",
+        "Single genus (chromosome) reads",
+        "Single genus (chromosome or plasmid) reads",
+        "Single genus (plasmid) reads",
+        "Single genus (no genomic info) reads",
+        "Promiscuous plasmid reads",
+        "Unknown taxonomy (chromosome) reads",
+        "Unknown taxonomy (chromosome or plasmid) reads",
+        "Unknown taxonomy (no genomic info) reads",
+    ]
+    header_error = (
+        "Header line does not match CARDReadsGeneKmerAnalysisFormat. Must "
+        "contain the following values: "
+    )
 
 
-class CARDReadsAlleleKmerAnalysisFormat(model.TextFileFormat):
-    def _validate(self, n_records=None):
-        header_exp = [
-            "Reference Sequence",
-            "Mapped reads with kmer DB hits",
-            "CARD*kmer Prediction",
-            "Single species (chromosome) reads",
-            "Single species (chromosome or plasmid) reads",
-            "Single species (plasmid) reads",
-            "Single species (no genomic info) reads",
-            "Single genus (chromosome) reads",
-            "Single genus (chromosome or plasmid) reads",
-            "Single genus (plasmid) reads",
-            "Single genus (no genomic info) reads",
-            "Promiscuous plasmid reads",
-            "Unknown taxonomy (chromosome) reads",
-            "Unknown taxonomy (chromosome or plasmid) reads",
-            "Unknown taxonomy (no genomic info) reads",
-        ]
-
-        df = pd.read_csv(str(self), sep="\t")
-        header_obs = list(df.columns)
-        if not set(header_exp).issubset(set(header_obs)):
-            raise ValidationError(
-                "Header line does not match CARDReadsAlleleKmerAnalysisFormat. Must "
-                "contain the following values: "
-                + ", ".join(header_exp)
-                + ".\n\nFound instead: "
-                + ", ".join(header_obs)
-            )
-
-    def _validate_(self, level):
-        self._validate()
+class CARDReadsAlleleKmerAnalysisFormat(RGITableFormat):
+    header_exp = [
+        "Reference Sequence",
+        "Mapped reads with kmer DB hits",
+        "CARD*kmer Prediction",
+        "Single species (chromosome) reads",
+        "Single species (chromosome or plasmid) reads",
+        "Single species (plasmid) reads",
+        "Single species (no genomic info) reads",
+        "Single genus (chromosome) reads",
+        "Single genus (chromosome or plasmid) reads",
+        "Single genus (plasmid) reads",
+        "Single genus (no genomic info) reads",
+        "Promiscuous plasmid reads",
+        "Unknown taxonomy (chromosome) reads",
+        "Unknown taxonomy (chromosome or plasmid) reads",
+        "Unknown taxonomy (no genomic info) reads",
+    ]
+    header_error = (
+        "Header line does not match CARDReadsAlleleKmerAnalysisFormat. Must "
+        "contain the following values: "
+    )
 
 
 class CARDReadsKmerAnalysisJSONFormat(model.TextFileFormat):
@@ -649,7 +871,7 @@ class CARDReadsKmerAnalysisJSONFormat(model.TextFileFormat):
 
 
 class CARDReadsAlleleKmerAnalysisDirectoryFormat(
-    MultiDirValidationMixin, model.DirectoryFormat
+    ParallelMultiDirValidationMixin, model.DirectoryFormat
 ):
     txt = model.FileCollection(
         r".+\d+mer_analysis\.allele\.txt$", format=CARDReadsAlleleKmerAnalysisFormat
@@ -670,7 +892,7 @@ class CARDReadsAlleleKmerAnalysisDirectoryFormat(
 
 
 class CARDReadsGeneKmerAnalysisDirectoryFormat(
-    MultiDirValidationMixin, model.DirectoryFormat
+    ParallelMultiDirValidationMixin, model.DirectoryFormat
 ):
     txt = model.FileCollection(
         r".+\d+mer_analysis\.gene\.txt$", format=CARDReadsGeneKmerAnalysisFormat
@@ -8,8 +8,8 @@
 import glob
 import json
 import os
-import shutil
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import qiime2
@@ -36,6 +36,7 @@ from ._format import (
     CARDReadsAlleleKmerAnalysisDirectoryFormat,
     CARDReadsGeneKmerAnalysisDirectoryFormat,
 )
+from ._util import read_rgi_table
 
 
 @plugin.register_transformer
@@ -191,41 +192,78 @@ def _11(data: CARDAnnotationDirectoryFormat) -> ProteinsDirectoryFormat:
 
 
 def create_dir_structure(annotation_dir, seq_type, genes_protein_directory):
+    # Collect the annotation TXT file of every bin and the FASTA file it is written to
+    jobs = []
     for sample in os.listdir(annotation_dir):
         for bin in os.listdir(os.path.join(annotation_dir, sample)):
             for file in os.listdir(os.path.join(annotation_dir, sample, bin)):
                 if file.endswith(".txt"):
-                    txt_file_path = os.path.join(annotation_dir, sample, bin, file)
                     os.makedirs(
                         os.path.join(str(genes_protein_directory), sample),
                         exist_ok=True,
                     )
-                    fasta = card_annotation_df_to_fasta(txt_file_path, seq_type)
                     filename = (
                         f"{bin}_genes.fasta"
                         if seq_type == "DNA"
                         else f"{bin}_proteins.fasta"
                     )
-                    shutil.move(
-                        str(fasta),
-                        os.path.join(str(genes_protein_directory), sample, filename),
+                    jobs.append(
+                        (
+                            os.path.join(annotation_dir, sample, bin, file),
+                            os.path.join(
+                                str(genes_protein_directory), sample, filename
+                            ),
+                        )
                     )
 
+    # Write the FASTA files of all bins concurrently
+    with ThreadPoolExecutor() as executor:
+        list(
+            executor.map(
+                lambda job: card_annotation_df_to_fasta(job[0], seq_type, job[1]), jobs
+            )
+        )
+
 
-def card_annotation_df_to_fasta(txt_file_path: str, seq_type: str):
-    annotation_df = pd.read_csv(txt_file_path, sep="\t")
-    fasta_format, sequence_class = (
-        (DNAFASTAFormat(), DNA)
-        if seq_type == "DNA"
-        else (ProteinFASTAFormat(), Protein)
+def card_annotation_df_to_fasta(
+    txt_file_path: str, seq_type: str, fasta_path: str = None
+):
+    """
+    Writes the predicted sequences of all ORFs in an RGI annotation TXT file to a
+    FASTA file. Only the needed columns are read and the records are formatted for
+    all ORFs at once, in the same way as skbio writes them.
+
+    Args:
+        txt_file_path (str): Path to the amr_annotation.txt file.
+        seq_type (str): "DNA" or "Protein".
+        fasta_path (str): Path to the FASTA file. By default a new DNAFASTAFormat or
+        ProteinFASTAFormat is created.
+
+    Returns:
+        The FASTA format if no fasta_path is specified, otherwise fasta_path.
+    """
+    seq_col = f"Predicted_{seq_type}"
+    annotation_df = read_rgi_table(
+        txt_file_path, usecols=["ORF_ID", "ARO", seq_col], dtype=str, engine="c"
+    ).dropna(subset=[seq_col])
+
+    if fasta_path is None:
+        fasta_path = DNAFASTAFormat() if seq_type == "DNA" else ProteinFASTAFormat()
+
+    # Whitespace in the IDs is replaced with underscores and the ARO accession is
+    # used as description. Records without ARO accession get no description
+    aro = annotation_df["ARO"].fillna("")
+    records = (
+        ">"
+        + annotation_df["ORF_ID"].str.replace(r"\s", "_", regex=True)
+        + (" " + aro).where(aro != "", "")
+        + "\n"
+        + annotation_df[seq_col]
+        + "\n"
     )
-    with open(str(fasta_format), "a") as fasta_file:
-        for index, row in annotation_df.iterrows():
-            sequence_object = sequence_class(row[f"Predicted_{seq_type}"])
-            sequence_object.metadata["id"] = row["ORF_ID"]
-            sequence_object.metadata["description"] = row["ARO"]
-            skbio.io.write(sequence_object, format="fasta", into=fasta_file)
-    return fasta_format
+    with open(str(fasta_path), "w") as fasta_file:
+        fasta_file.writelines(records)
+    return fasta_path
 
 
 @plugin.register_transformer
@@ -271,18 +309,22 @@ def tabulate_data(data_path, data_type):
     filename = filenames[data_type]
     df_list = []
 
+    # All tables are read with the C engine. RGI omits empty trailing fields in
+    # amr_annotation.txt files, which pyarrow can't parse, and pyarrow infers other
+    # column types than the C engine, which would change the tabulated metadata
+
     # Read in all analysis files as pd.Dataframes and add them to df_list
     for samp in os.listdir(str(data_path)):
         if data_type in ["mags", "kmer_mags"]:
             for bin in os.listdir(os.path.join(str(data_path), samp)):
                 file_path = glob.glob(rf"{str(data_path)}/{samp}/{bin}/{filename}")[0]
-                df = pd.read_csv(file_path, sep="\t")
+                df = read_rgi_table(file_path, engine="c")
                 df.insert(0, "Sample Name", f"{samp}/{bin}")
                 df_list.append(df)
 
         if data_type in ["allele", "gene", "kmer_allele", "kmer_gene"]:
             file_path = glob.glob(rf"{str(data_path)}/{samp}/{filename}")[0]
-            df = pd.read_csv(file_path, sep="\t")
+            df = read_rgi_table(file_path, engine="c")
             df.insert(0, "Sample Name", samp)
             df_list.append(df)
 
@@ -10,6 +10,7 @@ from qiime2.plugin import SemanticType
 
 CARDDatabase = SemanticType("CARDDatabase")
 CARDKmerDatabase = SemanticType("CARDKmerDatabase")
+CARDAlignerIndex = SemanticType("CARDAlignerIndex")
 CARDMAGsKmerAnalysis = SemanticType(
     "CARDMAGsKmerAnalysis", variant_of=SampleData.field["type"]
 )
@@ -0,0 +1,230 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, Bokulich Lab.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import csv
+import json
+import re
+
+import pandas as pd
+
+# The pyarrow CSV engine parses large tables considerably faster than the default C
+# engine but it is an optional dependency
+try:
+    import pyarrow  # noqa: F401
+
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
+
+# Size of the chunks in which JSON files are read
+CHUNK_SIZE = 1024**2
+
+_decoder = json.JSONDecoder()
+
+# Characters that change the nesting of JSON values and the end of a string
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_STRING_END = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+
+
+class _JSONReader:
+    # Reads a JSON file in chunks and decodes one value at a time from the buffer
+    def __init__(self, file, chunk_size: int):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        # Drop the decoded part of the buffer and read at least as much as is left
+        # in it, so that large values are read in a logarithmic number of steps
+        self.buffer = self.buffer[self.pos :]
+        self.pos = 0
+        chunk = self.file.read(max(self.chunk_size, len(self.buffer)))
+        if not chunk:
+            self.eof = True
+        self.buffer += chunk
+
+    def next_char(self):
+        # Returns the next character that is not whitespace and moves past it
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                self.pos += 1
+                return self.buffer[self.pos - 1]
+            if self.eof:
+                raise ValueError("Unexpected end of JSON file.")
+            self._fill()
+
+    def expect(self, char: str):
+        found = self.next_char()
+        if found != char:
+            raise ValueError(f"Expected '{char}' but found '{found}'.")
+
+    def decode(self):
+        # Move back to the first character of the value
+        self.next_char()
+        self.pos -= 1
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # A value that isn't followed by a delimiter might be cut off at the
+                # end of the buffer, like a number
+                if self.eof or (
+                    end < len(self.buffer) and self.buffer[end] in " \t\n\r,:]}"
+                ):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def skip(self):
+        # Moves past the next value without decoding it. Objects and arrays are only
+        # scanned for the characters that change their nesting
+        if self.next_char() not in "{[":
+            self.pos -= 1
+            self.decode()
+            return
+
+        depth = 1
+        while depth:
+            match = _STRUCTURE.search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                self._need_more()
+                continue
+            self.pos = match.end()
+
+            if match.group() == '"':
+                # Skip to the end of the string, which might be in the next chunk
+                end = _STRING_END.match(self.buffer, self.pos)
+                while end is None:
+                    self._need_more()
+                    end = _STRING_END.match(self.buffer, self.pos)
+                self.pos = end.end()
+            elif match.group() in "{[":
+                depth += 1
+            else:
+                depth -= 1
+
+    def _need_more(self):
+        if self.eof:
+            raise ValueError("Unexpected end of JSON file.")
+        self._fill()
+
+
+def _iter_items(path: str, chunk_size: int, decode_values: bool):
+    with open(path) as file:
+        reader = _JSONReader(file, chunk_size)
+        reader.expect("{")
+        if reader.next_char() == "}":
+            return
+        reader.pos -= 1
+
+        while True:
+            key = reader.decode()
+            if not isinstance(key, str):
+                raise ValueError(f"Expected a string key but found {key!r}.")
+            reader.expect(":")
+            if decode_values:
+                yield key, reader.decode()
+            else:
+                yield key
+                reader.skip()
+
+            char = reader.next_char()
+            if char == "}":
+                return
+            if char != ",":
+                raise ValueError(f"Expected ',' or '}}' but found '{char}'.")
+
+
+def iter_json_items(path: str, chunk_size: int = CHUNK_SIZE):
+    """
+    Iterates over the key-value pairs of the top-level JSON object in a file without
+    loading the whole file. Only one value at a time is held in memory.
+
+    Args:
+        path (str): Path to the JSON file.
+        chunk_size (int): Number of characters read from the file at once.
+
+    Yields:
+        tuple: Key and decoded value of every item in the top-level object.
+
+    Raises:
+        ValueError: If the file is not a JSON object.
+    """
+    return _iter_items(path, chunk_size, decode_values=True)
+
+
+def iter_json_keys(path: str, chunk_size: int = CHUNK_SIZE):
+    """
+    Iterates over the keys of the top-level JSON object in a file. Values are skipped
+    without decoding them, so that files with very large values can be scanned with
+    bounded memory.
+
+    Args:
+        path (str): Path to the JSON file.
+        chunk_size (int): Number of characters read from the file at once.
+
+    Yields:
+        str: Every key of the top-level object.
+
+    Raises:
+        ValueError: If the file is not a JSON object.
+    """
+    return _iter_items(path, chunk_size, decode_values=False)
+
+
+def read_rgi_table(
+    path: str,
+    usecols: list = None,
+    dtype: dict = None,
+    engine: str = CSV_ENGINE,
+    na_filter: bool = True,
+    quoting: int = csv.QUOTE_MINIMAL,
+) -> pd.DataFrame:
+    """
+    Reads a tab separated RGI output table. Only the columns in usecols are kept, so
+    that large columns like predicted or reference sequences don't have to be held in
+    memory when they are not needed.
+
+    Args:
+        path (str): Path to the table.
+        usecols (list): Names of the columns to read. All columns are read if None.
+        dtype (dict): Data types of the columns. Inferred by pandas if None.
+        engine (str): pandas parser engine. Defaults to pyarrow if it is installed.
+        amr_annotation.txt files have to be read with the C engine because RGI omits
+        empty trailing fields in them, which pyarrow can't parse.
+        na_filter (bool): Parse missing values like "n/a" to NaN. If False, all
+        values are kept as they are in the file.
+        quoting (int): csv quoting constant. With csv.QUOTE_NONE, quote characters
+        are read as part of the values. Only supported by the C engine.
+
+    Returns:
+        pd.DataFrame: The table with the columns in the same order as in the file.
+    """
+    df = pd.read_csv(
+        path,
+        sep="\t",
+        usecols=usecols,
+        dtype=dtype,
+        engine=engine,
+        na_filter=na_filter,
+        quoting=quoting,
+    )
+
+    # pyarrow returns the columns in the order of usecols
+    if usecols is not None:
+        with open(path, newline="") as f:
+            header = next(csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE), [])
+        df = df[[col for col in header if col in df.columns]]
+    return df
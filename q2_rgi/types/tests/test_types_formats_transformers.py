@@ -9,6 +9,7 @@ import json
 import os
 import shutil
 import warnings
+from unittest.mock import patch
 
 import pandas as pd
 import qiime2
@@ -30,12 +31,17 @@ from q2_rgi.types import (
     CARDGeneAnnotationDirectoryFormat,
 )
 from q2_rgi.types._format import (
+    VALIDATION_WORKERS_ENV,
+    CARDAlignerIndexDirectoryFormat,
+    CARDAlignerIndexMetadataFormat,
     CARDAlleleAnnotationFormat,
     CARDAnnotationDirectoryFormat,
     CARDAnnotationJSONFormat,
+    CARDAnnotationSettingsFormat,
     CARDAnnotationStatsFormat,
     CARDAnnotationTXTFormat,
     CARDDatabaseFormat,
+    CARDFetchMetadataFormat,
     CARDGeneAnnotationFormat,
     CARDKmerDatabaseDirectoryFormat,
     CARDKmerJSONFormat,
@@ -67,6 +73,41 @@ class TestCARDDatabaseTypesAndFormats(TestPluginBase):
         format = CARDDatabaseFormat(filepath, mode="r")
         format.validate()
 
+    def test_card_database_format_validate_min_positive(self):
+        filepath = self.get_data_path("card_test.json")
+        format = CARDDatabaseFormat(filepath, mode="r")
+        format.validate(level="min")
+
+    def test_card_database_format_validate_negative(self):
+        filepath = os.path.join(self.temp_dir.name, "card.json")
+        with open(filepath, "w") as f:
+            json.dump({"1": {"model_id": "1", "unknown_key": "value"}}, f)
+        format = CARDDatabaseFormat(filepath, mode="r")
+        for level in ["min", "max"]:
+            with self.assertRaisesRegex(ValidationError, "Found instead: model_id"):
+                format.validate(level=level)
+
+    def test_card_database_format_validate_missing_keys(self):
+        # Missing keys are only detected when all records are read
+        with open(self.get_data_path("card_test.json")) as f:
+            card = json.load(f)
+        del card["_comment"]
+        filepath = os.path.join(self.temp_dir.name, "card.json")
+        with open(filepath, "w") as f:
+            json.dump(card, f)
+        format = CARDDatabaseFormat(filepath, mode="r")
+        format.validate(level="min")
+        with self.assertRaisesRegex(ValidationError, "Header line does not match"):
+            format.validate(level="max")
+
+    def test_card_database_format_validate_invalid_json(self):
+        filepath = os.path.join(self.temp_dir.name, "card.json")
+        with open(filepath, "w") as f:
+            f.write('{"1": {"model_id": "1"')
+        format = CARDDatabaseFormat(filepath, mode="r")
+        with self.assertRaisesRegex(ValidationError, "not a valid JSON file"):
+            format.validate()
+
     def test_wildcard_index_format_validate_positive(self):
         filepath = self.get_data_path("index-for-model-sequences-test.txt")
         format = CARDWildcardIndexFormat(filepath, mode="r")
@@ -109,6 +150,70 @@ class TestCARDDatabaseTypesAndFormats(TestPluginBase):
         format = CARDDatabaseDirectoryFormat(self.temp_dir.name, mode="r")
         format.validate()
 
+    def test_card_fetch_metadata_format_validate_positive(self):
+        filepath = os.path.join(self.temp_dir.name, "fetch_metadata.json")
+        with open(filepath, "w") as f:
+            json.dump({"https://card.mcmaster.ca/latest/data": '"v1"'}, f)
+        format = CARDFetchMetadataFormat(filepath, mode="r")
+        format.validate()
+
+    def test_card_fetch_metadata_format_validate_negative(self):
+        filepath = os.path.join(self.temp_dir.name, "fetch_metadata.json")
+        with open(filepath, "w") as f:
+            json.dump({"https://card.mcmaster.ca/latest/data": 1}, f)
+        format = CARDFetchMetadataFormat(filepath, mode="r")
+        with self.assertRaisesRegex(ValidationError, "Fetch metadata must map"):
+            format.validate()
+
+    def test_card_annotation_settings_format_validate_positive(self):
+        filepath = os.path.join(self.temp_dir.name, "annotation_settings.json")
+        with open(filepath, "w") as f:
+            json.dump(
+                {
+                    "card_version": "3.2.5",
+                    "aligner": "kma",
+                    "include_wildcard": False,
+                    "include_other_models": False,
+                },
+                f,
+            )
+        format = CARDAnnotationSettingsFormat(filepath, mode="r")
+        format.validate()
+
+    def test_card_annotation_settings_format_validate_negative(self):
+        filepath = os.path.join(self.temp_dir.name, "annotation_settings.json")
+        with open(filepath, "w") as f:
+            json.dump({"aligner": "kma"}, f)
+        format = CARDAnnotationSettingsFormat(filepath, mode="r")
+        with self.assertRaisesRegex(ValidationError, "Annotation settings must"):
+            format.validate()
+
+    def test_card_aligner_index_directory_format_validate_positive(self):
+        index_dir = os.path.join(self.temp_dir.name, "card_index")
+        os.makedirs(os.path.join(index_dir, "localDB", "kma"))
+        with open(os.path.join(index_dir, "localDB", "kma", "index.name"), "wb") as f:
+            f.write(b"\x00\x01")
+        with open(os.path.join(index_dir, "index_metadata.json"), "w") as f:
+            json.dump(
+                {
+                    "card_version": "3.2.5",
+                    "aligner": "kma",
+                    "include_wildcard": False,
+                    "include_other_models": False,
+                },
+                f,
+            )
+        format = CARDAlignerIndexDirectoryFormat(index_dir, mode="r")
+        format.validate()
+
+    def test_card_aligner_index_metadata_format_validate_negative(self):
+        filepath = os.path.join(self.temp_dir.name, "index_metadata.json")
+        with open(filepath, "w") as f:
+            json.dump({"aligner": "kma"}, f)
+        format = CARDAlignerIndexMetadataFormat(filepath, mode="r")
+        with self.assertRaisesRegex(ValidationError, "Index metadata must contain"):
+            format.validate()
+
     def test_dataframe_to_card_format_transformer(self):
         filepath = self.get_data_path("card_test.json")
         transformer = self.get_transformer(pd.DataFrame, CARDDatabaseFormat)
@@ -233,6 +338,34 @@ class TestCARDCARDKmerDirectoryTypesAndFormats(TestPluginBase):
         format = CARDKmerJSONFormat(filepath, mode="r")
         format.validate()
 
+    def test_kmer_txt_format_validate_levels(self):
+        # Invalid lines after the first ten are only found at the max level
+        filepath = os.path.join(self.temp_dir.name, "all_amr_61mers.txt")
+        with open(filepath, "w") as f:
+            f.write("ACGT\t1\n" * 10 + "invalid\n")
+        format = CARDKmerTXTFormat(filepath, mode="r")
+        format.validate(level="min")
+        with self.assertRaisesRegex(ValidationError, "not the correct format"):
+            format.validate(level="max")
+
+    def test_kmer_json_format_validate_levels(self):
+        # Only the first key is checked at the min level
+        filepath = os.path.join(self.temp_dir.name, "61_kmer_db.json")
+        with open(filepath, "w") as f:
+            json.dump({"p": {"ACGT": ["a"]}, "c": {}, "b": {}, "s": {}, "x": {}}, f)
+        format = CARDKmerJSONFormat(filepath, mode="r")
+        format.validate(level="min")
+        with self.assertRaisesRegex(ValidationError, "Found instead: p, c, b, s, x"):
+            format.validate(level="max")
+
+    def test_kmer_json_format_validate_negative(self):
+        filepath = os.path.join(self.temp_dir.name, "61_kmer_db.json")
+        with open(filepath, "w") as f:
+            json.dump({"x": {}}, f)
+        format = CARDKmerJSONFormat(filepath, mode="r")
+        with self.assertRaisesRegex(ValidationError, "Keys do not match"):
+            format.validate(level="min")
+
     def test_card_kmer_database_directory_format_validate_positive(self):
         src_des_list = [
             ("kmer_json_test.json", "61_kmer_db.json"),
@@ -280,6 +413,35 @@ class TestCARDMagsAnnotationTypesAndFormats(TestPluginBase):
         self.assertEqual(protein_contents_obs, protein_contents_exp)
         self.assertEqual(dna_contents_obs, dna_contents_exp)
 
+    def test_card_annotation_df_to_fasta_path(self):
+        # Records are written straight into the specified file
+        fasta_path = os.path.join(self.temp_dir.name, "bin1_genes.fasta")
+        obs = card_annotation_df_to_fasta(
+            self.get_data_path("rgi_output.txt"), "DNA", fasta_path
+        )
+        self.assertEqual(obs, fasta_path)
+        with open(fasta_path) as obs_fh, open(
+            self.get_data_path("rgi_output_dna.fna")
+        ) as exp_fh:
+            self.assertEqual(obs_fh.read(), exp_fh.read())
+
+    def test_card_annotation_df_to_fasta_missing_aro(self):
+        # Records without ARO accession are written without description
+        df = pd.read_csv(
+            self.get_data_path("rgi_output.txt"), sep="\t", dtype=str, na_filter=False
+        )
+        df.loc[0, "ARO"] = ""
+        txt_path = os.path.join(self.temp_dir.name, "amr_annotation.txt")
+        df.to_csv(txt_path, sep="\t", index=False)
+
+        obs = card_annotation_df_to_fasta(txt_path, "Protein")
+
+        with open(str(obs)) as obs_fh, open(
+            self.get_data_path("rgi_output_protein.fna")
+        ) as exp_fh:
+            exp = exp_fh.read().replace(" 3002525\n", "\n", 1)
+            self.assertEqual(obs_fh.read(), exp)
+
     def test_CARDAnnotationDirectoryFormat_to_GenesDirectoryFormat_transformer(self):
         filepath = self.get_data_path("card_annotation")
         transformer = self.get_transformer(
@@ -413,6 +575,37 @@ class TestCARDMagsAnnotationTypesAndFormats(TestPluginBase):
         with self.assertRaisesRegex(ValidationError, "CARDAnnotationTXTFormat"):
             format.validate()
 
+    def test_card_annotation_txt_format_validate_levels(self):
+        # Rows are only checked at the max level
+        filepath = os.path.join(self.temp_dir.name, "amr_annotation.txt")
+        header = CARDAnnotationTXTFormat.header_exp
+        with open(filepath, "w") as f:
+            f.write("\t".join(header) + "\n")
+            f.write("\t".join(["x"] * (len(header) + 1)) + "\n")
+        format = CARDAnnotationTXTFormat(filepath, mode="r")
+        format.validate(level="min")
+        with self.assertRaisesRegex(ValidationError, "Line 2 has 26 fields"):
+            format.validate(level="max")
+
+    def test_card_annotation_txt_format_validate_quotes(self):
+        # Quotes are part of the fields and don't join the following rows
+        filepath = os.path.join(self.temp_dir.name, "amr_annotation.txt")
+        header = CARDAnnotationTXTFormat.header_exp
+        with open(filepath, "w") as f:
+            f.write("\t".join(header) + "\n")
+            f.write("\t".join(['"x'] * len(header)) + "\n")
+            f.write("\t".join(["x"] * (len(header) + 1)) + "\n")
+        format = CARDAnnotationTXTFormat(filepath, mode="r")
+        with self.assertRaisesRegex(ValidationError, "Line 3 has 26 fields"):
+            format.validate(level="max")
+
+    def test_card_annotation_txt_format_validate_empty(self):
+        filepath = os.path.join(self.temp_dir.name, "amr_annotation.txt")
+        open(filepath, "w").close()
+        format = CARDAnnotationTXTFormat(filepath, mode="r")
+        with self.assertRaisesRegex(ValidationError, "Found instead: $"):
+            format.validate(level="min")
+
     def test_card_annotation_json_format_validate_positive(self):
         filepath = self.get_data_path(
             "card_annotation/sample1/e026af61-d911-4de3-a957-7e8bf837f30d/"
@@ -427,6 +620,34 @@ class TestCARDMagsAnnotationTypesAndFormats(TestPluginBase):
         with self.assertRaisesRegex(ValidationError, "CARDAnnotation"):
             format.validate()
 
+    def test_card_annotation_json_format_validate_levels(self):
+        # The keys of the first ten HSPs are incomplete, so the file is only valid
+        # when all HSPs are read at the max level
+        filepath = self.get_data_path(
+            "card_annotation/sample1/e026af61-d911-4de3-a957-7e8bf837f30d/"
+            "amr_annotation.json"
+        )
+        with open(filepath) as f:
+            hsp = next(iter(next(iter(json.load(f).values())).values()))
+        orfs = {f"orf_{i}": {"hsp": {"match": "x"}} for i in range(10)}
+        orfs["orf_10"] = {"hsp": hsp}
+
+        filepath = os.path.join(self.temp_dir.name, "amr_annotation.json")
+        with open(filepath, "w") as f:
+            json.dump(orfs, f)
+        format = CARDAnnotationJSONFormat(filepath, mode="r")
+        format.validate(level="max")
+        with self.assertRaisesRegex(ValidationError, "Found instead: match"):
+            format.validate(level="min")
+
+    def test_card_annotation_json_format_validate_invalid_json(self):
+        filepath = os.path.join(self.temp_dir.name, "amr_annotation.json")
+        with open(filepath, "w") as f:
+            f.write('{"orf": {"hsp": {"match": ')
+        format = CARDAnnotationJSONFormat(filepath, mode="r")
+        with self.assertRaisesRegex(ValidationError, "not a valid JSON file"):
+            format.validate()
+
 
 class TestCARDReadsAnnotationTypesAndFormats(TestPluginBase):
     package = "q2_rgi.types.tests"
@@ -509,6 +730,38 @@ class TestCARDReadsAnnotationTypesAndFormats(TestPluginBase):
         with self.assertRaisesRegex(ValidationError, "CARDAlleleAnnotationFormat"):
             format.validate()
 
+    def test_card_gene_annotation_directory_format_validate_workers(self):
+        dirpath = self.get_data_path("card_gene_annotation")
+        with patch.dict(os.environ, {VALIDATION_WORKERS_ENV: "1"}):
+            CARDGeneAnnotationDirectoryFormat(dirpath, mode="r").validate()
+
+    def test_card_gene_annotation_directory_format_validate_invalid_workers(self):
+        dirpath = self.get_data_path("card_gene_annotation")
+        annotations = CARDGeneAnnotationDirectoryFormat(dirpath, mode="r")
+        for workers in ["two", "0"]:
+            with patch.dict(os.environ, {VALIDATION_WORKERS_ENV: workers}):
+                with self.assertRaisesRegex(ValueError, VALIDATION_WORKERS_ENV):
+                    annotations.validate()
+
+    def test_card_gene_annotation_directory_format_validate_first_error(self):
+        # The error of the first invalid file in path order is raised
+        dirpath = os.path.join(self.temp_dir.name, "card_gene_annotation")
+        shutil.copytree(self.get_data_path("card_gene_annotation"), dirpath)
+        for sample in ["sample1", "sample2"]:
+            with open(os.path.join(dirpath, sample, "gene_mapping_data.txt"), "w") as f:
+                f.write("invalid\n")
+        annotations = CARDGeneAnnotationDirectoryFormat(dirpath, mode="r")
+        with self.assertRaisesRegex(ValidationError, "sample1"):
+            annotations.validate()
+
+    def test_card_gene_annotation_directory_format_validate_unrecognized(self):
+        dirpath = os.path.join(self.temp_dir.name, "card_gene_annotation")
+        shutil.copytree(self.get_data_path("card_gene_annotation"), dirpath)
+        open(os.path.join(dirpath, "sample1", "other.txt"), "w").close()
+        annotations = CARDGeneAnnotationDirectoryFormat(dirpath, mode="r")
+        with self.assertRaisesRegex(ValidationError, "Unrecognized file"):
+            annotations.validate()
+
     def test_card_annotation_stats_validate_positive(self):
         filepath = self.get_data_path(
             "card_allele_annotation/sample1/overall_mapping_stats.txt"
@@ -0,0 +1,113 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, Bokulich Lab.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import os
+
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_rgi.types._util import iter_json_items, iter_json_keys
+
+
+class TestIterJSONItems(TestPluginBase):
+    package = "q2_rgi.types.tests"
+
+    def write_json(self, content):
+        path = os.path.join(self.temp_dir.name, "file.json")
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_iter_json_items(self):
+        path = self.get_data_path("card_test.json")
+        with open(path) as f:
+            exp = json.load(f)
+
+        # Values that are split between chunks are decoded correctly
+        for chunk_size in [1, 7, 1024]:
+            obs = dict(iter_json_items(path, chunk_size=chunk_size))
+            self.assertEqual(obs, exp)
+
+    def test_iter_json_items_numbers_at_chunk_border(self):
+        path = self.write_json('{"a": 12345, "b": [1, 2]}')
+        self.assertEqual(
+            list(iter_json_items(path, chunk_size=2)), [("a", 12345), ("b", [1, 2])]
+        )
+
+    def test_iter_json_items_escapes_at_chunk_border(self):
+        # Escapes and \u sequences that are split between chunks are decoded
+        # correctly with every chunk size
+        content = (
+            '{"a\\"b": "x\\\\", "\\u00e9\\ud83d\\ude00": ["\\\\\\"", "\\u005d"], '
+            '"n": "\u00e9\U0001f600 {[", "e": ""}'
+        )
+        path = self.write_json(content)
+        exp = json.loads(content)
+
+        for chunk_size in range(1, len(content) + 1):
+            obs = dict(iter_json_items(path, chunk_size=chunk_size))
+            self.assertEqual(obs, exp)
+
+    def test_iter_json_items_empty(self):
+        path = self.write_json(" {} ")
+        self.assertEqual(list(iter_json_items(path)), [])
+
+    def test_iter_json_items_stops_early(self):
+        # Items are decoded one at a time, so invalid content after the items that
+        # were read is not reached
+        path = self.write_json('{"a": 1, "b": invalid')
+        self.assertEqual(next(iter_json_items(path)), ("a", 1))
+
+    def test_iter_json_items_invalid(self):
+        for content in ["[1, 2]", '{"a": 1', '{"a" 1}', '{"a": 1,}', "{1: 2}"]:
+            path = self.write_json(content)
+            with self.assertRaises(ValueError):
+                list(iter_json_items(path))
+
+
+class TestIterJSONKeys(TestPluginBase):
+    package = "q2_rgi.types.tests"
+
+    def write_json(self, content):
+        path = os.path.join(self.temp_dir.name, "file.json")
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_iter_json_keys(self):
+        # Strings with brackets, quotes and escapes don't change the nesting
+        content = {
+            "p": {"A{C": ["x]", 'y"'], "G\\": {"T": [1, {"}": []}]}},
+            "c": "[",
+            "b": 1.5,
+            "s": [],
+            "g": None,
+        }
+        path = self.write_json(json.dumps(content))
+
+        for chunk_size in [1, 3, 1024]:
+            obs = list(iter_json_keys(path, chunk_size=chunk_size))
+            self.assertEqual(obs, ["p", "c", "b", "s", "g"])
+
+    def test_iter_json_keys_escapes_at_chunk_border(self):
+        # Skipped strings with escaped quotes and backslashes end at the right quote
+        # wherever they are split between chunks
+        content = (
+            '{"a": {"\\\\": ["\\"]", "\\\\\\"}"]}, '
+            '"\\u0062": ["\\ud83d\\ude00\\\\"], "c": "\u00e9\\"["}'
+        )
+        path = self.write_json(content)
+
+        for chunk_size in range(1, len(content) + 1):
+            obs = list(iter_json_keys(path, chunk_size=chunk_size))
+            self.assertEqual(obs, ["a", "b", "c"])
+
+    def test_iter_json_keys_invalid(self):
+        for content in ['{"a": {"b": [1, 2}', '{"a": "b', '["a"]']:
+            path = self.write_json(content)
+            with self.assertRaises(ValueError):
+                list(iter_json_keys(path, chunk_size=2))